@@ -7,24 +7,20 @@
 # NOTEBOOK.
 
 import os
-import sys
-from tempfile import NamedTemporaryFile
-from urllib.request import urlopen
-from urllib.parse import unquote, urlparse
-from urllib.error import HTTPError
-from zipfile import ZipFile
-import tarfile
-import shutil
-
-CHUNK_SIZE = 40960
+
+from handwritten_ocr.fetch import fetch_data_sources
+
 DATA_SOURCE_MAPPING = 'handwriting-recognitionocr:https%3A%2F%2Fstorage.googleapis.com%2Fkaggle-data-sets%2F1081982%2F1821108%2Fbundle%2Farchive.zip%3FX-Goog-Algorithm%3DGOOG4-RSA-SHA256%26X-Goog-Credential%3Dgcp-kaggle-com%2540kaggle-161607.iam.gserviceaccount.com%252F20241011%252Fauto%252Fstorage%252Fgoog4_request%26X-Goog-Date%3D20241011T012516Z%26X-Goog-Expires%3D259200%26X-Goog-SignedHeaders%3Dhost%26X-Goog-Signature%3D85471552d6d05a1c9bbf9d755ecaab994dba45fb89c196a92bff3d89b7168e3ba1aa62c4781f33f133108870de98adab6f646b058e0517a4e57fe6b5f3f58f7cb45bdf37530005a29dec4254804d78d72efe887f8a76ea89a78e9b29acbb51a8d741d959ae05ebcfce8255bc3a3105a78d5dfa4784fa8d1a9749b25bce887087d65f02db14ef6db336d29b52032e59081722e041c24d50a85c8342dd66b20832952f5ba66ccfc55cac1545282299c216279872a4778938829bfb4d3e6201e2d10904af2387470fb911194ec7d8323f54e258733102b344b5cee03763f4f489909adedfeb41b13bba2dd99093b2f8108f86115bdd6bc8385211f61550b459974c'
 
 KAGGLE_INPUT_PATH='/kaggle/input'
 KAGGLE_WORKING_PATH='/kaggle/working'
 KAGGLE_SYMLINK='kaggle'
+KAGGLE_CACHE_PATH=os.environ.get('OCR_DATA_CACHE', '/kaggle/working/.data-cache')
+
+# Optional expected SHA-256 digests, keyed by data source directory
+DATA_SOURCE_CHECKSUMS = {}
 
 !umount /kaggle/input/ 2> /dev/null
-shutil.rmtree('/kaggle/input', ignore_errors=True)
 os.makedirs(KAGGLE_INPUT_PATH, 0o777, exist_ok=True)
 os.makedirs(KAGGLE_WORKING_PATH, 0o777, exist_ok=True)
 
@@ -37,39 +33,13 @@ try:
 except FileExistsError:
   pass
 
-for data_source_mapping in DATA_SOURCE_MAPPING.split(','):
-    directory, download_url_encoded = data_source_mapping.split(':')
-    download_url = unquote(download_url_encoded)
-    filename = urlparse(download_url).path
-    destination_path = os.path.join(KAGGLE_INPUT_PATH, directory)
-    try:
-        with urlopen(download_url) as fileres, NamedTemporaryFile() as tfile:
-            total_length = fileres.headers['content-length']
-            print(f'Downloading {directory}, {total_length} bytes compressed')
-            dl = 0
-            data = fileres.read(CHUNK_SIZE)
-            while len(data) > 0:
-                dl += len(data)
-                tfile.write(data)
-                done = int(50 * dl / int(total_length))
-                sys.stdout.write(f"\r[{'=' * done}{' ' * (50-done)}] {dl} bytes downloaded")
-                sys.stdout.flush()
-                data = fileres.read(CHUNK_SIZE)
-            if filename.endswith('.zip'):
-              with ZipFile(tfile) as zfile:
-                zfile.extractall(destination_path)
-            else:
-              with tarfile.open(tfile.name) as tarfile:
-                tarfile.extractall(destination_path)
-            print(f'\nDownloaded and uncompressed: {directory}')
-    except HTTPError as e:
-        print(f'Failed to load (likely expired) {download_url} to path {destination_path}')
-        continue
-    except OSError as e:
-        print(f'Failed to load {download_url} to path {destination_path}')
-        continue
-
-print('Data source import complete.')
+# Downloads in parallel byte ranges, resumes partial downloads and reuses verified cached archives.
+fetch_data_sources(
+    DATA_SOURCE_MAPPING,
+    KAGGLE_INPUT_PATH,
+    KAGGLE_CACHE_PATH,
+    checksums=DATA_SOURCE_CHECKSUMS
+)
 
 """# **Introduction**
 ---
@@ -123,6 +93,7 @@ Below are all the modules that are used in the notebook.
 """
 
 # Common
+import math
 import numpy as np
 import pandas as pd
 import tensorflow as tf
@@ -141,6 +112,33 @@ from tensorflow import keras
 from tensorflow.keras import callbacks
 from tensorflow.keras import layers
 
+# Project helpers
+from handwritten_ocr.preprocessing import decode_image
+from handwritten_ocr import records
+from handwritten_ocr.image_cache import ImageCache
+from handwritten_ocr.decoding import BeamSearchDecoder, GreedyDecoder
+from handwritten_ocr.evaluation import build_eval_dataset, evaluate, format_report
+from handwritten_ocr.models import ARCHITECTURES, ENCODERS, CTCLayer, build_ocr_model
+from handwritten_ocr.training import (
+    ThroughputLogger, compare_training_modes, format_time_to_target, large_batch_optimizer, set_training_mode,
+    time_to_target
+)
+from handwritten_ocr.distributed import format_scaling, scaling_report, training_job
+from handwritten_ocr.vocabulary import load_or_create, vocabulary_path
+from handwritten_ocr.instrumentation import PipelineMonitor, PipelineStats, instrumented_dataset, notebook_stages
+from handwritten_ocr.bucketing import benchmark_fit, bucketed_dataset
+from handwritten_ocr.augmentation import BatchAugmenter, augment_dataset, batched_dataset
+from handwritten_ocr.checkpointing import fit_resumable
+from handwritten_ocr.distillation import distill, format_latency_report, latency_report
+from handwritten_ocr.export import ExportedOCR, export_saved_model
+from handwritten_ocr.batch import run_batch
+from handwritten_ocr.cascade import CascadeOCR, cascade_report, format_cascade_report
+from handwritten_ocr.prediction_cache import CachedModel, PredictionCache
+from handwritten_ocr.sweep import encoder_trials, format_leaderboard, prepare_data, run_sweep, trial
+from handwritten_ocr.quantization import (
+    TFLiteRunner, calibration_images, compare_models, export_tflite, format_comparison
+)
+
 """In the **data loading and model building process**, various constants are defined and used to **streamline the workflow** **and** ensure consistency in the results. Below are some of the essential constants used in the process:
 
 * **IMG_WIDTH**: This constant defines the width of the input image and is used in the preprocessing step to resize the images.
@@ -180,15 +178,29 @@ EPOCHS = 9
 # Model Name
 MODEL_NAME = 'Handwritten-OCR'
 
+# Training Mode : 'float32', 'mixed' (bfloat16 where supported), 'xla' or 'mixed_xla'
+TRAINING_MODE = 'float32'
+TRAINING_CONFIG = set_training_mode(TRAINING_MODE)
+
 # Callbacks
 CALLBACKS = [
     callbacks.EarlyStopping(patience=10, restore_best_weights=True),
-    callbacks.ModelCheckpoint(filepath=MODEL_NAME + ".keras", save_best_only=True)
+    callbacks.ModelCheckpoint(filepath=MODEL_NAME + ".keras", save_best_only=True),
+    ThroughputLogger(BATCH_SIZE, name=TRAINING_MODE)
 ]
 
 # Learning Rate
 LEARNING_RATE = 1e-3
 
+# Large-batch mode : effective batch of an update, micro batch held in memory, and the validation loss
+# the settings race to
+LARGE_BATCH_SIZE = 1024
+MICRO_BATCH_SIZE = 256
+TARGET_VAL_LOSS = 5.0
+
+# Beam Search
+BEAM_WIDTH = 10
+
 # Random Seed
 np.random.seed(2569)
 tf.random.set_seed(2569)
@@ -202,8 +214,35 @@ train_image_dir = '/kaggle/input/handwriting-recognitionocr/train_v2/train'
 valid_image_dir = '/kaggle/input/handwriting-recognitionocr/validation_v2/validation'
 test_image_dir = '/kaggle/input/handwriting-recognitionocr/test_v2/test'
 
+# Sharded records : set to True to train on the whole train_v2 directory from TFRecord shards
+USE_RECORD_SHARDS = False
+SHARD_DIR = '/kaggle/working/shards'
+
+# Preprocessed image cache : shared by every split and every model, persists across runs
+USE_IMAGE_CACHE = True
+IMAGE_CACHE_DIR = '/kaggle/working/image-cache'
+IMAGE_CACHE_MAX_BYTES = 8 * 1024 ** 3
+
+# Persistent prediction cache, keyed by the model weights and the image, and its size cap in bytes
+PREDICTION_CACHE_DIR = '/kaggle/working/prediction-cache'
+PREDICTION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Batched augmentation of the training split (faded, erased and poorly lit writing), seeded
+USE_AUGMENTATION = True
+AUGMENTATION_SEED = 2569
+
+# Step level checkpoints, so that a preempted run resumes in the middle of its epoch
+CHECKPOINT_DIR = '/kaggle/working/checkpoints'
+CHECKPOINT_STEPS = 200
+
+# Per-image CPU latency budget of the distilled student, in milliseconds
+STUDENT_LATENCY_BUDGET_MS = 5
+
+# Confidence below which the cascade sends an image to the large model
+CASCADE_THRESHOLD = 0.9
+
 # Data Size
-TRAIN_SIZE = BATCH_SIZE * 1000
+TRAIN_SIZE = None if USE_RECORD_SHARDS else BATCH_SIZE * 1000
 VALID_SIZE = BATCH_SIZE * 500
 TEST_SIZE  = BATCH_SIZE * 100
 
@@ -239,8 +278,9 @@ train_labels[:10]
 
 """From these words, we need to extract the **unique characters**."""
 
-# Unique characters
-unique_chars = set(char for word in train_labels for char in word)
+# Unique characters, in a fixed order saved next to the model so that its checkpoints keep their classes
+vocabulary = load_or_create(vocabulary_path(MODEL_NAME + ".keras"), train_labels)
+unique_chars = vocabulary.characters
 n_classes = len(unique_chars)
 
 # Show
@@ -303,20 +343,8 @@ def load_image(image_path : str):
     # Read the Image
     image = tf.io.read_file(image_path)
 
-    # Decode the image
-    decoded_image = tf.image.decode_jpeg(contents = image, channels = 1)
-
-    # Convert image data type.
-    cnvt_image = tf.image.convert_image_dtype(image = decoded_image, dtype = tf.float32)
-
-    # Resize the image
-    resized_image = tf.image.resize(images = cnvt_image, size = (IMG_HEIGHT, IMG_WIDTH))
-
-    # Transpose
-    image = tf.transpose(resized_image, perm = [1, 0, 2])
-
-    # Convert image to a tensor.
-    image = tf.cast(image, dtype = tf.float32)
+    # Decode, convert, resize and transpose the image
+    image = decode_image(image, img_height = IMG_HEIGHT, img_width = IMG_WIDTH)
 
     # Return loaded image
     return image
@@ -325,7 +353,7 @@ def encode_single_sample(image_path : str, label : str):
 
     '''
     The function takes an image path and label as input and returns a dictionary containing the processed image tensor and the label tensor.
-    First, it loads the image using the load_image function, which decodes and resizes the image to a specific size. Then it converts the given
+    First, it reads the image file and hands the bytes to encode_record, which decodes and resizes the image to a specific size. Then it converts the given
     label string into a sequence of Unicode characters using the unicode_split function. Next, it uses the char_to_num layer to convert each
     character in the label to a numerical representation. It pads the numerical representation with a special class (n_classes)
     to ensure that all labels have the same length (MAX_LABEL_LENGTH). Finally, it returns a dictionary containing the processed image tensor
@@ -339,8 +367,57 @@ def encode_single_sample(image_path : str, label : str):
         dict : A dictionary containing the processed image and label.
     '''
 
+    return encode_record(tf.io.read_file(image_path), label)
+
+def encode_record(image_bytes, label : str):
+
+    '''
+    Same as encode_single_sample, but starts from the raw JPEG bytes instead of a file path. This is
+    what the TFRecord shard reader produces.
+
+    Arguments :
+        image_bytes : The encoded JPEG.
+        label       : The text to present in the image.
+
+    Returns:
+        dict : A dictionary containing the processed image and label.
+    '''
+
+    # Get the image
+    image = decode_image(image_bytes, img_height = IMG_HEIGHT, img_width = IMG_WIDTH)
+
+    return {'image':image, 'label':encode_label(label)}
+
+def encode_packed_record(image_bytes, label_ids):
+
+    '''
+    Same as encode_record, for records packed with their labels already encoded (see records.pack_shards),
+    so only the image is processed.
+
+    Arguments :
+        image_bytes : The encoded JPEG.
+        label_ids   : The padded label indices stored in the record.
+
+    Returns:
+        dict : A dictionary containing the processed image and label.
+    '''
+
     # Get the image
-    image = load_image(image_path)
+    image = decode_image(image_bytes, img_height = IMG_HEIGHT, img_width = IMG_WIDTH)
+
+    return {'image':image, 'label':label_ids}
+
+def encode_label(label : str):
+
+    '''
+    Converts a label string into its padded numeric representation, as described in encode_single_sample.
+
+    Argument :
+        label : The text to present in the image.
+
+    Return:
+        vecs : The label as a vector of MAX_LABEL_LENGTH class indices.
+    '''
 
     # Convert the label into characters
     chars = tf.strings.unicode_split(label, input_encoding='UTF-8')
@@ -352,24 +429,80 @@ def encode_single_sample(image_path : str, label : str):
     pad_size = MAX_LABEL_LENGTH - tf.shape(vecs)[0]
     vecs = tf.pad(vecs, paddings = [[0, pad_size]], constant_values=n_classes+1)
 
-    return {'image':image, 'label':vecs}
+    return vecs
+
+# Preprocessed images are stored once as uint8 and reused by every split, epoch and model.
+image_cache = ImageCache(
+    IMAGE_CACHE_DIR, img_height = IMG_HEIGHT, img_width = IMG_WIDTH, channels = 1,
+    max_bytes = IMAGE_CACHE_MAX_BYTES
+)
+
+def build_dataset(csv : pd.DataFrame, shuffle : bool = False, augmenter : BatchAugmenter = None):
+
+    '''
+    Builds the batched dataset of a split. The labels of the whole split are encoded once into a padded
+    integer array that the dataset slices, so no string is processed while training. With
+    USE_IMAGE_CACHE the images come from the preprocessed image cache, so they are only decoded the
+    first time they are seen; otherwise the images are only decoded per sample, and resized and
+    normalized a whole batch at a time. The augmenter, if any, runs on whole batches too.
+
+    Arguments :
+        csv       : The split's data frame, with full paths in FILENAME.
+        shuffle   : Whether to shuffle the samples.
+        augmenter : The batched augmentations, for the training split.
+
+    Return:
+        dataset : The batched and prefetched dataset.
+    '''
+
+    # Same indices as encode_label, for every label at once
+    labels, _ = vocabulary.encode(csv['IDENTITY'], MAX_LABEL_LENGTH, padding=n_classes+1)
+
+    if not USE_IMAGE_CACHE:
+        return batched_dataset(
+            csv['FILENAME'], labels, BATCH_SIZE, augmenter=augmenter, shuffle=shuffle,
+            img_height=IMG_HEIGHT, img_width=IMG_WIDTH
+        )
+
+    images = image_cache.dataset(csv['FILENAME'].to_list())
+    dataset = tf.data.Dataset.zip((images, tf.data.Dataset.from_tensor_slices(labels)))
+    if shuffle:
+        dataset = dataset.shuffle(1000)
+    dataset = dataset.map(
+        lambda image, label: {'image':image, 'label':label},
+        num_parallel_calls=AUTOTUNE
+    ).batch(BATCH_SIZE)
+
+    if augmenter is not None:
+        dataset = augment_dataset(dataset, augmenter)
+
+    return dataset.prefetch(AUTOTUNE)
 
 """Now it's time to apply these functions and get our data."""
 
 # Training Data
-train_ds = tf.data.Dataset.from_tensor_slices(
-    (np.array(train_csv['FILENAME'].to_list()), np.array(train_csv['IDENTITY'].to_list()))
-).shuffle(1000).map(encode_single_sample, num_parallel_calls=AUTOTUNE).batch(BATCH_SIZE).prefetch(AUTOTUNE)
+train_augmenter = BatchAugmenter(seed=AUGMENTATION_SEED) if USE_AUGMENTATION else None
+if USE_RECORD_SHARDS:
+    # Pack the whole training split once, labels encoded, then stream it back from a few hundred large shards
+    records.pack_shards(
+        train_csv_path, train_image_dir, SHARD_DIR, prefix='train',
+        vocabulary=vocabulary, max_label_length=MAX_LABEL_LENGTH, padding=n_classes+1
+    )
+    train_ds = records.read_shards(
+        records.shard_pattern(SHARD_DIR, 'train'), seed=2569, max_label_length=MAX_LABEL_LENGTH
+    ).apply(tfd.experimental.assert_cardinality(len(train_csv))
+    ).map(encode_packed_record, num_parallel_calls=AUTOTUNE).batch(BATCH_SIZE)
+    if train_augmenter is not None:
+        train_ds = augment_dataset(train_ds, train_augmenter)
+    train_ds = train_ds.prefetch(AUTOTUNE)
+else:
+    train_ds = build_dataset(train_csv, shuffle=True, augmenter=train_augmenter)
 
 # Validation data
-valid_ds = tf.data.Dataset.from_tensor_slices(
-    (np.array(valid_csv['FILENAME'].to_list()), np.array(valid_csv['IDENTITY'].to_list()))
-).map(encode_single_sample, num_parallel_calls=AUTOTUNE).batch(BATCH_SIZE).prefetch(AUTOTUNE)
+valid_ds = build_dataset(valid_csv)
 
 # Testing data.
-test_ds = tf.data.Dataset.from_tensor_slices(
-    (np.array(test_csv['FILENAME'].to_list()), np.array(test_csv['IDENTITY'].to_list()))
-).map(encode_single_sample, num_parallel_calls=AUTOTUNE).batch(BATCH_SIZE).prefetch(AUTOTUNE)
+test_ds = build_dataset(test_csv)
 
 """Let's have a look at the **data distribution**."""
 
@@ -448,26 +581,7 @@ The **CTC loss** is calculated by **summing over all possible alignments** betwe
 In summary, the **CTC loss** is used in ***sequence-to-sequence tasks*** to align the **predicted sequence and the ground truth label** by adding ***blank characters*** between the characters of the predicted sequence. The **CTC loss** is calculated by **dynamic programming**, and its goal is to ***minimize the difference between the predicted sequence and the ground truth label***.
 """
 
-class CTCLayer(layers.Layer):
-
-    def __init__(self, **kwargs) -> None:
-        super().__init__(**kwargs)
-
-        self.loss_fn = keras.backend.ctc_batch_cost
-
-    def call(self, y_true, y_pred):
-
-        batch_len = tf.cast(tf.shape(y_true)[0], dtype='int64')
-
-        input_len = tf.cast(tf.shape(y_pred)[1], dtype='int64') * tf.ones(shape=(batch_len, 1), dtype='int64')
-        label_len = tf.cast(tf.shape(y_true)[1], dtype='int64') * tf.ones(shape=(batch_len, 1), dtype='int64')
-
-        loss = self.loss_fn(y_true, y_pred, input_len, label_len)
-
-        self.add_loss(loss)
-
-        return y_pred
-
+# The CTC layer is the package's CTCLayer, which is also what the saved checkpoints are loaded with
 """# **OCR Model**
 
 The ***optical character recognition (OCR)*** model is a powerful combination of ***convolutional neural networks (CNNs)*** and ***recurrent neural networks (RNNs)***. The **CNNs** are used to extract **high-level features** from the input images, while the ***RNNs*** are used to **generate the corresponding text output**.
@@ -518,10 +632,10 @@ x = layers.Bidirectional(layers.LSTM(128, return_sequences=True, dropout=0.25))(
 x = layers.Bidirectional(layers.LSTM(64, return_sequences=True, dropout=0.25))(x)
 
 # Output Layer
-output = layers.Dense(len(char_to_num.get_vocabulary())+1, activation='softmax')(x)
+output = layers.Dense(len(char_to_num.get_vocabulary())+1, activation='softmax', dtype='float32')(x)
 
 # CTC Layer
-ctc_layer = CTCLayer()(target_labels, output)
+ctc_layer = CTCLayer(xla=TRAINING_CONFIG['xla'], dtype='float32')(target_labels, output)
 
 # Model
 ocr_model = keras.Model(
@@ -543,14 +657,18 @@ tf.keras.utils.plot_model(ocr_model)
 """Our model architecture is ready. It's time to train the model."""
 
 # Compile
-ocr_model.compile(optimizer='adam')
+ocr_model.compile(optimizer='adam', jit_compile=TRAINING_CONFIG['jit_compile'])
 
-# Train
-history = ocr_model.fit(
+# Train, resuming from the last checkpoint if the previous run was preempted
+history = fit_resumable(
+    ocr_model,
     train_ds,
-    validation_data=valid_ds,
     epochs=EPOCHS,
-    callbacks=CALLBACKS
+    checkpoint_dir=CHECKPOINT_DIR,
+    validation_data=valid_ds,
+    callbacks=CALLBACKS,
+    save_steps=CHECKPOINT_STEPS,
+    **({'augmenter': train_augmenter.generator} if train_augmenter is not None else {})
 )
 
 pd.DataFrame(history.history).plot(figsize=(8,5))
@@ -600,51 +718,78 @@ The **predictions generated** by the **OCR model** are in the form of a **matrix
 The resulting **matrix** can be **quite complex** and may be **difficult to interpret at first glance**. However, if you have studied the ***Connectionist Temporal Classification (CTC)*** algorithm, this representation will be **easier to understand**. The **CTC algorithm** is a technique used to train the model to make predictions on sequences of variable length, which is often used in **speech and handwriting recognition tasks**.
 """
 
-def decode_pred(pred_label):
+# Batched greedy CTC decoder, with the num_to_char mapping precomputed as a character table
+greedy_decoder = GreedyDecoder(char_to_num.get_vocabulary(), max_length=MAX_LABEL_LENGTH)
+
+def decode_pred(pred_label, return_confidence : bool = False):
 
     '''
     The decode_pred function is used to decode the predicted labels generated by the OCR model.
     It takes a matrix of predicted labels as input, where each time step represents the probability
-    for each character. The function uses CTC decoding to decode the numeric labels back into their
-    character values. The function also removes any unknown tokens and returns the decoded texts as a
-    list of strings. The function utilizes the num_to_char function to map numeric values back to their
-    corresponding characters. Overall, the function is an essential step in the OCR process, as it allows
+    for each character. The function uses greedy CTC decoding, vectorized over the whole batch in NumPy,
+    to decode the numeric labels back into their character values through a precomputed character table
+    (the same mapping as num_to_char). The function also removes any unknown tokens and returns the decoded
+    texts as a list of strings. Overall, the function is an essential step in the OCR process, as it allows
     us to obtain the final text output from the model's predictions.
 
-    Argument :
-        pred_label : These are the model predictions which are needed to be decoded.
+    Arguments :
+        pred_label        : These are the model predictions which are needed to be decoded.
+        return_confidence : Whether to also return the confidence of every prediction, the probability
+                            of its best path.
 
     Return:
-        filtered_text : This is the list of all the decoded and processed predictions.
+        filtered_text : This is the list of all the decoded and processed predictions, with the array of
+                        their confidences when return_confidence is set.
 
     '''
 
-    # Input length
-    input_len = np.ones(shape=pred_label.shape[0]) * pred_label.shape[1]
+    if return_confidence:
+        return greedy_decoder.decode_with_confidence(pred_label)
 
-    # CTC decode
-    decode = keras.backend.ctc_decode(pred_label, input_length=input_len, greedy=True)[0][0][:,:MAX_LABEL_LENGTH]
+    # Best path, collapse repeats, drop blanks, look up characters and remove the unknown token
+    filtered_texts = greedy_decoder(pred_label)
 
-    # Converting numerics back to their character values
-    chars = num_to_char(decode)
+    return filtered_texts
 
-    # Join all the characters
-    texts = [tf.strings.reduce_join(inputs=char).numpy().decode('UTF-8') for char in chars]
+# Predictions are stored by model weights and image, so evaluating or plotting the same images again
+# with the same weights, here or after a restart, does not run the model again
+prediction_cache = PredictionCache(PREDICTION_CACHE_DIR, max_bytes=PREDICTION_CACHE_MAX_BYTES)
+cached_inference_model = CachedModel(inference_model, prediction_cache, greedy_decoder)
 
-    # Remove the unknown token
-    filtered_texts = [text.replace('[UNK]', " ").strip() for text in texts]
+"""Let's see this function working. Rather than predicting the whole test set at once, the model is evaluated **batch by batch**: every batch is decoded as soon as it is predicted and scored against its true label, so memory stays constant even over the **complete test and validation sets**."""
 
-    return filtered_texts
+def evaluate_split(model, csv_path : str, image_dir : str):
 
-"""Let's see this function working."""
+    '''
+    Evaluates a model on every image of a split, streaming the predictions through decode_pred.
+
+    Arguments :
+        model     : The inference model.
+        csv_path  : The split's CSV file.
+        image_dir : The split's image directory.
+
+    Return:
+        report : The CER, WER and exact match of the model, overall and per label length.
+    '''
 
-print(decode_pred(inference_model.predict(test_ds)))
+    csv = pd.read_csv(csv_path)
+    dataset = build_eval_dataset(
+        [image_dir + f"/{filename}" for filename in csv['FILENAME']],
+        csv['IDENTITY'].to_numpy(),
+        batch_size=BATCH_SIZE * 16,
+        img_height=IMG_HEIGHT,
+        img_width=IMG_WIDTH
+    )
+    return evaluate(CachedModel(model, prediction_cache, greedy_decoder), dataset, decode_pred)
+
+print(format_report(evaluate_split(inference_model, test_csv_path, test_image_dir)))
+print(format_report(evaluate_split(inference_model, valid_csv_path, valid_image_dir)))
 
 """This function seems to **work perfectly fine** for **decoding the predicted labels**, but to gain better **insight and understanding**, it would be beneficial to have a **visual representation** of the **model's predictions**."""
 
-show_images(data=test_ds, model=inference_model, decode_pred=decode_pred, cmap='binary')
+show_images(data=test_ds, model=cached_inference_model, decode_pred=decode_pred, cmap='binary')
 
-show_images(data=valid_ds, model=inference_model, decode_pred=decode_pred, cmap='binary')
+show_images(data=valid_ds, model=cached_inference_model, decode_pred=decode_pred, cmap='binary')
 
 """Upon inspection, **most of the predictions were correct** except for a **few cases where mistakes were made**. These cases include:
 
@@ -654,7 +799,41 @@ show_images(data=valid_ds, model=inference_model, decode_pred=decode_pred, cmap=
 
 In a few other cases, the model appears to be **confused** between **D&B and G&B**, indicating that the **model thinks everything is a B** if it has a **curve on the right side**. However, for cases where the **writing is clearly visible**, **all predictions were accurate**. Further **fine-tuning** of the model could improve its performance in situations where the **handwritten text is not properly illuminated or the writings are not clearly visible or are erased**.
 
-# **OCR Model - Improved**
+**Beam Search Decoding**
+
+---
+
+Greedy decoding keeps only the **single most likely character** at every time step, so a faded stroke is enough to lose a letter. A ***prefix beam search*** keeps the **BEAM_WIDTH most likely prefixes** instead, and restricting it to a **lexicon of the training names** stops it from producing strings that are not names at all. Confident predictions are still decoded greedily, so the extra cost is only paid on the hard images.
+"""
+
+# Lexicon of every name in the training split
+lexicon = [str(word) for word in pd.read_csv(train_csv_path)['IDENTITY'].to_numpy()]
+
+# Prefix beam search decoder, constrained to the lexicon
+beam_decoder = BeamSearchDecoder(
+    char_to_num.get_vocabulary(),
+    max_length=MAX_LABEL_LENGTH,
+    beam_width=BEAM_WIDTH,
+    lexicon=lexicon
+)
+
+def decode_pred_beam(pred_label):
+
+    '''
+    Same as decode_pred, but decodes with the lexicon constrained prefix beam search.
+
+    Argument :
+        pred_label : These are the model predictions which are needed to be decoded.
+
+    Return:
+        texts : This is the list of all the decoded predictions.
+    '''
+
+    return beam_decoder(pred_label)
+
+show_images(data=test_ds, model=cached_inference_model, decode_pred=decode_pred_beam, cmap='binary')
+
+"""# **OCR Model - Improved**
 
 Let's try to change the model architecture,
 """
@@ -717,10 +896,10 @@ x = layers.Bidirectional(layers.LSTM(256, return_sequences=True, dropout=0.25))(
 x = layers.Bidirectional(layers.LSTM(128, return_sequences=True, dropout=0.25))(x)
 
 # Output Layer
-output = layers.Dense(len(char_to_num.get_vocabulary())+1, activation='softmax')(x)
+output = layers.Dense(len(char_to_num.get_vocabulary())+1, activation='softmax', dtype='float32')(x)
 
 # CTC Layer
-ctc_layer = CTCLayer()(target_labels, output)
+ctc_layer = CTCLayer(xla=TRAINING_CONFIG['xla'], dtype='float32')(target_labels, output)
 
 # Model
 ocr_model_2 = keras.Model(
@@ -729,7 +908,9 @@ ocr_model_2 = keras.Model(
 )
 
 # Compile
-ocr_model_2.compile(optimizer=keras.optimizers.Adam(learning_rate=1e-3))
+ocr_model_2.compile(
+    optimizer=keras.optimizers.Adam(learning_rate=1e-3), jit_compile=TRAINING_CONFIG['jit_compile']
+)
 
 # Train
 history_2 = ocr_model_2.fit(
@@ -737,7 +918,8 @@ history_2 = ocr_model_2.fit(
     validation_data=valid_ds,
     epochs=EPOCHS,
     callbacks=[
-        callbacks.EarlyStopping(patience=5, restore_best_weights=True)
+        callbacks.EarlyStopping(patience=5, restore_best_weights=True),
+        ThroughputLogger(BATCH_SIZE, name=TRAINING_MODE)
     ]
 )
 
@@ -760,9 +942,122 @@ inference_model_2 = keras.Model(
 # Model summary
 inference_model_2.summary()
 
-show_images(data=test_ds, model=inference_model_2, decode_pred=decode_pred, cmap='binary')
+# Its predictions, served from the prediction cache when already made
+cached_inference_model_2 = CachedModel(inference_model_2, prediction_cache, greedy_decoder)
+
+"""**Quantized Export**
+
+---
+
+On **CPU-only machines** the full float32 model is heavier than it needs to be. ***Post-training quantization*** stores the weights as **int8** (dynamic range), and optionally the activations too (full integer, calibrated on **validation images**). Let's export both and compare **size, latency and CER** against the float model.
+"""
+
+# Dynamic range quantization : int8 weights, float activations
+# One artifact per timed batch size : the converted graph cannot be resized
+export_tflite(
+    inference_model_2, MODEL_NAME + "-dynamic.tflite", mode='dynamic', batch_size=BATCH_SIZE, extra_batch_sizes=(1,)
+)
+quantized_models = {
+    'float32': inference_model_2,
+    'dynamic': TFLiteRunner(MODEL_NAME + "-dynamic.tflite")
+}
+
+# Full integer quantization, calibrated on validation images
+try:
+    export_tflite(
+        inference_model_2, MODEL_NAME + "-int8.tflite", mode='int8',
+        calibration=calibration_images(valid_ds, n_samples=512), batch_size=BATCH_SIZE, extra_batch_sizes=(1,)
+    )
+    quantized_models['int8'] = TFLiteRunner(MODEL_NAME + "-int8.tflite")
+except RuntimeError as error:
+    print(error)
+
+# Size, latency and CER on the validation images
+comparison = compare_models(
+    quantized_models,
+    build_eval_dataset(valid_csv['FILENAME'], valid_csv['IDENTITY'], batch_size=BATCH_SIZE),
+    decode_pred,
+    batch_sizes=(1, BATCH_SIZE)
+)
+print(format_comparison(comparison))
+
+"""**End-to-End Export**
+
+---
+
+Serving the model from Python means **decoding** the images, running **predict**, then the **CTC decoding** and the **character lookup**, each with its own round trip. Let's export a ***SavedModel*** whose single signature takes the **raw JPEG bytes** of a batch and returns the **decoded strings** and their **confidences**, with every step inside one graph.
+"""
+
+# Raw JPEG bytes in, strings and confidences out
+export_saved_model(inference_model_2, vocabulary, MODEL_NAME + "-serving", max_length=MAX_LABEL_LENGTH)
+exported_model = ExportedOCR(MODEL_NAME + "-serving")
+
+texts, confidences = exported_model.predict_files(test_csv['FILENAME'][:16])
+pd.DataFrame({'IDENTITY': test_csv['IDENTITY'][:16], 'PREDICTION': texts, 'CONFIDENCE': confidences})
+
+"""**Batch Transcription**
+
+---
+
+New scans come by the **million**. The ***batch*** job shards a directory, glob or manifest across a **process pool**, each worker holding its own copy of the model on its share of the cores, and writes the results **in input order** as it goes. A **corrupt JPEG** gets an error line instead of stopping the job, and running it again **skips** the images already transcribed.
+"""
+
+# The whole test directory, with the best checkpoint; rerunning resumes where it stopped
+batch_report = run_batch(
+    MODEL_NAME + ".keras", test_image_dir, MODEL_NAME + "-test.jsonl", cache_dir=PREDICTION_CACHE_DIR
+)
+batch_report
+
+"""**Distilled Student**
+
+---
+
+The improved model is accurate, but expensive per image on CPU. Let's **distill** it into a much smaller ***student*** : thinner, **depthwise separable** convolutions and a single small **bidirectional GRU**, picked as the largest candidate that fits the **latency budget**. The student learns from the **CTC loss** and from the teacher's **per-timestep softmax outputs**, which tell it how confusable the characters are. Then we compare **CER against latency** for both models.
+"""
+
+student_name, student_model, student_inference_model, student_history = distill(
+    inference_model_2,
+    len(char_to_num.get_vocabulary())+1,
+    train_ds,
+    latency_budget_ms=STUDENT_LATENCY_BUDGET_MS,
+    validation_data=valid_ds,
+    epochs=EPOCHS,
+    learning_rate=LEARNING_RATE,
+    img_height=IMG_HEIGHT,
+    img_width=IMG_WIDTH
+)
+
+student_report = latency_report(
+    {'teacher': inference_model_2, student_name: student_inference_model},
+    build_eval_dataset(valid_csv['FILENAME'], valid_csv['IDENTITY'], batch_size=BATCH_SIZE),
+    decode_pred,
+    latency_budget_ms=STUDENT_LATENCY_BUDGET_MS
+)
+print(format_latency_report(student_report))
+
+"""**Confidence-Gated Cascade**
+
+---
+
+We now have a **cheap** model and an **accurate** one, but most names are written cleanly and the cheap model already reads them right. In a ***cascade***, the small model reads **every** image, and only the predictions whose **confidence** (the probability of the best path) is below a **threshold** are read again by the large model. The threshold trades **throughput** against **CER**, so let's score a range of them on the validation set.
+"""
+
+cascade_results = cascade_report(
+    inference_model,
+    inference_model_2,
+    build_eval_dataset(valid_csv['FILENAME'], valid_csv['IDENTITY'], batch_size=BATCH_SIZE * 16),
+    greedy_decoder
+)
+print(format_cascade_report(cascade_results))
 
-show_images(data=valid_ds, model=inference_model_2, decode_pred=decode_pred, cmap='binary')
+# The cascade at a chosen threshold, on a few test images
+cascade = CascadeOCR(inference_model, inference_model_2, greedy_decoder, threshold=CASCADE_THRESHOLD)
+texts, confidences, escalated = cascade(next(iter(test_ds))['image'])
+pd.DataFrame({'PREDICTION': texts, 'CONFIDENCE': confidences, 'ESCALATED': escalated})
+
+show_images(data=test_ds, model=cached_inference_model_2, decode_pred=decode_pred, cmap='binary')
+
+show_images(data=valid_ds, model=cached_inference_model_2, decode_pred=decode_pred, cmap='binary')
 
 """Certainly, I can provide a **clearer explanation** of the **two main points** behind the **new model's improvement**:
 
@@ -772,6 +1067,167 @@ show_images(data=valid_ds, model=inference_model_2, decode_pred=decode_pred, cma
 
 Overall, these **two main improvements work** together to create a **more accurate and effective model** for **character recognition**. By improving both the **feature extraction process** and the **embedding space** used by the **RNN path**, the model is better able to **recognize and differentiate between different characters**, resulting in **more accurate predictions**.
 
+# **Aspect Preserving Width Buckets**
+
+Resizing every image to **200x50** stretches short names over all **50 time steps** and squashes long ones. Instead, we can resize to the **fixed height only**, keeping the **aspect ratio**, and group the samples into **width buckets** so that a batch is only padded to its widest image. The model then accepts **variable widths**, and the **CTC loss** uses each image's own number of time steps. Let's train one epoch of the first architecture with both pipelines and compare.
+"""
+
+# Labels encoded once, with their lengths for the variable width CTC loss
+train_label_ids, train_label_lengths = vocabulary.encode(train_csv['IDENTITY'], MAX_LABEL_LENGTH, padding=n_classes+1)
+
+# Fixed size pipeline, decoding every image (no image cache) so both pipelines do the same work
+fixed_train_ds = tf.data.Dataset.from_tensor_slices(
+    (np.array(train_csv['FILENAME'].to_list()), train_label_ids)
+).shuffle(1000).map(
+    lambda image_path, label: {'image':load_image(image_path), 'label':label}, num_parallel_calls=AUTOTUNE
+).batch(BATCH_SIZE).prefetch(AUTOTUNE)
+
+# Width bucketed pipeline
+bucketed_train_ds = bucketed_dataset(
+    train_csv['FILENAME'], train_label_ids, None, BATCH_SIZE, label_lengths=train_label_lengths,
+    shuffle=True, img_height=IMG_HEIGHT, label_padding=n_classes+1
+)
+
+# Same architecture, fixed and variable width
+fixed_model, _ = build_ocr_model(
+    len(char_to_num.get_vocabulary())+1, img_height=IMG_HEIGHT, img_width=IMG_WIDTH, **ARCHITECTURES['small']
+)
+bucketed_model, bucketed_inference_model = build_ocr_model(
+    len(char_to_num.get_vocabulary())+1, img_height=IMG_HEIGHT, img_width=None, **ARCHITECTURES['small']
+)
+fixed_model.compile(optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE))
+bucketed_model.compile(optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE))
+
+# Side by side
+pd.DataFrame({
+    'fixed' : benchmark_fit(fixed_model, fixed_train_ds),
+    'bucketed' : benchmark_fit(bucketed_model, bucketed_train_ds),
+})
+
+"""# **Training Modes**
+
+Our training runs are **CPU bound**, so any speedup the runtime gives for free is welcome. **XLA** compiles the whole training step into fused kernels, and **mixed precision** computes in **bfloat16** on CPUs with native support (**AVX512-BF16 / AMX**) while keeping the weights, the softmax output and the **CTC loss** in **float32**. The **TRAINING_MODE** constant selects the mode of the models above; here the first architecture is trained in every mode on the same batches and the **samples per second** of the last epoch are compared (the first one includes compilation).
+"""
+
+def build_mode_model(xla):
+    model, _ = build_ocr_model(
+        len(char_to_num.get_vocabulary())+1, img_height=IMG_HEIGHT, img_width=IMG_WIDTH, xla=xla, **ARCHITECTURES['small']
+    )
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE), jit_compile=xla)
+    return model
+
+mode_report = compare_training_modes(build_mode_model, train_ds.take(200), BATCH_SIZE, epochs=2)
+pd.DataFrame(mode_report).T
+
+"""**Large-Batch Training**
+
 ---
+
+With **16 images per step**, a step is dominated by **per-step overhead** rather than arithmetic. In **large-batch mode**, the dataset yields **micro batches** as large as memory allows, and the gradients of several micro batches are **accumulated** into one update of **LARGE_BATCH_SIZE** images. The learning rate is **scaled** with the batch size, **warmed up** over the first epoch and then follows a **cosine decay**. Let's compare the **wall-clock time** both settings need to reach the same **validation CTC loss**.
+"""
+
+# The training split again, in micro batches
+large_train_ds = train_ds.unbatch().batch(MICRO_BATCH_SIZE).prefetch(AUTOTUNE)
+micro_steps_per_epoch = math.ceil(len(train_csv) / MICRO_BATCH_SIZE)
+
+def build_small_model():
+    model, _ = build_ocr_model(
+        len(char_to_num.get_vocabulary())+1, img_height=IMG_HEIGHT, img_width=IMG_WIDTH, **ARCHITECTURES['small']
+    )
+    return model
+
+target_report = time_to_target(
+    build_small_model,
+    {
+        'current': {'dataset': train_ds, 'optimizer': keras.optimizers.Adam(learning_rate=LEARNING_RATE), 'batch_size': BATCH_SIZE},
+        'large_batch': {
+            'dataset': large_train_ds,
+            'optimizer': large_batch_optimizer(
+                LARGE_BATCH_SIZE, MICRO_BATCH_SIZE, micro_steps_per_epoch, epochs=EPOCHS,
+                base_learning_rate=LEARNING_RATE, base_batch_size=BATCH_SIZE
+            ),
+            'batch_size': LARGE_BATCH_SIZE,
+            'micro_batch_size': MICRO_BATCH_SIZE,
+        },
+    },
+    valid_ds,
+    target_loss=TARGET_VAL_LOSS,
+    max_epochs=EPOCHS
+)
+print(format_time_to_target(target_report))
+
+"""# **Multi-Worker Training**
+
+A single process leaves most cores of a large machine idle, because the small **BiLSTM** steps do not scale with more threads per op. Instead, we can run several **worker processes** under a **multi-worker strategy**: each worker reads its **own shard** of the training CSV and the gradients are **all-reduced** after every step. The workers can also run on other hosts. The chief saves a regular **.keras** checkpoint with the same layers as **ocr_model**, and here the workers continue from **Handwritten-OCR.keras**. Let's see how the throughput scales as workers are added.
+"""
+
+distributed_job = training_job(
+    train_csv_path, train_image_dir, char_to_num.get_vocabulary(), MAX_LABEL_LENGTH,
+    checkpoint=MODEL_NAME + '-distributed.keras', batch_size=BATCH_SIZE, epochs=2,
+    learning_rate=LEARNING_RATE, train_size=TRAIN_SIZE, initial_checkpoint=MODEL_NAME + '.keras'
+)
+scaling = scaling_report(distributed_job, worker_counts=(1, 2, 4))
+print(format_scaling(scaling))
+
+"""# **Input Pipeline Profile**
+
+A faster model only helps if the **input pipeline** keeps up with it. Let's rebuild the training pipeline with probes that time **every preprocessing stage** and count the elements going through it. Before every step, the monitor checks how many batches wait in the **prefetch buffer**. If the buffer is **empty** at most steps, the model waits for data and the epoch is **input bound**, so the pipeline is the place to optimize (image cache, record shards, more parallel calls). Otherwise it is **compute bound**. The epochs are saved as **JSON** and **TensorBoard** scalars, and a few steps are captured as a **profiler trace**.
+"""
+
+pipeline_stats = PipelineStats()
+profiled_train_ds = instrumented_dataset(
+    train_csv['FILENAME'], train_label_ids, BATCH_SIZE, pipeline_stats,
+    notebook_stages(img_height=IMG_HEIGHT, img_width=IMG_WIDTH)
+)
+pipeline_monitor = PipelineMonitor(
+    pipeline_stats, json_path=MODEL_NAME + '-pipeline.json', tensorboard_dir='logs/pipeline',
+    batch_size=BATCH_SIZE, profile_steps=(20, 25)
+)
+
+profiled_model, _ = build_ocr_model(
+    len(char_to_num.get_vocabulary())+1, img_height=IMG_HEIGHT, img_width=IMG_WIDTH, **ARCHITECTURES['small']
+)
+profiled_model.compile(optimizer=keras.optimizers.Adam(learning_rate=LEARNING_RATE))
+profiled_model.fit(profiled_train_ds, epochs=2, callbacks=[pipeline_monitor])
+
+pd.DataFrame(pipeline_monitor.history).set_index('epoch').drop(columns='stage_latency_ms')
+
+pd.DataFrame({report['epoch'] : report['stage_latency_ms'] for report in pipeline_monitor.history})
+
+"""# **Architecture Sweep**
+
+Above, **ocr_model** and **ocr_model_2** each re-read and re-decode the whole data set, for every epoch. To compare more variants, we decode both splits **once** into arrays that every trial **memory-maps**, and train the trials **concurrently** in a pool of processes, each with the **same budget** of training steps. Every few hundred steps each trial measures its **validation CER**; a trial doing worse than the **median** of the trials that reached the same step is **stopped early**, freeing its process for the next one. The result is a **leaderboard** by CER.
+"""
+
+sweep_data = prepare_data(
+    'sweep', train_csv['FILENAME'], train_csv['IDENTITY'], valid_csv['FILENAME'], valid_csv['IDENTITY'],
+    vocabulary, MAX_LABEL_LENGTH, img_height=IMG_HEIGHT, img_width=IMG_WIDTH
+)
+sweep_trials = [
+    trial('small', learning_rate=LEARNING_RATE),
+    trial('large', learning_rate=LEARNING_RATE),
+    trial('small', learning_rate=3e-3),
+    trial('small', learning_rate=LEARNING_RATE, lstm_units=(256, 128)),
+    trial('small', learning_rate=LEARNING_RATE, dense_units=(64, 128)),
+    trial('large', learning_rate=LEARNING_RATE, dropout=0.2),
+]
+leaderboard = run_sweep(
+    sweep_trials, sweep_data, steps=2000, eval_every=250, batch_size=BATCH_SIZE, output_dir='sweep/models'
+)
+print(format_leaderboard(leaderboard))
+
+"""# **Parallel Sequence Encoders**
+
+The **BiLSTMs** read the **50 time steps** strictly one after the other, so extra cores do not make them faster. The sequence encoder can instead be a stack of **dilated 1D convolutions** or **self-attention** blocks with a **positional encoding**, which process every time step **at once**, behind the same CNN front end and CTC head. Let's size each encoder to the **parameter count** of the first architecture and compare **training and inference throughput** and **CER** on the sweep data.
+"""
+
+# No early stopping : with min_peers as large as the sweep, every encoder trains its whole budget
+encoder_leaderboard = run_sweep(
+    encoder_trials(len(char_to_num.get_vocabulary())+1, 'small', learning_rate=LEARNING_RATE),
+    sweep_data, steps=2000, eval_every=250, batch_size=BATCH_SIZE, min_peers=len(ENCODERS)
+)
+print(format_leaderboard(encoder_leaderboard))
+
+"""---
 **DeepNets**
 """
@@ -0,0 +1,40 @@
+'''
+Helpers for the Handwritten OCR notebook.
+
+The notebook (Handwritten_OCR.py) stays the main entry point; the modules in this package hold the
+pieces that are worth importing on their own, such as the dataset fetch stage. ``python -m
+handwritten_ocr`` runs them from the command line (see ``cli``).
+
+Importing the package is cheap : the names below are only imported, with TensorFlow and the rest,
+the first time they are used, e.g. ``handwritten_ocr.GreedyDecoder``.
+'''
+
+import importlib
+
+# Public name -> module defining it
+_LAZY_NAMES = {
+    'ARCHITECTURES': 'models',
+    'CTCLayer': 'models',
+    'build_ocr_model': 'models',
+    'load_inference_model': 'models',
+    'GreedyDecoder': 'decoding',
+    'BeamSearchDecoder': 'decoding',
+    'Vocabulary': 'vocabulary',
+    'decode_image': 'preprocessing',
+    'evaluate': 'evaluation',
+    'fetch_data_sources': 'fetch',
+}
+
+__all__ = sorted(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'{__name__}.{_LAZY_NAMES[name]}'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
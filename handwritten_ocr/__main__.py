@@ -0,0 +1,3 @@
+from handwritten_ocr.cli import main
+
+main()
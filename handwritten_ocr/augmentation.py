@@ -0,0 +1,326 @@
+'''
+Batched preprocessing and augmentation, applied after ``batch()``.
+
+The per-sample ``.map(encode_single_sample)`` runs the whole decode, convert, resize and transpose
+chain once per image. Here the per-sample map only reads and decodes the JPEG. The decoded images are
+padded into a batch with their true shapes, and everything else runs once per batch :
+``preprocess_batch`` resizes all the images of the batch with a single ``crop_and_resize`` (the same
+values as ``tf.image.resize`` on every image), scales them to [0, 1] and transposes them to the model
+layout.
+
+``BatchAugmenter`` adds augmentations aimed at the errors seen in the notebook (faded, erased and
+poorly lit writing) to the same batched step :
+
+* slight shear and elastic distortion, folded into the sampling grid of the resize (a bilinear
+  gather then replaces ``crop_and_resize``), so the geometry costs no extra pass over the pixels;
+* brightness and contrast jitter;
+* random erase of a rectangle, filled with the background level.
+
+Every random draw is per sample and vectorized across the batch. Seeds are drawn from a
+``tf.random.Generator`` in a small sequential map, and the heavy map only uses stateless ops, so a
+seeded augmenter gives the same batches on every run while the batches are still augmented in
+parallel.
+
+    augmenter = BatchAugmenter(seed=2569)
+    train_ds = batched_dataset(paths, label_ids, BATCH_SIZE, augmenter=augmenter, shuffle=True)
+    valid_ds = batched_dataset(valid_paths, valid_label_ids, BATCH_SIZE)
+'''
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH
+
+
+def read_image(path):
+    '''
+    Reads and decodes one image for ``preprocess_batch``. The image gets a one pixel border repeating
+    its edges, so that sampling just outside it gives the edge values, as ``tf.image.resize`` does.
+
+    Argument :
+        path : The image file path.
+
+    Returns:
+        image : The uint8 image of shape (height + 2, width + 2, 1).
+        shape : Its true (height, width).
+    '''
+
+    image = tf.image.decode_jpeg(tf.io.read_file(path), channels=1)
+    return tf.pad(image, [[1, 1], [1, 1], [0, 0]], mode='SYMMETRIC'), tf.shape(image)[:2]
+
+
+def _resize(images, shapes, img_height : int, img_width : int):
+    '''
+    Resizes every image of a padded batch from its own shape, with the half pixel centres of
+    ``tf.image.resize``, through one ``crop_and_resize``.
+    '''
+
+    padded = tf.cast(tf.shape(images)[1:3], tf.float32) - 1
+    heights = tf.cast(shapes[:, 0], tf.float32)
+    widths = tf.cast(shapes[:, 1], tf.float32)
+
+    # Boxes whose sampling points are (i + 0.5) * scale - 0.5, shifted by the border
+    top = (0.5 * heights / img_height + 0.5) / padded[0]
+    left = (0.5 * widths / img_width + 0.5) / padded[1]
+    bottom = top + heights / img_height * (img_height - 1) / padded[0]
+    right = left + widths / img_width * (img_width - 1) / padded[1]
+    boxes = tf.stack([top, left, bottom, right], axis=1)
+
+    return tf.image.crop_and_resize(images, boxes, tf.range(tf.shape(images)[0]), (img_height, img_width))
+
+
+def _sample_bilinear(images, shapes, rows, columns):
+    '''
+    Samples the images of a padded batch at fractional coordinates, clamped to each image's extent.
+
+    Arguments :
+        images  : A batch of shape (batch, max height + 2, max width + 2, 1), see ``read_image``.
+        shapes  : The true (height, width) of every image, of shape (batch, 2).
+        rows    : The source rows to sample, of shape (batch, height, width).
+        columns : The source columns to sample, of shape (batch, height, width).
+
+    Return:
+        images : The sampled float32 batch of shape (batch, height, width, 1), in the input's range.
+    '''
+
+    batch, max_height, max_width = tf.unstack(tf.shape(images)[:3])
+    heights = tf.cast(shapes[:, 0], tf.float32)[:, None, None]
+    widths = tf.cast(shapes[:, 1], tf.float32)[:, None, None]
+
+    # Clamped, then shifted by the border
+    rows = tf.clip_by_value(rows, 0.0, heights - 1) + 1
+    columns = tf.clip_by_value(columns, 0.0, widths - 1) + 1
+    top, left = tf.floor(rows), tf.floor(columns)
+    row_weight, column_weight = (rows - top)[..., None], (columns - left)[..., None]
+
+    flat = tf.reshape(images, [-1, 1])
+    index = tf.range(batch)[:, None, None] * max_height * max_width + tf.cast(top, tf.int32) * max_width + tf.cast(left, tf.int32)
+
+    def gather(offset):
+        return tf.cast(tf.gather(flat, index + offset), tf.float32)
+
+    top_left, top_right = gather(0), gather(1)
+    bottom_left, bottom_right = gather(max_width), gather(max_width + 1)
+    upper = top_left + (top_right - top_left) * column_weight
+    lower = bottom_left + (bottom_right - bottom_left) * column_weight
+    return upper + (lower - upper) * row_weight
+
+
+def preprocess_batch(
+    images,
+    shapes,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+    augmenter = None,
+    seed = None,
+):
+    '''
+    Resizes, normalizes and optionally augments a padded batch of decoded images, all at once.
+
+    Arguments :
+        images     : A uint8 or float32 batch of images read by ``read_image``, padded to the largest one.
+        shapes     : The true (height, width) of every image, of shape (batch, 2).
+        img_height : The height the images are resized to.
+        img_width  : The width the images are resized to.
+        augmenter  : An optional ``BatchAugmenter``.
+        seed       : The stateless seed of shape (2,) of the augmentations.
+
+    Return:
+        images : The float32 batch of shape (batch, img_width, img_height, 1), in [0, 1].
+    '''
+
+    # Scaled to [0, 1] after the resize, on the smaller output rather than on the padded batch
+    scale = 1 / 255 if images.dtype == tf.uint8 else 1.0
+    if augmenter is None:
+        return tf.transpose(_resize(images, shapes, img_height, img_width) * scale, perm=[0, 2, 1, 3])
+
+    # Output pixels, displaced by the geometric augmentations, then mapped to the source pixels with
+    # the half pixel centres of tf.image.resize
+    geometry_seed, photometric_seed = tf.unstack(tf.random.experimental.stateless_split(seed, num=2))
+    batch = tf.shape(images)[0]
+    rows = tf.broadcast_to(tf.range(img_height, dtype=tf.float32)[None, :, None], [batch, img_height, img_width])
+    columns = tf.broadcast_to(tf.range(img_width, dtype=tf.float32)[None, None, :], [batch, img_height, img_width])
+    rows, columns = augmenter.displace(rows, columns, geometry_seed)
+
+    scale_y = tf.cast(shapes[:, 0], tf.float32)[:, None, None] / img_height
+    scale_x = tf.cast(shapes[:, 1], tf.float32)[:, None, None] / img_width
+    images = _sample_bilinear(images, shapes, (rows + 0.5) * scale_y - 0.5, (columns + 0.5) * scale_x - 0.5)
+    images = augmenter.recolor(images * scale, photometric_seed)
+
+    return tf.transpose(images, perm=[0, 2, 1, 3])
+
+
+class BatchAugmenter:
+
+    '''
+    Random per-sample augmentations of whole batches.
+
+    Arguments :
+        brightness        : The maximum brightness shift, in [0, 1] intensity units.
+        contrast          : The maximum relative contrast change; factors below 1 fade the writing.
+        erase_probability : The probability that a sample has a rectangle erased.
+        erase_size        : The (min, max) size of the erased rectangle, as a fraction of each side.
+        shear             : The maximum horizontal shift per row, in pixels per pixel (slant).
+        elastic_alpha     : The standard deviation of the elastic displacement, in output pixels.
+        elastic_grid      : The (rows, columns) of the coarse displacement grid, smoothly upsampled;
+                            a coarser grid gives smoother distortions.
+        seed              : The seed of the augmentations, or None for different ones on every run.
+    '''
+
+    def __init__(
+        self,
+        brightness : float = 0.15,
+        contrast : float = 0.4,
+        erase_probability : float = 0.25,
+        erase_size = (0.1, 0.3),
+        shear : float = 0.3,
+        elastic_alpha : float = 1.0,
+        elastic_grid = (3, 10),
+        seed : int = None,
+    ) -> None:
+        self.brightness = brightness
+        self.contrast = contrast
+        self.erase_probability = erase_probability
+        self.erase_size = erase_size
+        self.shear = shear
+        self.elastic_alpha = elastic_alpha
+        self.elastic_grid = elastic_grid
+        self.seed = seed
+        if seed is None:
+            self.generator = tf.random.Generator.from_non_deterministic_state()
+        else:
+            self.generator = tf.random.Generator.from_seed(seed)
+
+    def make_seed(self):
+        '''
+        Draws the stateless seed of one batch, of shape (2,).
+        '''
+
+        return self.generator.make_seeds(1)[:, 0]
+
+    def displace(self, rows, columns, seed):
+        '''
+        Applies the shear and the elastic distortion to a sampling grid of shape (batch, height, width).
+        '''
+
+        shear_seed, elastic_seed = tf.unstack(tf.random.experimental.stateless_split(seed, num=2))
+        batch, height, width = tf.unstack(tf.shape(rows))
+
+        # Slant : every row is shifted in proportion to its distance from the middle row
+        shear = tf.random.stateless_uniform([batch, 1, 1], shear_seed, -self.shear, self.shear)
+        columns = columns + shear * (rows - tf.cast(height, tf.float32) / 2)
+
+        # Elastic : a coarse random displacement field, upsampled to a smooth one
+        field = tf.random.stateless_normal([batch, *self.elastic_grid, 2], elastic_seed) * self.elastic_alpha
+        field = tf.image.resize(field, tf.stack([height, width]), method='bicubic')
+        return rows + field[..., 0], columns + field[..., 1]
+
+    def recolor(self, images, seed):
+        '''
+        Applies the brightness and contrast jitter and the random erase to a batch of shape
+        (batch, height, width, channels) in [0, 1].
+        '''
+
+        brightness_seed, contrast_seed, erase_seed, box_seed = tf.unstack(
+            tf.random.experimental.stateless_split(seed, num=4)
+        )
+        batch, height, width = tf.unstack(tf.shape(images)[:3])
+
+        # Contrast around each image's mean, then brightness
+        mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+        factor = tf.random.stateless_uniform([batch, 1, 1, 1], contrast_seed, 1 - self.contrast, 1 + self.contrast)
+        shift = tf.random.stateless_uniform([batch, 1, 1, 1], brightness_seed, -self.brightness, self.brightness)
+        images = tf.clip_by_value((images - mean) * factor + mean + shift, 0.0, 1.0)
+
+        # Erase : a random rectangle per selected sample, filled with the background (the brightest tenth)
+        erased = tf.random.stateless_uniform([batch], erase_seed) < self.erase_probability
+        box = tf.random.stateless_uniform([batch, 4], box_seed)
+        low, high = self.erase_size
+        box_height = (low + (high - low) * box[:, 0]) * tf.cast(height, tf.float32)
+        box_width = (low + (high - low) * box[:, 1]) * tf.cast(width, tf.float32)
+        top = box[:, 2] * (tf.cast(height, tf.float32) - box_height)
+        left = box[:, 3] * (tf.cast(width, tf.float32) - box_width)
+
+        y = tf.range(height, dtype=tf.float32)[None, :, None]
+        x = tf.range(width, dtype=tf.float32)[None, None, :]
+        mask = (
+            erased[:, None, None]
+            & (y >= top[:, None, None]) & (y < (top + box_height)[:, None, None])
+            & (x >= left[:, None, None]) & (x < (left + box_width)[:, None, None])
+        )
+        flat = tf.reshape(images, [batch, -1])
+        background = tf.math.top_k(flat, k=tf.maximum(tf.shape(flat)[1] // 10, 1)).values[:, -1]
+        return tf.where(mask[..., None], background[:, None, None, None], images)
+
+    def apply(self, images, seed):
+        '''
+        Augments a batch already in the model layout (batch, img_width, img_height, 1), e.g. images read
+        from the image cache.
+        '''
+
+        images = tf.transpose(images, perm=[0, 2, 1, 3])
+        img_height, img_width = images.shape[1], images.shape[2]
+        shapes = tf.tile([[img_height, img_width]], [tf.shape(images)[0], 1])
+        images = tf.pad(images, [[0, 0], [1, 1], [1, 1], [0, 0]], mode='SYMMETRIC')
+        return preprocess_batch(images, shapes, img_height, img_width, augmenter=self, seed=seed)
+
+
+def batched_dataset(
+    paths,
+    labels,
+    batch_size : int,
+    augmenter : BatchAugmenter = None,
+    shuffle : bool = False,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Builds a dataset of {'image', 'label'} batches whose preprocessing runs after ``batch()``.
+
+    Arguments :
+        paths      : The image file paths.
+        labels     : The encoded labels, see ``Vocabulary.encode``.
+        batch_size : The batch size.
+        augmenter  : An optional ``BatchAugmenter``, for the training split.
+        shuffle    : Whether to shuffle the samples.
+        img_height : The height the images are resized to.
+        img_width  : The width the images are resized to.
+
+    Return:
+        dataset : The batched and prefetched dataset.
+    '''
+
+    dataset = tf.data.Dataset.from_tensor_slices((np.array(list(paths)), np.asarray(labels)))
+    if shuffle:
+        dataset = dataset.shuffle(1000)
+
+    # Only reading and decoding depend on the individual file
+    dataset = dataset.map(
+        lambda path, label: (*read_image(path), label), num_parallel_calls=tf.data.AUTOTUNE
+    ).padded_batch(batch_size)
+
+    if augmenter is None:
+        def preprocess(images, shapes, labels):
+            return {'image': preprocess_batch(images, shapes, img_height, img_width), 'label': labels}
+        dataset = dataset.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        def preprocess(images, shapes, labels, seed):
+            images = preprocess_batch(images, shapes, img_height, img_width, augmenter=augmenter, seed=seed)
+            return {'image': images, 'label': labels}
+        dataset = dataset.map(lambda *batch: (*batch, augmenter.make_seed()))
+        dataset = dataset.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def augment_dataset(dataset, augmenter : BatchAugmenter):
+    '''
+    Augments a dataset of {'image', 'label'} batches already in the model layout, e.g. the image cache
+    pipeline of the notebook's build_dataset.
+    '''
+
+    def augment(batch, seed):
+        return {**batch, 'image': augmenter.apply(batch['image'], seed)}
+
+    dataset = dataset.map(lambda batch: (batch, augmenter.make_seed()))
+    return dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
@@ -0,0 +1,234 @@
+'''
+Directory-scale batch OCR : millions of image files through a process pool, resumable.
+
+``run_batch`` lists the inputs (a directory searched recursively, a glob pattern, or a manifest file
+with one path per line or a CSV with a FILENAME column), splits them into chunks and has a pool of
+worker processes transcribe the chunks. Every worker loads the model once and runs its ops on its
+share of the cores, so the workers do not compete for threads and throughput grows with the number
+of processes. The results are written as they come, in the order of the inputs, as JSON lines
+
+    {"path": "...", "text": "..."}      or      {"path": "...", "error": "..."}
+
+or as CSV rows (path, text, error). A file that cannot be read or decoded gets an error record
+instead of stopping the job. Restarting a job with the same output skips every path already in it;
+a line cut short by a crash is dropped first, so the file stays valid. With a ``cache_dir``, the
+workers share a ``PredictionCache``, so images already read by the same weights, in another job or in
+the notebook, are not run through the model again.
+
+    python -m handwritten_ocr batch Handwritten-OCR.keras scans/ --output names.jsonl --workers 8
+'''
+
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Image extensions picked up in a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Images per task sent to a worker
+CHUNK_SIZE = 512
+
+# Images per forward pass inside a worker
+BATCH_SIZE = 64
+
+# Output columns of the CSV format
+CSV_FIELDS = ('path', 'text', 'error')
+
+
+def list_inputs(source : str):
+    '''
+    Lists the images of a job, in a stable order.
+
+    Argument :
+        source : A directory (searched recursively for IMAGE_EXTENSIONS), a glob pattern, or a manifest
+                 file : a .csv with a FILENAME column (relative paths are taken from the manifest's
+                 directory) or a text file with one path per line.
+
+    Return:
+        paths : The image paths; sorted for a directory or a pattern, in manifest order otherwise.
+    '''
+
+    if os.path.isdir(source):
+        paths = []
+        for root, _, filenames in os.walk(source):
+            paths.extend(
+                os.path.join(root, filename) for filename in filenames
+                if filename.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        return sorted(paths)
+
+    if os.path.isfile(source):
+        base = os.path.dirname(source)
+        with open(source, newline='', encoding='UTF-8') as file:
+            if source.lower().endswith('.csv'):
+                names = [row['FILENAME'] for row in csv.DictReader(file)]
+            else:
+                names = [line.strip() for line in file if line.strip()]
+        return [name if os.path.isabs(name) else os.path.join(base, name) for name in names]
+
+    paths = sorted(glob.glob(source, recursive=True))
+    if not paths:
+        raise FileNotFoundError(f'No input matches {source!r}')
+    return paths
+
+
+def _is_csv(output : str) -> bool:
+    return output.lower().endswith('.csv')
+
+
+def completed_paths(output : str) -> set:
+    '''
+    Returns the paths already in an output file, after dropping a last line cut short by a crash.
+    '''
+
+    if not os.path.exists(output):
+        return set()
+
+    # Only complete lines are kept : everything after the last newline is an interrupted write
+    with open(output, 'rb+') as file:
+        contents = file.read()
+        end = contents.rfind(b'\n') + 1
+        if end != len(contents):
+            file.truncate(end)
+    lines = contents[:end].decode('UTF-8').splitlines()
+
+    if _is_csv(output):
+        return {row['path'] for row in csv.DictReader(lines)}
+
+    paths = set()
+    for line in lines:
+        try:
+            paths.add(json.loads(line)['path'])
+        except (ValueError, KeyError):
+            continue
+    return paths
+
+
+# Model and batch function of a worker process, set once per process
+_worker_predictor = None
+
+
+def _init_worker(model_path : str, beam_width : int, threads : int, cache_dir : str = None):
+    global _worker_predictor
+
+    import tensorflow as tf
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from handwritten_ocr.cli import _decoder, _load_model
+    from handwritten_ocr.server import OCRBatchPredictor
+
+    model, vocabulary = _load_model(model_path)
+    cache = None
+    if cache_dir is not None:
+        from handwritten_ocr.prediction_cache import PredictionCache
+        cache = PredictionCache(cache_dir)
+    _worker_predictor = OCRBatchPredictor(model, _decoder(model, vocabulary, beam_width), cache=cache)
+
+
+def _transcribe_chunk(paths, batch_size : int = BATCH_SIZE):
+    records = []
+    for start in range(0, len(paths), batch_size):
+        batch_paths, contents, readable = paths[start:start + batch_size], [], []
+        for path in batch_paths:
+            try:
+                with open(path, 'rb') as file:
+                    contents.append(file.read())
+                readable.append(path)
+            except OSError as error:
+                records.append({'path': path, 'error': f'Unreadable file : {error.strerror}'})
+
+        results = _worker_predictor(contents) if contents else []
+        for path, result in zip(readable, results):
+            if isinstance(result, Exception):
+                records.append({'path': path, 'error': 'Invalid image'})
+            else:
+                records.append({'path': path, 'text': result})
+
+    # In input order, whichever failed
+    position = {path: index for index, path in enumerate(paths)}
+    return sorted(records, key=lambda record: position[record['path']])
+
+
+def run_batch(
+    model_path : str,
+    source : str,
+    output : str,
+    n_workers : int = None,
+    chunk_size : int = CHUNK_SIZE,
+    batch_size : int = BATCH_SIZE,
+    beam_width : int = 1,
+    cache_dir : str = None,
+    verbose : bool = True,
+) -> dict:
+    '''
+    Transcribes every image of ``source`` into ``output``, skipping the ones already there.
+
+    Arguments :
+        model_path : The .keras training checkpoint or .tflite artifact, with its .vocab.json file.
+        source     : The inputs, see ``list_inputs``.
+        output     : The .jsonl (or .csv) file the results are appended to.
+        n_workers  : The number of worker processes, by default one per core.
+        chunk_size : The number of images per worker task.
+        batch_size : The number of images per forward pass.
+        beam_width : The beam search width, 1 for greedy decoding.
+        cache_dir  : The directory of a PredictionCache shared by the workers, if any.
+        verbose    : Whether to print the progress to standard error.
+
+    Return:
+        report : The number of inputs, of images skipped as already done, transcribed and failed, the
+                 wall time and the images per second.
+    '''
+
+    paths = list_inputs(source)
+    done = completed_paths(output)
+    pending = [path for path in paths if path not in done]
+    chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+
+    cores = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers or cores, len(chunks) or 1))
+    threads = max(1, cores // n_workers)
+
+    report = {'inputs': len(paths), 'skipped': len(paths) - len(pending), 'transcribed': 0, 'errors': 0}
+    start = time.perf_counter()
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+
+    with open(output, 'a', newline='', encoding='UTF-8') as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS) if _is_csv(output) else None
+        if writer is not None and new_file:
+            writer.writeheader()
+
+        if chunks:
+            # TensorFlow is not fork safe; map yields the chunks in input order while the workers run ahead
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(model_path, beam_width, threads, cache_dir),
+            ) as executor:
+                for records in executor.map(_transcribe_chunk, chunks, [batch_size] * len(chunks)):
+                    for record in records:
+                        if writer is not None:
+                            writer.writerow(record)
+                        else:
+                            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        report['errors' if 'error' in record else 'transcribed'] += 1
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                    if verbose:
+                        processed = report['transcribed'] + report['errors']
+                        rate = processed / max(time.perf_counter() - start, 1e-9)
+                        print(f'\r{processed}/{len(pending)} images, {rate:.1f} images/s', end='', file=sys.stderr)
+            if verbose:
+                print(file=sys.stderr)
+
+    report['seconds'] = time.perf_counter() - start
+    report['images_per_second'] = (report['transcribed'] + report['errors']) / max(report['seconds'], 1e-9)
+    return report
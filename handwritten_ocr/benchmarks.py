@@ -0,0 +1,349 @@
+'''
+Reproducible benchmark suite of the data functions, the models and the decoder.
+
+``synthetic_split`` draws handwritten-style names (random pen strokes, one fixed glyph per character
+plus jitter) into JPEG files and writes the matching CSV, so the suite needs no dataset download.
+``run_benchmarks`` then times, on those files :
+
+* ``load_image``           : reading, decoding and resizing one image (``decode_image``);
+* ``encode_single_sample`` : the same plus the label encoding of the notebook (unicode_split,
+                             StringLookup, pad);
+* ``train_step/<name>``    : one training step of every architecture of ``models.ARCHITECTURES``;
+* ``inference/<batch>``    : the inference model at batch sizes 1 to 512;
+* ``decode_pred``          : greedy CTC decoding of a batch of 512 predictions.
+
+Every benchmark reports the median and minimum of several timed runs, after a warm-up, and the
+median time per item (image, sample or prediction). The report is JSON, and ``compare`` flags the
+benchmarks whose time per item is slower than a stored baseline by more than a tolerance :
+
+    python -m handwritten_ocr benchmark --output benchmark.json --baseline benchmark-baseline.json
+
+The first run stores the baseline, later runs are compared with it. Timings only compare on the same
+machine, so the report records the environment and ``compare`` warns when it differs; reports run
+with a different configuration are not compared at all.
+'''
+
+import csv
+import os
+import platform
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.decoding import GreedyDecoder
+from handwritten_ocr.models import ARCHITECTURES, build_ocr_model
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+from handwritten_ocr.vocabulary import Vocabulary
+
+# Characters of the synthetic names, those of the dataset's labels
+CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ -'"
+
+# Batch sizes the inference model is timed at
+INFERENCE_BATCH_SIZES = (1, 8, 32, 128, 512)
+
+# Batch size of the training steps, the notebook's BATCH_SIZE
+TRAIN_BATCH_SIZE = 16
+
+# Relative slowdown over the baseline reported as a regression
+REGRESSION_TOLERANCE = 0.15
+
+# Maximum label length of the synthetic names
+MAX_LABEL_LENGTH = 12
+
+
+def _glyph(character : str, rng):
+    '''
+    Returns the pen strokes of a character as lists of (x, y) control points in a unit cell. The glyph
+    of a character is always the same; ``rng`` adds the writer's jitter.
+    '''
+
+    glyph_rng = np.random.default_rng(ord(character))
+    strokes = []
+    for _ in range(1 if character in " -'" else glyph_rng.integers(1, 4)):
+        points = glyph_rng.uniform(0.1, 0.9, size=(glyph_rng.integers(2, 5), 2))
+        if character == '-':
+            points[:, 1] = 0.5
+        elif character == "'":
+            points = points * [1, 0.3]
+        strokes.append(points + rng.normal(0, 0.04, size=points.shape))
+    return [] if character == ' ' else strokes
+
+
+def render_name(name : str, rng, height : int = 64, char_width : int = 24):
+    '''
+    Draws a name with random pen strokes.
+
+    Arguments :
+        name       : The text.
+        rng        : A NumPy random generator.
+        height     : The image height.
+        char_width : The width of a character cell.
+
+    Return:
+        image : A uint8 array of shape (height, width, 1), dark ink on white.
+    '''
+
+    width = char_width * (len(name) + 2)
+    image = np.full((height, width), 255, dtype=np.uint8)
+    thickness = rng.integers(1, 3)
+    for index, character in enumerate(name):
+        for points in _glyph(character, rng):
+            # Dense polyline through the control points
+            t = np.linspace(0, 1, 40)
+            segments = np.linspace(0, 1, len(points))
+            xs = np.interp(t, segments, points[:, 0]) * char_width + char_width * (index + 1)
+            ys = np.interp(t, segments, points[:, 1]) * height * 0.6 + height * 0.2
+            for dx in range(-thickness, thickness + 1):
+                for dy in range(-thickness, thickness + 1):
+                    columns = np.clip(np.round(xs + dx).astype(int), 0, width - 1)
+                    rows = np.clip(np.round(ys + dy).astype(int), 0, height - 1)
+                    image[rows, columns] = rng.integers(0, 80)
+    noise = rng.normal(0, 8, size=image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)[..., None]
+
+
+def synthetic_split(directory : str, n_samples : int = 512, seed : int = 2569) -> str:
+    '''
+    Writes ``n_samples`` synthetic JPEGs and their CSV (FILENAME, IDENTITY) to ``directory``. The same
+    seed always gives the same files.
+
+    Return:
+        csv_path : The path of the CSV file.
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(CHARACTERS[:26]))
+
+    rows = []
+    for index in range(n_samples):
+        name = ''.join(rng.choice(letters, size=rng.integers(3, MAX_LABEL_LENGTH - 2)))
+        if rng.random() < 0.1:
+            name += rng.choice([' ', '-', "'"]) + ''.join(rng.choice(letters, size=2))
+        filename = f'SYNTH_{index:05d}.jpg'
+        image = tf.io.encode_jpeg(render_name(name, rng), quality=90)
+        tf.io.write_file(os.path.join(directory, filename), image)
+        rows.append((filename, name))
+
+    csv_path = os.path.join(directory, 'written_name_synthetic.csv')
+    with open(csv_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('FILENAME', 'IDENTITY'))
+        writer.writerows(rows)
+    return csv_path
+
+
+def _read_csv(csv_path : str):
+    with open(csv_path, newline='') as file:
+        rows = list(csv.DictReader(file))
+    directory = os.path.dirname(csv_path)
+    return [os.path.join(directory, row['FILENAME']) for row in rows], [row['IDENTITY'] for row in rows]
+
+
+def _timed(function, n_runs : int, items : int = 1) -> dict:
+    '''
+    Times ``function()`` ``n_runs`` times after a warm-up call.
+
+    Return:
+        result : Median and minimum milliseconds per call, and milliseconds per item and items per
+                 second at the median.
+    '''
+
+    function()
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return {
+        'median_ms': median * 1000,
+        'min_ms': float(np.min(times)) * 1000,
+        'ms_per_item': median * 1000 / items,
+        'items_per_second': items / median,
+        'runs': n_runs,
+    }
+
+
+def environment() -> dict:
+    '''
+    Describes the machine and library versions the benchmarks ran with.
+    '''
+
+    return {
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'gpus': len(tf.config.list_physical_devices('GPU')),
+    }
+
+
+def run_benchmarks(
+    directory : str,
+    n_samples : int = 512,
+    n_runs : int = 10,
+    batch_sizes = INFERENCE_BATCH_SIZES,
+    architectures = tuple(ARCHITECTURES),
+    seed : int = 2569,
+    verbose : bool = True,
+) -> dict:
+    '''
+    Runs the benchmark suite on synthetic data.
+
+    Arguments :
+        directory     : The directory of the synthetic split, generated when missing.
+        n_samples     : The number of synthetic images; the preprocessing benchmarks go over all of them.
+                        A split in ``directory`` with fewer images is generated again.
+        n_runs        : The number of timed runs of every benchmark.
+        batch_sizes   : The inference batch sizes.
+        architectures : The names of the architectures whose training step is timed.
+        seed          : The seed of the data, the weights and the dropout masks.
+        verbose       : Whether to print every result.
+
+    Return:
+        report : {'environment', 'config', 'benchmarks'}, where benchmarks maps every benchmark name to
+                 its timings (see ``_timed``).
+    '''
+
+    csv_path = os.path.join(directory, 'written_name_synthetic.csv')
+    if not os.path.exists(csv_path) or len(_read_csv(csv_path)[0]) < n_samples:
+        csv_path = synthetic_split(directory, n_samples, seed)
+    # The split of a seed is the same whatever its size, so a larger one starts with the same images
+    paths, labels = _read_csv(csv_path)
+    paths, labels = paths[:n_samples], labels[:n_samples]
+
+    keras.utils.set_random_seed(seed)
+    vocabulary = Vocabulary(sorted(CHARACTERS))
+    n_outputs = len(vocabulary) + 1
+    char_to_num = keras.layers.StringLookup(vocabulary=vocabulary.characters, mask_token=None)
+    benchmarks = {}
+
+    def record(name, result):
+        benchmarks[name] = result
+        if verbose:
+            print(f"{name:<28}{result['median_ms']:>10.2f} ms{result['ms_per_item']:>10.3f} ms/item")
+
+    # Preprocessing, one element at a time so the figures do not depend on the number of cores
+    def load_image(path):
+        return decode_image(tf.io.read_file(path), img_height=IMG_HEIGHT, img_width=IMG_WIDTH)
+
+    def encode_single_sample(path, label):
+        vecs = char_to_num(tf.strings.unicode_split(label, input_encoding='UTF-8'))
+        vecs = tf.pad(vecs, [[0, MAX_LABEL_LENGTH - tf.shape(vecs)[0]]], constant_values=n_outputs)
+        return {'image': load_image(path), 'label': vecs}
+
+    images = tf.data.Dataset.from_tensor_slices(paths).map(load_image)
+    samples = tf.data.Dataset.from_tensor_slices((paths, labels)).map(encode_single_sample)
+    record('load_image', _timed(lambda: images.reduce(0, lambda count, _: count + 1), n_runs, len(paths)))
+    record('encode_single_sample', _timed(lambda: samples.reduce(0, lambda count, _: count + 1), n_runs, len(paths)))
+
+    batch = next(iter(samples.batch(max(TRAIN_BATCH_SIZE, max(batch_sizes)))))
+    while batch['image'].shape[0] < max(batch_sizes):
+        batch = {key: tf.concat([value, value], axis=0) for key, value in batch.items()}
+
+    # Training step of every architecture
+    inference_model = None
+    for architecture in architectures:
+        model, architecture_inference = build_ocr_model(n_outputs, **ARCHITECTURES[architecture])
+        model.compile(optimizer=keras.optimizers.Adam(learning_rate=1e-3))
+        train_batch = {key: value[:TRAIN_BATCH_SIZE] for key, value in batch.items()}
+        record(f'train_step/{architecture}', _timed(lambda: model.train_on_batch(train_batch), n_runs, TRAIN_BATCH_SIZE))
+        if inference_model is None:
+            inference_model = architecture_inference
+
+    # Inference of the first architecture
+    for batch_size in batch_sizes:
+        images = batch['image'][:batch_size]
+        record(f'inference/{batch_size}', _timed(lambda: inference_model.predict_on_batch(images), n_runs, batch_size))
+
+    # Greedy decoding of the largest batch of predictions
+    pred = inference_model.predict_on_batch(batch['image'][:max(batch_sizes)])
+    decode_pred = GreedyDecoder(vocabulary.get_vocabulary(), max_length=MAX_LABEL_LENGTH)
+    record('decode_pred', _timed(lambda: decode_pred(pred), n_runs, len(pred)))
+
+    return {
+        'environment': environment(),
+        'config': {
+            'n_samples': len(paths),
+            'n_runs': n_runs,
+            'batch_sizes': list(batch_sizes),
+            'architectures': list(architectures),
+            'seed': seed,
+        },
+        'benchmarks': benchmarks,
+    }
+
+
+def _ms_per_item(result : dict) -> float:
+    # Reports written before 'ms_per_item' existed only have items per second
+    return result.get('ms_per_item', 1000 / result['items_per_second'])
+
+
+def compare(report : dict, baseline : dict, tolerance : float = REGRESSION_TOLERANCE) -> dict:
+    '''
+    Compares a report of ``run_benchmarks`` with a baseline report, on the median time per item so
+    that benchmarks over a whole split or batch do not depend on its size.
+
+    Arguments :
+        report    : The new report.
+        baseline  : The baseline report.
+        tolerance : The relative slowdown of the time per item above which a benchmark is a regression.
+
+    Return:
+        comparison : {'same_environment', 'regressions', 'benchmarks'}, where benchmarks maps every
+                     benchmark to its baseline and new milliseconds per item, their ratio and whether
+                     it regressed. Benchmarks missing from the baseline have no ratio. Raises a
+                     ValueError when the reports were run with a different configuration.
+    '''
+
+    if report['config'] != baseline['config']:
+        changed = sorted(
+            key for key in set(report['config']) | set(baseline['config'])
+            if report['config'].get(key) != baseline['config'].get(key)
+        )
+        raise ValueError(
+            f"The baseline was run with a different configuration ({', '.join(changed)}); "
+            'run it again with the same settings or update the baseline'
+        )
+
+    benchmarks = {}
+    for name, result in report['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        now = _ms_per_item(result)
+        if before is None:
+            benchmarks[name] = {'ms_per_item': now, 'baseline_ms_per_item': None, 'ratio': None, 'regression': False}
+            continue
+        ratio = now / _ms_per_item(before)
+        benchmarks[name] = {
+            'ms_per_item': now,
+            'baseline_ms_per_item': _ms_per_item(before),
+            'ratio': ratio,
+            'regression': ratio > 1 + tolerance,
+        }
+
+    return {
+        'same_environment': report['environment'] == baseline['environment'],
+        'tolerance': tolerance,
+        'regressions': [name for name, row in benchmarks.items() if row['regression']],
+        'benchmarks': benchmarks,
+    }
+
+
+def format_comparison(comparison : dict) -> str:
+    '''
+    Formats the result of ``compare`` as a text table.
+    '''
+
+    lines = [f"{'Benchmark (ms / item)':<28}{'Baseline':>12}{'Now':>12}{'Ratio':>8}"]
+    for name, row in comparison['benchmarks'].items():
+        baseline = '-' if row['baseline_ms_per_item'] is None else f"{row['baseline_ms_per_item']:.3f}"
+        ratio = '-' if row['ratio'] is None else f"{row['ratio']:.2f}"
+        flag = '  REGRESSION' if row['regression'] else ''
+        lines.append(f"{name:<28}{baseline:>12}{row['ms_per_item']:>12.3f}{ratio:>8}{flag}")
+    if not comparison['same_environment']:
+        lines.append('Warning : the baseline was measured in a different environment.')
+    return '\n'.join(lines)
@@ -0,0 +1,176 @@
+'''
+Width bucketed, aspect preserving input pipeline.
+
+The fixed pipeline stretches every image to 200x50 whatever its shape: short names waste most of the
+50 CTC time steps and long names get squashed. Here images are resized to the fixed height only,
+keeping their aspect ratio (the width is rounded up to a multiple of 4, the model's downsampling, and
+kept between ``MIN_WIDTH`` and ``max_width``). The width depends on the image alone, so serving resizes
+exactly as training did; training samples whose image is too narrow for CTC to align their label are
+dropped instead. Samples are then grouped into width buckets, so a batch is only padded to the widest
+image of its bucket, and the CTC loss gets each sample's own number of time steps.
+``benchmark_fit`` times an epoch of either pipeline for a side by side comparison.
+'''
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.models import DOWNSAMPLE
+from handwritten_ocr.preprocessing import IMG_HEIGHT
+
+# Width bucket boundaries, in pixels
+BUCKET_BOUNDARIES = (64, 96, 128, 160, 200)
+
+# Widest image kept, in pixels; wider images are squeezed to it
+MAX_WIDTH = 320
+
+# Narrowest image kept, in pixels; narrower images are stretched to it
+MIN_WIDTH = 64
+
+
+def decode_image_keep_aspect(
+    contents,
+    img_height : int = IMG_HEIGHT,
+    max_width : int = MAX_WIDTH,
+    min_width : int = MIN_WIDTH,
+):
+    '''
+    Decodes a JPEG and resizes it to ``img_height`` keeping its aspect ratio. The width is rounded up
+    to a multiple of DOWNSAMPLE and clipped to [min_width, max_width]; it only depends on the image.
+
+    Arguments :
+        contents     : A scalar string tensor holding the encoded JPEG.
+        img_height   : The height the image is resized to.
+        max_width    : The largest width kept.
+        min_width    : The smallest width kept.
+
+    Returns:
+        image        : The image tensor of shape (width, img_height, 1).
+        input_length : The number of CTC time steps of the image, width // DOWNSAMPLE.
+    '''
+
+    image = tf.image.decode_jpeg(contents = contents, channels = 1)
+    image = tf.image.convert_image_dtype(image = image, dtype = tf.float32)
+
+    shape = tf.cast(tf.shape(image), tf.float32)
+    width = tf.cast(tf.math.ceil(shape[1] * img_height / shape[0] / DOWNSAMPLE), tf.int32) * DOWNSAMPLE
+    width = tf.clip_by_value(width, max(min_width, DOWNSAMPLE), max_width)
+
+    image = tf.image.resize(images = image, size = (img_height, width))
+    image = tf.transpose(image, perm = [1, 0, 2])
+
+    return image, tf.cast(width // DOWNSAMPLE, tf.int64)
+
+
+def bucketed_dataset(
+    paths,
+    labels,
+    encode_label,
+    batch_size : int,
+    shuffle : bool = False,
+    bucket_boundaries = BUCKET_BOUNDARIES,
+    img_height : int = IMG_HEIGHT,
+    max_width : int = MAX_WIDTH,
+    label_padding : int = 0,
+    label_lengths = None,
+    min_width : int = MIN_WIDTH,
+):
+    '''
+    Builds a dataset of width bucketed batches for a variable width model (see ``build_ocr_model``
+    with ``img_width=None``).
+
+    Arguments :
+        paths             : The image file paths.
+        labels            : The label strings, or their padded indices when ``encode_label`` is None.
+        encode_label      : The notebook's encode_label, mapping a label string to its padded indices;
+                            None when the labels are already encoded (see ``Vocabulary.encode``).
+        batch_size        : The batch size of every bucket.
+        shuffle           : Whether to shuffle the samples before bucketing.
+        bucket_boundaries : The width boundaries of the buckets.
+        img_height        : The image height.
+        max_width         : The largest width kept.
+        label_padding     : The padding value of the labels (n_classes + 1 in the notebook).
+        label_lengths     : The label lengths, with encoded labels.
+        min_width         : The smallest width kept.
+
+    Return:
+        dataset : A dataset of {'image', 'label', 'input_length', 'label_length'} batches; images are
+                  padded with white up to the widest image of their batch. Samples with fewer time
+                  steps than CTC needs for their label (2 * length + 1) are left out.
+    '''
+
+    def encode(path, label, label_length):
+        image, input_length = decode_image_keep_aspect(
+            tf.io.read_file(path), img_height=img_height, max_width=max_width, min_width=min_width
+        )
+        return {
+            'image': image,
+            'label': label,
+            'input_length': tf.reshape(input_length, (1,)),
+            'label_length': tf.reshape(tf.cast(label_length, tf.int64), (1,)),
+        }
+
+    if encode_label is None:
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (np.array(list(paths)), np.asarray(labels), np.asarray(label_lengths, dtype=np.int64))
+        )
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(
+            (np.array(list(paths)), np.array([str(label) for label in labels]))
+        ).map(
+            lambda path, label: (path, encode_label(label), tf.strings.length(label, unit='UTF8_CHAR')),
+            num_parallel_calls=tf.data.AUTOTUNE
+        )
+    if shuffle:
+        dataset = dataset.shuffle(1000)
+    dataset = dataset.map(encode, num_parallel_calls=tf.data.AUTOTUNE).filter(
+        lambda sample: sample['input_length'][0] >= 2 * sample['label_length'][0] + 1
+    )
+
+    label_dtype = dataset.element_spec['label'].dtype
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=lambda sample: tf.shape(sample['image'])[0],
+        bucket_boundaries=list(bucket_boundaries),
+        bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+        padding_values={
+            'image': tf.constant(1.0, tf.float32),
+            'label': tf.constant(label_padding, label_dtype),
+            'input_length': tf.constant(0, tf.int64),
+            'label_length': tf.constant(0, tf.int64),
+        },
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def benchmark_fit(model, dataset, epochs : int = 1) -> dict:
+    '''
+    Trains ``model`` on ``dataset`` and measures throughput and the work per sample.
+
+    Arguments :
+        model   : A compiled training model.
+        dataset : Its training dataset of dictionary batches.
+        epochs  : The number of epochs to time.
+
+    Return:
+        report : Samples per second, mean CTC time steps per sample and mean pixels processed per sample,
+                 padding included.
+    '''
+
+    samples, time_steps, pixels = 0, 0, 0
+    for batch in dataset:
+        images = batch['image']
+        samples += int(images.shape[0])
+        pixels += int(np.prod(images.shape))
+        time_steps += int(images.shape[0]) * (int(images.shape[1]) // DOWNSAMPLE)
+
+    start = time.perf_counter()
+    model.fit(dataset, epochs=epochs, verbose=0)
+    seconds = time.perf_counter() - start
+
+    return {
+        'samples_per_second': samples * epochs / seconds,
+        'time_steps_per_sample': time_steps / max(samples, 1),
+        'pixels_per_sample': pixels / max(samples, 1),
+        'seconds': seconds,
+    }
@@ -0,0 +1,197 @@
+'''
+Confidence-gated cascade : the small model reads every image, the large one only the uncertain ones.
+
+Most names are written cleanly, and the small model already reads them right. ``CascadeOCR`` runs the
+small model on every image and decodes it with its confidence, the probability of the best path (see
+``GreedyDecoder.confidence``), or with a ``BeamSearchDecoder`` that of the labelling the beam found.
+Only the images whose confidence is below ``threshold`` go on to the large model, whose reading
+replaces the small one's. The large model therefore costs in proportion to the share of uncertain
+images rather than to the whole split.
+
+``cascade_report`` chooses the threshold. It runs each model once over the validation set, then scores
+every threshold from those predictions : the CER, the share of images escalated and the throughput,
+from the measured per-image time of the two models. Over a dataset the escalated images are collected
+into full batches for the large model (``CascadeOCR.predict``), so its per-image time is the one measured
+at the same batch size.
+
+    cascade = CascadeOCR(inference_model, inference_model_2, greedy_decoder, threshold=0.9)
+    texts, confidences, escalated = cascade(images)
+'''
+
+import time
+
+import numpy as np
+
+from handwritten_ocr.evaluation import OCRMetrics
+
+# Confidence thresholds scored by cascade_report
+THRESHOLDS = (0.5, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+
+class CascadeOCR:
+
+    '''
+    Two models behind one prediction : the large one only reads what the small one is unsure of.
+
+    Arguments :
+        small_model : The cheap inference model, run on every image.
+        large_model : The accurate inference model, run on the images below the threshold.
+        decoder     : The decoder of both models, e.g. greedy_decoder; they share the vocabulary.
+        threshold   : The confidence below which an image is escalated; 0 never escalates, above 1 always.
+    '''
+
+    def __init__(self, small_model, large_model, decoder, threshold : float = 0.9) -> None:
+        self.small_model = small_model
+        self.large_model = large_model
+        self.decoder = decoder
+        self.threshold = threshold
+
+    def _large(self, images):
+        pred = self.large_model.predict_on_batch(np.asarray(images))
+        return self.decoder.decode_with_confidence(np.asarray(pred))
+
+    def __call__(self, images):
+        '''
+        Reads a batch of images.
+
+        Argument :
+            images : A batch in the model layout.
+
+        Returns:
+            texts       : The decoded strings.
+            confidences : The confidence of the model that read each image.
+            escalated   : A boolean array of the images read by the large model.
+        '''
+
+        pred = self.small_model.predict_on_batch(images)
+        texts, confidences = self.decoder.decode_with_confidence(np.asarray(pred))
+        escalated = confidences < self.threshold
+
+        indices = np.flatnonzero(escalated)
+        if len(indices):
+            large_texts, large_confidences = self._large(np.asarray(images)[indices])
+            for index, text in zip(indices, large_texts):
+                texts[index] = text
+            confidences[indices] = large_confidences
+        return texts, confidences, escalated
+
+    def predict(self, dataset, batch_size : int = None):
+        '''
+        Reads a whole dataset, sending the escalated images to the large model in full batches.
+
+        Arguments :
+            dataset    : A dataset of image batches, or of (images, texts) batches.
+            batch_size : The large model batch size, by default the size of the first batch.
+
+        Returns:
+            texts       : The decoded strings, in the order of the dataset.
+            confidences : The confidence of the model that read each image.
+            escalated   : A boolean array of the images read by the large model.
+        '''
+
+        texts, confidences, escalated = [], [], []
+        pending, pending_images = [], []
+
+        def flush():
+            large_texts, large_confidences = self._large(np.concatenate(pending_images))
+            for index, text, confidence in zip(pending, large_texts, large_confidences):
+                texts[index], confidences[index] = text, confidence
+            pending.clear()
+            pending_images.clear()
+
+        for batch in dataset:
+            images = np.asarray(batch[0] if isinstance(batch, tuple) else batch)
+            batch_size = batch_size or len(images)
+            pred = self.small_model.predict_on_batch(images)
+            batch_texts, batch_confidences = self.decoder.decode_with_confidence(np.asarray(pred))
+
+            uncertain = batch_confidences < self.threshold
+            pending.extend(len(texts) + np.flatnonzero(uncertain))
+            pending_images.append(images[uncertain])
+            texts.extend(batch_texts)
+            confidences.extend(batch_confidences)
+            escalated.extend(uncertain)
+            if len(pending) >= batch_size:
+                flush()
+
+        if pending:
+            flush()
+        return texts, np.asarray(confidences, dtype=np.float32), np.asarray(escalated, dtype=bool)
+
+
+def _read(model, dataset, decoder):
+    '''
+    Predicts a dataset of (images, texts) batches, timing the model calls only.
+    '''
+
+    texts, confidences, truths, seconds = [], [], [], 0.0
+    for images, labels in dataset:
+        start = time.perf_counter()
+        pred = np.asarray(model.predict_on_batch(images))
+        seconds += time.perf_counter() - start
+        batch_texts, batch_confidences = decoder.decode_with_confidence(pred)
+        texts.extend(batch_texts)
+        confidences.extend(batch_confidences)
+        truths.extend(label.decode('UTF-8') for label in labels.numpy())
+    return texts, np.asarray(confidences), truths, seconds
+
+
+def _score(truths, preds) -> dict:
+    metrics = OCRMetrics()
+    metrics.update(truths, preds)
+    result = metrics.result()
+    return {'cer': result['cer'], 'exact_match': result['exact_match']}
+
+
+def cascade_report(small_model, large_model, dataset, decoder, thresholds = THRESHOLDS) -> dict:
+    '''
+    Scores the cascade at every threshold against the two models alone.
+
+    Arguments :
+        small_model : The cheap inference model.
+        large_model : The accurate inference model.
+        dataset     : An evaluation dataset of (images, texts) batches, see ``build_eval_dataset``.
+        decoder     : The decoder of both models.
+        thresholds  : The confidence thresholds scored.
+
+    Return:
+        report : Mapping of 'small', 'cascade <threshold>' and 'large' to the threshold, the share of
+                 images escalated, the CER, exact match, images per second and speedup over the large model.
+    '''
+
+    small_texts, small_confidences, truths, small_seconds = _read(small_model, dataset, decoder)
+    large_texts, _, _, large_seconds = _read(large_model, dataset, decoder)
+    n_samples = len(truths)
+
+    rows = [('small', 0.0), *((f'cascade {threshold:g}', threshold) for threshold in thresholds), ('large', None)]
+    report = {}
+    for name, threshold in rows:
+        if threshold is None:
+            escalated, seconds = np.ones(n_samples, dtype=bool), large_seconds
+        else:
+            escalated = small_confidences < threshold
+            seconds = small_seconds + large_seconds * escalated.mean()
+        preds = [large if up else small for small, large, up in zip(small_texts, large_texts, escalated)]
+
+        report[name] = {
+            'threshold': threshold,
+            'escalated': float(escalated.mean()),
+            **_score(truths, preds),
+            'images_per_second': n_samples / max(seconds, 1e-9),
+            'speedup': large_seconds / max(seconds, 1e-9),
+        }
+    return report
+
+
+def format_cascade_report(report : dict) -> str:
+    '''
+    Formats the report of ``cascade_report`` as a text table.
+    '''
+
+    lines = [f"{'Mode':<16}{'Escalated':>10}{'CER':>8}{'Exact':>8}{'Images/s':>10}{'Speedup':>9}"]
+    for name, row in report.items():
+        lines.append(
+            f"{name:<16}{row['escalated']:>10.1%}{row['cer']:>8.4f}{row['exact_match']:>8.4f}"
+            f"{row['images_per_second']:>10.1f}{row['speedup']:>9.2f}"
+        )
+    return '\n'.join(lines)
@@ -0,0 +1,330 @@
+'''
+Preemption-safe training : step level checkpoints and mid-epoch resume.
+
+The notebook's ModelCheckpoint only writes the .keras file at the end of an epoch, so a preempted
+instance loses the epoch in progress and restarts the shuffle from scratch. ``fit_resumable`` trains
+like ``model.fit`` (same callbacks, progress bar and History), but every ``save_steps`` steps it writes a
+TensorFlow checkpoint of
+
+* the model weights and the optimizer state (slots and iteration count);
+* the tf.data iterator, i.e. the position in the epoch, the shuffle order and the prefetched batches;
+* the random states that make the next steps what they would have been : the dropout seed generators
+  and any extra generator passed in, e.g. the ``BatchAugmenter``'s;
+* the History of the epochs trained so far and the state of the callbacks (``CALLBACK_STATE``, and the
+  best weights of an ``EarlyStopping(restore_best_weights=True)``), with whether training stopped early.
+
+Checkpoints are written asynchronously (variables are copied, then written by a background thread),
+so training does not wait for the disk. On SIGTERM, which spot instances receive before they are
+reclaimed, the current step finishes, a checkpoint is written synchronously and training returns.
+Calling ``fit_resumable`` again with the same directory restores the latest checkpoint and continues
+from the next step of the same epoch, with the same batches as without the interruption. The
+following epochs are reshuffled from a fresh shuffle state, since tf.data does not restore the reshuffle
+of a ``shuffle`` followed by other transformations; they are still a permutation of the whole split.
+The History returned covers every epoch of the run, not only those of the last call. Once all the
+epochs are trained, or an EarlyStopping stopped the run, calling again trains nothing and returns the
+History of the run, with the model as it was at the end of it.
+
+    history = fit_resumable(
+        model, train_ds, epochs=EPOCHS, checkpoint_dir='checkpoints', validation_data=valid_ds,
+        callbacks=CALLBACKS, augmenter=train_augmenter.generator
+    )
+'''
+
+import json
+import signal
+import threading
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+# Default number of training steps between two checkpoints
+SAVE_STEPS = 200
+
+# Callback attributes saved with the run (EarlyStopping, ReduceLROnPlateau, ModelCheckpoint)
+CALLBACK_STATE = ('wait', 'best', 'best_epoch', 'stopped_epoch', 'cooldown_counter')
+
+
+def _variables(variables):
+    '''
+    Returns the TensorFlow variables behind Keras variables. Recent Keras versions wrap them, and the
+    wrappers cannot be copied by the asynchronous checkpoint more than once.
+    '''
+
+    return [variable if isinstance(variable, tf.Variable) else variable.value for variable in variables]
+
+
+class StepCheckpoint:
+
+    '''
+    Step level checkpoints of a training run. They hold the variables by position, so they resume the
+    same model and optimizer, not a different architecture.
+
+    Arguments :
+        model       : The compiled training model.
+        iterator    : The iterator over the training dataset.
+        directory   : The checkpoint directory.
+        max_to_keep : The number of checkpoints kept.
+        async_save  : Whether checkpoints are written in the background.
+        callbacks   : The Keras callbacks whose state is saved with the run.
+        trackables  : Extra objects saved with the run, e.g. a tf.random.Generator.
+    '''
+
+    def __init__(
+        self,
+        model,
+        iterator,
+        directory : str,
+        max_to_keep : int = 2,
+        async_save : bool = True,
+        callbacks = (),
+        **trackables,
+    ) -> None:
+        # The optimizer slots must exist before they can be restored
+        if not getattr(model.optimizer, 'built', True):
+            model.optimizer.build(model.trainable_variables)
+
+        # The History, the callback attributes and whether training stopped, as JSON
+        self.callbacks = list(callbacks or ())
+        self.state = tf.Variable('', dtype=tf.string, trainable=False)
+
+        # Copies of the best weights of the callbacks that restore them at the end of training
+        self.best_weights = [
+            [tf.Variable(weight, trainable=False) for weight in model.get_weights()]
+            if getattr(callback, 'restore_best_weights', False) else []
+            for callback in self.callbacks
+        ]
+
+        # Every model variable (weights and dropout seed states) and optimizer variable, by position
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(
+            model=_variables(model.variables),
+            optimizer=_variables(model.optimizer.variables),
+            iterator=iterator,
+            step=self.step,
+            state=self.state,
+            best_weights=self.best_weights,
+            **trackables,
+        )
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=max_to_keep)
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_save)
+
+    def restore(self) -> int:
+        '''
+        Restores the latest checkpoint, if any, and returns the number of steps already trained.
+        '''
+
+        if self.manager.latest_checkpoint:
+            self.checkpoint.restore(self.manager.latest_checkpoint)
+        return int(self.step.numpy())
+
+    def run_state(self) -> dict:
+        '''
+        Returns the run state of the restored checkpoint : 'epoch' and 'history' (as in a History),
+        the last training 'logs', whether training 'stopped' early and the 'callbacks' attributes.
+        '''
+
+        state = self.state.numpy().decode('UTF-8')
+        return json.loads(state) if state else {'epoch': [], 'history': {}, 'logs': {}, 'stopped': False}
+
+    def restore_callbacks(self, state : dict):
+        '''
+        Puts the callbacks back in the state of ``run_state``; call it after their ``on_train_begin``.
+        '''
+
+        for callback, attributes, variables in zip(self.callbacks, state.get('callbacks', []), self.best_weights):
+            for name, value in attributes.items():
+                setattr(callback, name, value)
+            if variables and attributes.get('has_best_weights'):
+                callback.best_weights = [variable.numpy() for variable in variables]
+
+    def record(self, history, logs : dict, stopped : bool = False):
+        '''
+        Stores the History, the last training logs, the callbacks and whether training stopped early,
+        for the next ``save``.
+        '''
+
+        callbacks = []
+        for callback, variables in zip(self.callbacks, self.best_weights):
+            attributes = {
+                name: _plain(getattr(callback, name)) for name in CALLBACK_STATE if hasattr(callback, name)
+            }
+            best_weights = getattr(callback, 'best_weights', None)
+            if variables and best_weights is not None:
+                for variable, weight in zip(variables, best_weights):
+                    variable.assign(weight)
+                attributes['has_best_weights'] = True
+            callbacks.append(attributes)
+
+        self.state.assign(json.dumps({
+            'epoch': [int(epoch) for epoch in history.epoch],
+            'history': {name: [float(value) for value in values] for name, values in history.history.items()},
+            'logs': {name: float(value) for name, value in logs.items()},
+            'stopped': bool(stopped),
+            'callbacks': callbacks,
+        }))
+
+    def save(self, wait : bool = False) -> str:
+        '''
+        Writes a checkpoint numbered by the current step; ``wait`` blocks until it is on disk.
+        '''
+
+        path = self.manager.save(checkpoint_number=int(self.step.numpy()), options=self.options)
+        if wait:
+            self.sync()
+        return path
+
+    def sync(self):
+        '''
+        Waits for the checkpoints being written in the background.
+        '''
+
+        if hasattr(self.checkpoint, 'sync'):
+            self.checkpoint.sync()
+
+
+def _plain(value):
+    # NumPy scalars become Python numbers, so that the state can be written as JSON
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class PreemptionHandler:
+
+    '''
+    Context manager recording SIGTERM instead of dying on it, so that the training loop can checkpoint
+    first. Signals can only be handled in the main thread; elsewhere it does nothing.
+    '''
+
+    def __init__(self, signals = (signal.SIGTERM,)) -> None:
+        self.signals = signals
+        self.requested = False
+        self._previous = {}
+
+    def _handle(self, signum, frame):
+        self.requested = True
+
+    def __enter__(self):
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self._previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, *exc):
+        for signum, handler in self._previous.items():
+            signal.signal(signum, handler)
+        self._previous = {}
+
+
+def fit_resumable(
+    model,
+    dataset,
+    epochs : int,
+    checkpoint_dir : str,
+    validation_data = None,
+    callbacks = None,
+    steps_per_epoch : int = None,
+    save_steps : int = SAVE_STEPS,
+    async_save : bool = True,
+    verbose : int = 1,
+    **trackables,
+):
+    '''
+    Trains ``model`` like ``model.fit``, with step level checkpoints and mid-epoch resume.
+
+    Arguments :
+        model           : The compiled training model.
+        dataset         : The training dataset; it is repeated, so an epoch is ``steps_per_epoch`` steps.
+        epochs          : The number of epochs.
+        checkpoint_dir  : The checkpoint directory; training resumes from it when it has a checkpoint.
+        validation_data : An optional validation dataset, evaluated at the end of every epoch.
+        callbacks       : Keras callbacks, called as ``fit`` does.
+        steps_per_epoch : The steps of an epoch, by default the cardinality of ``dataset``.
+        save_steps      : The number of steps between two checkpoints.
+        async_save      : Whether checkpoints are written in the background.
+        verbose         : The progress bar verbosity, as in ``fit``.
+        trackables      : Extra state saved with the run, e.g. augmenter=train_augmenter.generator.
+
+    Return:
+        history : The History of every epoch of the run, including those of earlier calls.
+    '''
+
+    if steps_per_epoch is None:
+        steps_per_epoch = int(dataset.cardinality())
+        if steps_per_epoch < 0:
+            raise ValueError('The dataset size is unknown; pass steps_per_epoch')
+
+    # Generators the pipeline draws from are external to the iterator state; they are saved as trackables
+    options = tf.data.Options()
+    options.experimental_external_state_policy = tf.data.experimental.ExternalStatePolicy.IGNORE
+    iterator = iter(dataset.repeat().with_options(options))
+    callbacks = list(callbacks or [])
+    checkpoint = StepCheckpoint(
+        model, iterator, checkpoint_dir, async_save=async_save, callbacks=callbacks, **trackables
+    )
+    initial_epoch, initial_step = divmod(checkpoint.restore(), steps_per_epoch)
+    state = checkpoint.run_state()
+
+    # A checkpoint written on the last step of an epoch, before its end was processed, resumes at that end
+    if initial_step == 0 and len(state['epoch']) < initial_epoch:
+        initial_epoch, initial_step = initial_epoch - 1, steps_per_epoch
+    latest = checkpoint.manager.latest_checkpoint
+    if state['stopped'] or initial_epoch >= epochs:
+        print(f'Training already finished after {len(state["epoch"])} epochs ({latest})')
+    elif initial_epoch or initial_step:
+        print(f'Resuming from epoch {initial_epoch + 1}, step {initial_step} ({latest})')
+
+    callback_list = keras.callbacks.CallbackList(
+        callbacks, add_history=True, add_progbar=verbose != 0, model=model,
+        verbose=verbose, epochs=epochs, steps=steps_per_epoch,
+    )
+    history = next(
+        callback for callback in callback_list.callbacks if isinstance(callback, keras.callbacks.History)
+    )
+    model.stop_training = False
+    logs = state['logs']
+    trained = False
+
+    with PreemptionHandler() as preemption:
+        callback_list.on_train_begin()
+        history.epoch, history.history = state['epoch'], state['history']
+        model.history = history
+        checkpoint.restore_callbacks(state)
+
+        for epoch in range(initial_epoch, initial_epoch if state['stopped'] else epochs):
+            model.reset_metrics()
+            callback_list.on_epoch_begin(epoch)
+
+            for step in range(initial_step if epoch == initial_epoch else 0, steps_per_epoch):
+                callback_list.on_train_batch_begin(step)
+                logs = model.train_on_batch(next(iterator), return_dict=True)
+                checkpoint.step.assign_add(1)
+                trained = True
+                callback_list.on_train_batch_end(step, logs)
+
+                if preemption.requested:
+                    checkpoint.record(history, logs)
+                    path = checkpoint.save(wait=True)
+                    print(f'\nPreempted : step {int(checkpoint.step.numpy())} saved to {path}')
+                    return history
+                if int(checkpoint.step.numpy()) % save_steps == 0:
+                    checkpoint.record(history, logs)
+                    checkpoint.save()
+                if model.stop_training:
+                    break
+
+            epoch_logs = dict(logs)
+            if validation_data is not None:
+                results = model.evaluate(validation_data, verbose=0, return_dict=True)
+                epoch_logs.update({'val_' + name: value for name, value in results.items()})
+            callback_list.on_epoch_end(epoch, epoch_logs)
+            trained = True
+            if model.stop_training:
+                break
+
+        # The end of the run, so that calling again neither repeats the last epoch nor trains past a stop
+        if trained:
+            checkpoint.record(history, logs, stopped=model.stop_training)
+            checkpoint.save(wait=True)
+        callback_list.on_train_end(logs)
+
+    return history
@@ -0,0 +1,390 @@
+'''
+Command line entry points : train, predict and evaluate without running the notebook.
+
+    python -m handwritten_ocr train    --csv written_name_train.csv --image-dir train_v2/train \\
+                                       --model Handwritten-OCR.keras
+    python -m handwritten_ocr predict  Handwritten-OCR.keras image1.jpg image2.jpg
+    python -m handwritten_ocr evaluate Handwritten-OCR.keras --csv written_name_test.csv --image-dir test_v2/test
+    python -m handwritten_ocr startup  -- predict Handwritten-OCR.keras image1.jpg
+    python -m handwritten_ocr benchmark --output benchmark.json --baseline benchmark-baseline.json
+    python -m handwritten_ocr export   Handwritten-OCR.keras exported/
+    python -m handwritten_ocr batch    Handwritten-OCR.keras scans/ --output names.jsonl --workers 8
+
+This module only imports the standard library at the top. Each command imports what it needs when
+it runs: ``predict`` loads TensorFlow and the model but none of matplotlib, pandas or the training
+modules itself (recent Keras versions import pandas and IPython along with TensorFlow, though).
+
+A model is the ``.keras`` training checkpoint (the notebook's ModelCheckpoint file) or a ``.tflite``
+artifact from ``quantization.export_tflite``; either way its vocabulary is read from the
+``.vocab.json`` file next to it.
+
+``startup`` measures cold start : it runs a command in fresh interpreters several times and compares
+the wall time with importing the notebook's modules alone.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# The modules the notebook imports before doing anything
+NOTEBOOK_MODULES = ('numpy', 'pandas', 'tensorflow', 'tensorflow.keras', 'matplotlib.pyplot', 'IPython', 'tqdm')
+
+# Imports the notebook modules that are installed, the baseline of ``measure_startup``
+NOTEBOOK_IMPORTS = (
+    'import importlib\n'
+    f'for name in {NOTEBOOK_MODULES!r}:\n'
+    '    try:\n'
+    '        importlib.import_module(name)\n'
+    '    except ImportError:\n'
+    '        pass\n'
+)
+
+
+def _log(message : str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def _read_split(csv_path : str, image_dir : str, limit : int = None):
+    import pandas as pd
+
+    csv = pd.read_csv(csv_path)[:limit]
+    paths = [os.path.join(image_dir, filename) for filename in csv['FILENAME']]
+    # str() like the notebook, so missing names become 'nan' there and here
+    texts = [str(word) for word in csv['IDENTITY'].to_numpy()]
+    return paths, texts
+
+
+def _load_model(path : str):
+    '''
+    Loads a model for inference and its vocabulary.
+    '''
+
+    from handwritten_ocr.vocabulary import Vocabulary, vocabulary_path
+
+    vocabulary = Vocabulary.load(vocabulary_path(path))
+    if path.endswith('.tflite'):
+        from handwritten_ocr.quantization import TFLiteRunner
+        return TFLiteRunner(path), vocabulary
+
+    from handwritten_ocr.models import load_inference_model
+    return load_inference_model(path), vocabulary
+
+
+def _decoder(model, vocabulary, beam_width : int = 1):
+    if hasattr(model, 'output_shape'):
+        n_steps = model.output_shape[1]
+    else:
+        n_steps = int(model.output['shape'][1])
+    max_length = vocabulary.max_label_length or n_steps
+
+    if beam_width > 1:
+        from handwritten_ocr.decoding import BeamSearchDecoder
+        return BeamSearchDecoder(vocabulary.get_vocabulary(), max_length=max_length, beam_width=beam_width)
+
+    from handwritten_ocr.decoding import GreedyDecoder
+    return GreedyDecoder(vocabulary.get_vocabulary(), max_length=max_length)
+
+
+def predict(args):
+    '''
+    Prints one JSON line {"path", "text"} per image.
+    '''
+
+    timings = {'imports': time.perf_counter()}
+    import numpy as np
+    import tensorflow as tf
+
+    from handwritten_ocr.preprocessing import decode_image
+    timings['imports'] = time.perf_counter() - timings['imports']
+
+    start = time.perf_counter()
+    model, vocabulary = _load_model(args.model)
+    decode = _decoder(model, vocabulary, args.beam_width)
+    timings['load_model'] = time.perf_counter() - start
+
+    def load(path):
+        return decode_image(tf.io.read_file(path))
+
+    start = time.perf_counter()
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for offset in range(0, len(args.images), args.batch_size):
+            paths = args.images[offset:offset + args.batch_size]
+            images, valid = [], []
+            for path in paths:
+                # Unreadable images get an error line instead of stopping the batch
+                try:
+                    images.append(load(path))
+                    valid.append(path)
+                except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError):
+                    output.write(json.dumps({'path': path, 'error': 'Invalid image'}) + '\n')
+            if images:
+                pred = model.predict_on_batch(tf.stack(images))
+                for path, text in zip(valid, decode(np.asarray(pred))):
+                    output.write(json.dumps({'path': path, 'text': text}) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    timings['predict'] = time.perf_counter() - start
+
+    if args.timings:
+        _log(json.dumps({name: round(seconds, 3) for name, seconds in timings.items()}))
+
+
+def evaluate(args):
+    '''
+    Scores a model on a CSV split and prints the report.
+    '''
+
+    from handwritten_ocr.evaluation import build_eval_dataset, evaluate as run, format_report, save_report
+
+    paths, texts = _read_split(args.csv, args.image_dir, args.limit)
+    model, vocabulary = _load_model(args.model)
+    decode = _decoder(model, vocabulary, args.beam_width)
+
+    report = run(model, build_eval_dataset(paths, texts, args.batch_size), decode, verbose=False)
+    print(format_report(report))
+    if args.report:
+        save_report(report, args.report)
+
+
+def train(args):
+    '''
+    Trains a model from a CSV split and saves it, with its vocabulary, to ``args.model``.
+    '''
+
+    from handwritten_ocr.training import ThroughputLogger, set_training_mode
+
+    # The precision policy must be set before the model is built
+    config = set_training_mode(args.mode)
+
+    import tensorflow as tf
+    from tensorflow import keras
+
+    from handwritten_ocr.models import ARCHITECTURES, build_ocr_model
+    from handwritten_ocr.preprocessing import decode_image
+    from handwritten_ocr.vocabulary import load_or_create, vocabulary_path
+
+    paths, texts = _read_split(args.csv, args.image_dir, args.train_size)
+    vocabulary = load_or_create(vocabulary_path(args.model), texts)
+    max_length = vocabulary.max_label_length
+
+    def dataset(paths, texts, shuffle):
+        labels, _ = vocabulary.encode(texts, max_length)
+        data = tf.data.Dataset.from_tensor_slices((paths, labels))
+        if shuffle:
+            data = data.shuffle(1000)
+        data = data.map(
+            lambda path, label: {'image': decode_image(tf.io.read_file(path)), 'label': label},
+            num_parallel_calls=tf.data.AUTOTUNE
+        )
+        return data.batch(args.batch_size).prefetch(tf.data.AUTOTUNE)
+
+    train_ds = dataset(paths, texts, shuffle=True)
+    valid_ds = None
+    if args.valid_csv:
+        valid_ds = dataset(*_read_split(args.valid_csv, args.valid_image_dir or args.image_dir), shuffle=False)
+
+    model, _ = build_ocr_model(len(vocabulary) + 1, xla=config['xla'], **ARCHITECTURES[args.architecture])
+    if args.resume and os.path.exists(args.model):
+        model.load_weights(args.model)
+    model.compile(
+        optimizer=keras.optimizers.Adam(learning_rate=args.learning_rate), jit_compile=config['jit_compile']
+    )
+
+    callbacks = [ThroughputLogger(args.batch_size, name=args.mode)]
+    if valid_ds is not None:
+        callbacks += [
+            keras.callbacks.EarlyStopping(patience=10, restore_best_weights=True),
+            keras.callbacks.ModelCheckpoint(filepath=args.model, save_best_only=True),
+        ]
+    model.fit(train_ds, validation_data=valid_ds, epochs=args.epochs, callbacks=callbacks)
+    if valid_ds is None:
+        model.save(args.model)
+
+
+def measure_startup(command, runs : int = 5) -> dict:
+    '''
+    Measures the cold start of a command of this CLI against importing the notebook's modules, which
+    is only the first few seconds of running the notebook, and against starting the CLI alone.
+
+    Arguments :
+        command : The CLI arguments, e.g. ['predict', 'Handwritten-OCR.keras', 'image.jpg'].
+        runs    : The number of fresh interpreters timed for each.
+
+    Return:
+        report : Median and minimum wall seconds of the command, of the CLI alone (--help) and of the
+                 notebook imports, and the ratio of the command to the notebook imports.
+    '''
+
+    def timed(argv):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        times.sort()
+        return {'median_seconds': times[len(times) // 2], 'min_seconds': times[0]}
+
+    report = {
+        'command': timed([sys.executable, '-m', 'handwritten_ocr', *command]),
+        'cli_only': timed([sys.executable, '-m', 'handwritten_ocr', '--help']),
+        'notebook_imports': timed([sys.executable, '-c', NOTEBOOK_IMPORTS]),
+    }
+    report['ratio'] = report['command']['median_seconds'] / report['notebook_imports']['median_seconds']
+    return report
+
+
+def startup(args):
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    report = measure_startup(command, args.runs)
+    print(json.dumps(report, indent=2))
+
+
+def benchmark(args):
+    '''
+    Runs the benchmark suite and compares it with the baseline, which the first run stores. Exits with
+    status 1 when a benchmark regressed.
+    '''
+
+    from handwritten_ocr.benchmarks import compare, format_comparison, run_benchmarks
+
+    report = run_benchmarks(
+        args.data_dir, n_samples=args.samples, n_runs=args.runs,
+        batch_sizes=args.batch_sizes, architectures=args.architectures
+    )
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if not args.baseline:
+        return
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        _log(f'Baseline written to {args.baseline}')
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    try:
+        comparison = compare(report, baseline, args.tolerance)
+    except ValueError as error:
+        sys.exit(str(error))
+    print(format_comparison(comparison))
+    if comparison['regressions']:
+        sys.exit(1)
+
+
+def export(args):
+    '''
+    Exports a .keras checkpoint as a SavedModel taking raw JPEG bytes and returning strings.
+    '''
+
+    from handwritten_ocr.export import export_saved_model
+    from handwritten_ocr.models import load_inference_model
+    from handwritten_ocr.vocabulary import Vocabulary, vocabulary_path
+
+    vocabulary = Vocabulary.load(vocabulary_path(args.model))
+    export_saved_model(load_inference_model(args.model), vocabulary, args.path, max_length=args.max_length)
+    _log(f'SavedModel written to {args.path}')
+
+
+def batch(args):
+    '''
+    Transcribes a directory, glob or manifest of images into a JSON lines or CSV file, resumably.
+    '''
+
+    from handwritten_ocr.batch import run_batch
+
+    report = run_batch(
+        args.model, args.source, args.output, n_workers=args.workers, chunk_size=args.chunk_size,
+        batch_size=args.batch_size, beam_width=args.beam_width, cache_dir=args.cache_dir,
+    )
+    _log(
+        f"{report['transcribed']} transcribed, {report['errors']} errors, {report['skipped']} already done "
+        f"of {report['inputs']} images, {report['images_per_second']:.1f} images/s"
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m handwritten_ocr', description='Handwritten OCR.')
+    commands = parser.add_subparsers(dest='command_name', required=True)
+
+    command = commands.add_parser('predict', help='read the text of images')
+    command.add_argument('model', help='.keras training checkpoint or .tflite artifact')
+    command.add_argument('images', nargs='+', help='JPEG files')
+    command.add_argument('--batch-size', type=int, default=64)
+    command.add_argument('--beam-width', type=int, default=1, help='beam search width, 1 for greedy decoding')
+    command.add_argument('--output', help='JSON lines file, standard output by default')
+    command.add_argument('--timings', action='store_true', help='print the time of each stage to standard error')
+    command.set_defaults(run=predict)
+
+    command = commands.add_parser('evaluate', help='score a model on a CSV split')
+    command.add_argument('model', help='.keras training checkpoint or .tflite artifact')
+    command.add_argument('--csv', required=True, help='written_name_*.csv file')
+    command.add_argument('--image-dir', required=True)
+    command.add_argument('--batch-size', type=int, default=64)
+    command.add_argument('--beam-width', type=int, default=1)
+    command.add_argument('--limit', type=int, help='number of rows evaluated')
+    command.add_argument('--report', help='JSON report file')
+    command.set_defaults(run=evaluate)
+
+    command = commands.add_parser('train', help='train a model')
+    command.add_argument('--csv', required=True, help='written_name_train.csv file')
+    command.add_argument('--image-dir', required=True)
+    command.add_argument('--valid-csv')
+    command.add_argument('--valid-image-dir')
+    command.add_argument('--model', default='Handwritten-OCR.keras', help='.keras file written')
+    command.add_argument('--architecture', choices=('small', 'large'), default='small')
+    command.add_argument('--mode', choices=('float32', 'mixed', 'xla', 'mixed_xla'), default='float32')
+    command.add_argument('--epochs', type=int, default=9)
+    command.add_argument('--batch-size', type=int, default=16)
+    command.add_argument('--learning-rate', type=float, default=1e-3)
+    command.add_argument('--train-size', type=int, help='number of rows used')
+    command.add_argument('--resume', action='store_true', help='start from the weights of --model')
+    command.set_defaults(run=train)
+
+    command = commands.add_parser('startup', help='measure the cold start of a command')
+    command.add_argument('--runs', type=int, default=5)
+    command.add_argument('command', nargs=argparse.REMAINDER, help='the command to time, after --')
+    command.set_defaults(run=startup)
+
+    command = commands.add_parser('benchmark', help='time the data functions, models and decoder')
+    command.add_argument('--data-dir', default='benchmark-data', help='synthetic images, generated when missing')
+    command.add_argument('--samples', type=int, default=512)
+    command.add_argument('--runs', type=int, default=10)
+    command.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128, 512])
+    command.add_argument('--architectures', nargs='+', choices=('small', 'large'), default=['small', 'large'])
+    command.add_argument('--output', help='JSON report file')
+    command.add_argument('--baseline', help='JSON baseline report, written by the first run')
+    command.add_argument('--update-baseline', action='store_true', help='replace the baseline with this run')
+    command.add_argument('--tolerance', type=float, default=0.15, help='relative slowdown flagged as a regression')
+    command.set_defaults(run=benchmark)
+
+    command = commands.add_parser('export', help='export a SavedModel reading JPEG bytes end to end')
+    command.add_argument('model', help='.keras training checkpoint')
+    command.add_argument('path', help='SavedModel directory written')
+    command.add_argument('--max-length', type=int, help='characters per prediction, by default the vocabulary\'s')
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('batch', help='transcribe a directory of images with a process pool, resumably')
+    command.add_argument('model', help='.keras training checkpoint or .tflite artifact')
+    command.add_argument('source', help='directory, glob pattern, or manifest (.csv with FILENAME, or one path per line)')
+    command.add_argument('--output', required=True, help='.jsonl or .csv file, appended to and skipped on restart')
+    command.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    command.add_argument('--chunk-size', type=int, default=512, help='images per worker task')
+    command.add_argument('--batch-size', type=int, default=64)
+    command.add_argument('--beam-width', type=int, default=1)
+    command.add_argument('--cache-dir', help='prediction cache directory, consulted before running the model')
+    command.set_defaults(run=batch)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
@@ -0,0 +1,464 @@
+'''
+CTC decoding of the OCR model's per-timestep softmax outputs.
+
+``GreedyDecoder`` is a fully batched NumPy replacement for the notebook's original ``decode_pred``,
+which went through ``keras.backend.ctc_decode``, the ``num_to_char`` StringLookup and a per-sample
+``tf.strings.reduce_join``. It returns exactly the same strings: best path per time step, repeats
+collapsed, blanks dropped, at most ``max_length`` characters, ``[UNK]`` shown as a space and the
+result stripped.
+
+``BeamSearchDecoder`` runs a CTC prefix beam search, optionally constrained to a lexicon of names held
+in a ``Trie``. Samples whose best path is already confident are decoded greedily, and the remaining
+ones are searched in parallel worker processes, so the extra cost over greedy decoding is only paid
+where the beam can change the answer. Its confidence of a searched sample is the probability of the
+decoded labelling, summed over the alignments kept in the beam, rather than that of the best path.
+'''
+
+import heapq
+import multiprocessing
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Out of vocabulary token of the StringLookup layers
+OOV_TOKEN = '[UNK]'
+
+
+class GreedyDecoder:
+
+    '''
+    Batched greedy CTC decoder with a precomputed character table.
+
+    Arguments :
+        vocabulary : The vocabulary of the char_to_num StringLookup, index 0 being '[UNK]'. The blank
+                     class is the one after the last vocabulary entry, as in the OCR models.
+        max_length : The maximum number of characters kept per prediction (MAX_LABEL_LENGTH).
+    '''
+
+    def __init__(self, vocabulary, max_length : int) -> None:
+
+        vocabulary = list(vocabulary)
+        self.vocabulary = vocabulary
+        self.max_length = max_length
+        self.blank = len(vocabulary)
+
+        # Every vocabulary entry is a single code point (labels are split with unicode_split), except
+        # the OOV token which decode_pred rendered as a space.
+        table = [' ' if token == OOV_TOKEN else token for token in vocabulary]
+        if any(len(token) != 1 for token in table):
+            raise ValueError('Every vocabulary entry must be a single character')
+        self.table = np.array([ord(token) for token in table] + [0], dtype=np.uint32)
+
+    def best_path(self, pred):
+        '''
+        Returns the argmax class of every time step.
+
+        Argument :
+            pred : The model output of shape (batch, time steps, classes).
+
+        Return:
+            best : An int array of shape (batch, time steps).
+        '''
+
+        return np.asarray(pred).argmax(axis=-1)
+
+    def collapse(self, best):
+        '''
+        Applies the CTC collapse rule to best paths: repeated classes are merged, then blanks removed.
+
+        Argument :
+            best : The best path class indices, of shape (batch, time steps).
+
+        Return:
+            keep : A boolean mask of the time steps that emit a character.
+        '''
+
+        keep = best != self.blank
+        keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+        return keep
+
+    def to_strings(self, best, keep):
+        '''
+        Turns the emitted classes into strings in one vectorized pass: the characters are scattered
+        into a fixed width array of code points which is then viewed as a NumPy unicode array.
+
+        Arguments :
+            best : The best path class indices, of shape (batch, time steps).
+            keep : The emit mask returned by ``collapse``.
+
+        Return:
+            texts : The list of decoded strings.
+        '''
+
+        n_samples = best.shape[0]
+        position = np.cumsum(keep, axis=1) - 1
+        keep = keep & (position < self.max_length)
+
+        rows, cols = np.nonzero(keep)
+        codes = np.zeros((n_samples, max(self.max_length, 1)), dtype=np.uint32)
+        codes[rows, position[rows, cols]] = self.table[best[rows, cols]]
+
+        texts = codes.view(f'<U{codes.shape[1]}').reshape(n_samples)
+        return np.char.strip(texts).tolist()
+
+    def __call__(self, pred, input_length = None):
+        '''
+        Decodes a batch of model predictions.
+
+        Arguments :
+            pred         : The model output of shape (batch, time steps, classes).
+            input_length : Optional number of valid time steps per sample, for variable width inputs
+                           padded within their batch; later time steps are ignored.
+
+        Return:
+            texts : The list of decoded strings, one per sample.
+        '''
+
+        best = self.best_path(pred)
+        keep = self.collapse(best)
+        if input_length is not None:
+            input_length = np.asarray(input_length).reshape(-1, 1)
+            keep &= np.arange(best.shape[1]) < input_length
+        return self.to_strings(best, keep)
+
+    def confidence(self, pred, input_length = None):
+        '''
+        Returns the probability of the best path of every sample, the product over the time steps of
+        the highest class probability, as in the exported SavedModel.
+
+        Arguments :
+            pred         : The model output of shape (batch, time steps, classes).
+            input_length : Optional number of valid time steps per sample; later time steps are ignored.
+
+        Return:
+            confidences : A float32 array of shape (batch,), between 0 and 1.
+        '''
+
+        log_max = np.log(np.maximum(np.asarray(pred).max(axis=-1).astype(np.float64), 1e-30))
+        if input_length is not None:
+            input_length = np.asarray(input_length).reshape(-1, 1)
+            log_max = np.where(np.arange(log_max.shape[1]) < input_length, log_max, 0.0)
+        return np.exp(log_max.sum(axis=1)).astype(np.float32)
+
+    def decode_with_confidence(self, pred, input_length = None):
+        '''
+        Decodes a batch of model predictions with their confidences.
+
+        Arguments :
+            pred         : The model output of shape (batch, time steps, classes).
+            input_length : Optional number of valid time steps per sample.
+
+        Returns:
+            texts       : The list of decoded strings, one per sample.
+            confidences : The best path probabilities, see ``confidence``.
+        '''
+
+        texts = self(pred) if input_length is None else self(pred, input_length)
+        return texts, self.confidence(pred, input_length)
+
+
+class Trie:
+
+    '''
+    Prefix tree over label class indices, used to restrict beam search to known words.
+    Nodes are dictionaries mapping a class index to the child node; the END key marks a complete word.
+    '''
+
+    END = -1
+
+    def __init__(self) -> None:
+        self.root = {}
+        self.words = set()
+
+    def add(self, word : str, char_index : dict) -> bool:
+        '''
+        Adds a word, skipping it if it contains characters outside the vocabulary.
+
+        Arguments :
+            word       : The word to add.
+            char_index : Mapping of character to class index.
+
+        Return:
+            added : Whether the word was added.
+        '''
+
+        if not word or any(char not in char_index for char in word):
+            return False
+        node = self.root
+        for char in word:
+            node = node.setdefault(char_index[char], {})
+        node[self.END] = True
+        self.words.add(word)
+        return True
+
+    @classmethod
+    def from_words(cls, words, vocabulary):
+        '''
+        Builds a trie from label strings, e.g. the IDENTITY column of the training CSV.
+
+        Arguments :
+            words      : The label strings.
+            vocabulary : The char_to_num vocabulary.
+
+        Return:
+            trie : The populated trie.
+        '''
+
+        char_index = {char: index for index, char in enumerate(vocabulary) if char != OOV_TOKEN}
+        trie = cls()
+        for word in words:
+            trie.add(str(word).strip(), char_index)
+        return trie
+
+
+# Decoder used by the worker processes of BeamSearchDecoder, set once per process
+_worker_decoder = None
+
+
+def _init_worker(decoder):
+    global _worker_decoder
+    _worker_decoder = decoder
+
+
+def _search_chunk(probs):
+    return [_worker_decoder.search_with_probability(sample) for sample in probs]
+
+
+class BeamSearchDecoder(GreedyDecoder):
+
+    '''
+    CTC prefix beam search decoder, optionally constrained to a lexicon.
+
+    Arguments :
+        vocabulary       : The vocabulary of the char_to_num StringLookup, index 0 being '[UNK]'.
+        max_length       : The maximum number of characters per prediction (MAX_LABEL_LENGTH).
+        beam_width       : The number of prefixes kept after every time step.
+        prune_threshold  : Characters with a probability below this at a time step are not considered
+                           as extensions at that step.
+        greedy_threshold : Samples whose best path has at least this probability at every time step are
+                           decoded greedily (and, with a lexicon, only if the result is a lexicon word).
+                           Set it above 1 to always run the beam search.
+        lexicon          : Optional iterable of words, or a Trie, restricting the output to known words.
+        num_workers      : The number of worker processes; 1 searches in the calling process.
+    '''
+
+    def __init__(
+        self,
+        vocabulary,
+        max_length : int,
+        beam_width : int = 10,
+        prune_threshold : float = 1e-3,
+        greedy_threshold : float = 0.99,
+        lexicon = None,
+        num_workers : int = None,
+    ) -> None:
+
+        super().__init__(vocabulary, max_length)
+
+        self.beam_width = beam_width
+        self.prune_threshold = prune_threshold
+        self.greedy_threshold = greedy_threshold
+        if lexicon is not None and not isinstance(lexicon, Trie):
+            lexicon = Trie.from_words(lexicon, self.vocabulary)
+        self.trie = lexicon
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+    def _text(self, prefix) -> str:
+        return ''.join(chr(self.table[index]) for index in prefix).strip()
+
+    def search(self, probs):
+        '''
+        Runs the prefix beam search on one sample.
+
+        Argument :
+            probs : The softmax output of one sample, of shape (time steps, classes).
+
+        Return:
+            text : The decoded string.
+        '''
+
+        return self.search_with_probability(probs)[0]
+
+    def search_with_probability(self, probs):
+        '''
+        Runs the prefix beam search on one sample, also returning the probability of the result.
+
+        Argument :
+            probs : The softmax output of one sample, of shape (time steps, classes).
+
+        Returns:
+            text        : The decoded string.
+            probability : The probability of its labelling, summed over the alignments kept in the beam.
+        '''
+
+        probs = np.asarray(probs, dtype=np.float64)
+        blank = self.blank
+        constrained = self.trie is not None
+
+        # prefix -> [probability ending in blank, probability ending in a character]
+        beams = {(): (1.0, 0.0)}
+        nodes = {(): self.trie.root if constrained else None}
+        log_scale = 0.0
+
+        for row in probs:
+            p_blank = row[blank]
+            chars = [int(c) for c in np.flatnonzero(row >= self.prune_threshold) if c != blank]
+
+            next_beams = defaultdict(lambda: [0.0, 0.0])
+            next_nodes = {}
+            for prefix, (pb, pnb) in beams.items():
+                total = pb + pnb
+                node = nodes[prefix]
+
+                # Stay on the same prefix: emit a blank, or repeat the last character
+                entry = next_beams[prefix]
+                entry[0] += total * p_blank
+                last = prefix[-1] if prefix else None
+                if last is not None:
+                    entry[1] += pnb * row[last]
+                next_nodes[prefix] = node
+
+                if len(prefix) >= self.max_length:
+                    continue
+
+                # Extend the prefix by one character
+                for char in chars:
+                    if constrained:
+                        child = node.get(char)
+                        if child is None:
+                            continue
+                    else:
+                        child = None
+                    # A repeated character only starts a new symbol after a blank
+                    extension = pb * row[char] if char == last else total * row[char]
+                    new_prefix = prefix + (char,)
+                    next_beams[new_prefix][1] += extension
+                    next_nodes[new_prefix] = child
+
+            kept = heapq.nlargest(
+                self.beam_width, next_beams.items(), key=lambda item: item[1][0] + item[1][1]
+            )
+
+            # Renormalize so that long sequences do not underflow
+            norm = sum(pb + pnb for _, (pb, pnb) in kept) or 1.0
+            beams = {prefix: (pb / norm, pnb / norm) for prefix, (pb, pnb) in kept}
+            nodes = {prefix: next_nodes[prefix] for prefix in beams}
+            log_scale += np.log(norm)
+
+        ranked = sorted(beams, key=lambda prefix: sum(beams[prefix]), reverse=True)
+        best = ranked[0]
+        if constrained:
+            complete = [prefix for prefix in ranked if Trie.END in nodes[prefix]]
+            if complete:
+                best = complete[0]
+        probability = float(np.exp(np.log(max(sum(beams[best]), 1e-300)) + log_scale))
+        return self._text(best), min(probability, 1.0)
+
+    def _parallel_search(self, probs):
+        if self.num_workers <= 1 or len(probs) < 2 * self.num_workers:
+            return [self.search_with_probability(sample) for sample in probs]
+
+        if self._executor is None:
+            # Spawned workers only import NumPy, not whatever the parent process has loaded
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self,),
+            )
+
+        # The samples may have different numbers of time steps, so they are split as a list
+        parts = np.array_split(np.arange(len(probs)), self.num_workers * 4)
+        chunks = [[probs[index] for index in part] for part in parts]
+        results = []
+        for result in self._executor.map(_search_chunk, chunks):
+            results.extend(result)
+        return results
+
+    def close(self):
+        '''
+        Shuts down the worker processes.
+        '''
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _decode(self, pred, input_length = None):
+        '''
+        Decodes greedily, then searches the samples that are not confident.
+
+        Returns:
+            texts   : The list of decoded strings, one per sample.
+            pending : The indices of the searched samples.
+            results : The (text, probability) pair of every searched sample.
+        '''
+
+        pred = np.asarray(pred)
+        best = self.best_path(pred)
+        keep = self.collapse(best)
+        max_prob = pred.max(axis=-1)
+        lengths = np.full(len(pred), pred.shape[1])
+        if input_length is not None:
+            lengths = np.asarray(input_length).reshape(-1)
+            valid = np.arange(pred.shape[1]) < lengths.reshape(-1, 1)
+            keep &= valid
+            max_prob = np.where(valid, max_prob, 1.0)
+        texts = self.to_strings(best, keep)
+
+        confident = max_prob.min(axis=-1) >= self.greedy_threshold
+        if self.trie is not None:
+            confident &= np.array([text in self.trie.words for text in texts], dtype=bool)
+
+        pending = np.flatnonzero(~confident)
+        results = []
+        if len(pending):
+            results = self._parallel_search([pred[index, :lengths[index]] for index in pending])
+        for index, (text, _) in zip(pending, results):
+            texts[index] = text
+        return texts, pending, results
+
+    def __call__(self, pred, input_length = None):
+        '''
+        Decodes a batch of model predictions.
+
+        Arguments :
+            pred         : The model output of shape (batch, time steps, classes).
+            input_length : Optional number of valid time steps per sample, for variable width inputs
+                           padded within their batch; later time steps are ignored.
+
+        Return:
+            texts : The list of decoded strings, one per sample.
+        '''
+
+        return self._decode(pred, input_length)[0]
+
+    def decode_with_confidence(self, pred, input_length = None):
+        '''
+        Decodes a batch of model predictions with their confidences. The samples decoded greedily keep
+        the probability of their best path, as with GreedyDecoder; the searched ones get the probability
+        of the labelling found, summed over the alignments kept in the beam, which is at least the
+        probability of any single path to it.
+
+        Arguments :
+            pred         : The model output of shape (batch, time steps, classes).
+            input_length : Optional number of valid time steps per sample.
+
+        Returns:
+            texts       : The list of decoded strings, one per sample.
+            confidences : A float32 array of shape (batch,), between 0 and 1.
+        '''
+
+        texts, pending, results = self._decode(pred, input_length)
+        confidences = self.confidence(pred, input_length)
+        for index, (_, probability) in zip(pending, results):
+            confidences[index] = probability
+        return texts, confidences
@@ -0,0 +1,295 @@
+'''
+Knowledge distillation of the large OCR model into a compact student meeting a CPU latency budget.
+
+``ocr_model_2`` is accurate but costly per image on CPU. A much smaller student learns from the
+teacher's per-timestep softmax outputs as well as from the labels: ``Distiller`` trains it on
+
+    (1 - alpha) * CTC loss  +  alpha * temperature**2 * KL(teacher || student)
+
+where the KL divergence is taken between the teacher and student distributions softened by
+``temperature`` at every time step and summed over the time steps, like the CTC loss. The soft targets
+carry how confusable the characters are and where the teacher puts its blanks, which a small model
+learns from much faster than from the labels alone.
+
+The student is chosen for a latency budget : ``select_student`` builds the candidates of ``STUDENTS``
+(thinner and depthwise separable convolutions, one small bidirectional GRU), measures their per-image
+latency, which does not depend on the weights, and keeps the largest one within the budget.
+``latency_report`` then scores the teacher and the trained student on CER against latency.
+
+    name, student, student_inference, history = distill(inference_model_2, n_outputs, train_ds, latency_budget_ms=5)
+'''
+
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.evaluation import evaluate
+from handwritten_ocr.models import build_ocr_model
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH
+
+# Student candidates, from the largest to the smallest; both keep two pooled blocks, so they have the
+# teacher's number of time steps
+STUDENTS = {
+    'student_m': {
+        'conv_filters': ((32,), (64,)),
+        'dense_units': (64,),
+        'dropout': 0.2,
+        'lstm_units': (96,),
+        'encoder': 'gru',
+        'separable': True,
+    },
+    'student_s': {
+        'conv_filters': ((16,), (32,)),
+        'dense_units': (64,),
+        'dropout': 0.2,
+        'lstm_units': (64,),
+        'encoder': 'gru',
+        'separable': True,
+    },
+    'student_xs': {
+        'conv_filters': ((16,), (32,)),
+        'dense_units': (32,),
+        'dropout': 0.1,
+        'lstm_units': (32,),
+        'encoder': 'gru',
+        'separable': True,
+    },
+}
+
+# Weight of the distillation loss against the CTC loss
+ALPHA = 0.5
+
+# Softening of the teacher and student distributions
+TEMPERATURE = 2.0
+
+
+def per_image_latency(model, images, n_runs : int = 20) -> float:
+    '''
+    Returns the median time of one image predicted on its own, in milliseconds, after a warm-up.
+
+    Arguments :
+        model  : The inference model.
+        images : A few images in the model layout; they are predicted one at a time, round robin.
+        n_runs : The number of timed predictions.
+    '''
+
+    images = np.asarray(images, dtype=np.float32)
+    model.predict_on_batch(images[:1])
+    times = []
+    for run in range(n_runs):
+        image = images[run % len(images)][None]
+        start = time.perf_counter()
+        model.predict_on_batch(image)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def select_student(
+    n_outputs : int,
+    latency_budget_ms : float,
+    images,
+    candidates : dict = None,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Picks the largest student candidate whose per-image latency fits the budget.
+
+    Arguments :
+        n_outputs         : The size of the softmax output, as for build_ocr_model.
+        latency_budget_ms : The per-image latency budget, in milliseconds.
+        images            : A few images to time the candidates on.
+        candidates        : Mapping of name to build_ocr_model settings, largest first; STUDENTS by default.
+        img_height        : The image height.
+        img_width         : The image width.
+
+    Returns:
+        name       : The chosen candidate; the smallest one when none fits.
+        config     : Its build_ocr_model settings.
+        latency_ms : Mapping of every candidate timed to its latency.
+    '''
+
+    candidates = STUDENTS if candidates is None else candidates
+    latency_ms = {}
+    for name, config in candidates.items():
+        _, inference_model = build_ocr_model(n_outputs, img_height=img_height, img_width=img_width, **config)
+        latency_ms[name] = per_image_latency(inference_model, images)
+        if latency_ms[name] <= latency_budget_ms:
+            return name, config, latency_ms
+    return name, config, latency_ms
+
+
+class Distiller(keras.Model):
+
+    '''
+    Trains a student on the CTC loss and on the teacher's softened per-timestep outputs.
+
+    Arguments :
+        student     : The student training model of build_ocr_model, with its CTC layer.
+        teacher     : The teacher inference model, mapping images to per-timestep probabilities.
+        alpha       : The weight of the distillation loss; 0 trains on the labels only.
+        temperature : The softening of both distributions.
+    '''
+
+    def __init__(self, student, teacher, alpha : float = ALPHA, temperature : float = TEMPERATURE, **kwargs) -> None:
+        super().__init__(**kwargs)
+        if student.output_shape[1] != teacher.output_shape[1]:
+            raise ValueError(
+                f'The student has {student.output_shape[1]} time steps and the teacher {teacher.output_shape[1]}'
+            )
+        self.student = student
+        # Only the student's variables are updated; the teacher is left trainable, since its layers
+        # may be shared with a training model
+        self.teacher = teacher
+        self.alpha = alpha
+        self.temperature = temperature
+        self.loss_tracker = keras.metrics.Mean(name='loss')
+        self.ctc_tracker = keras.metrics.Mean(name='ctc_loss')
+        self.distillation_tracker = keras.metrics.Mean(name='distillation_loss')
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.ctc_tracker, self.distillation_tracker]
+
+    def call(self, batch, training=False):
+        return self.student(batch, training=training)
+
+    def _soften(self, probs):
+        # Softmax of the logits divided by the temperature, from the probabilities
+        return tf.nn.log_softmax(tf.math.log(probs + 1e-9) / self.temperature, axis=-1)
+
+    def _distillation_losses(self, batch, training : bool):
+        teacher_probs = self.teacher(batch['image'], training=False)
+        student_probs = self.student(batch, training=training)
+        ctc_loss = tf.reduce_mean(tf.add_n(self.student.losses))
+
+        teacher_log = self._soften(tf.cast(teacher_probs, tf.float32))
+        student_log = self._soften(tf.cast(student_probs, tf.float32))
+        kl = tf.reduce_sum(tf.exp(teacher_log) * (teacher_log - student_log), axis=-1)
+        distillation_loss = tf.reduce_mean(tf.reduce_sum(kl, axis=-1)) * self.temperature ** 2
+
+        loss = (1 - self.alpha) * ctc_loss + self.alpha * distillation_loss
+        return loss, ctc_loss, distillation_loss
+
+    def _track(self, loss, ctc_loss, distillation_loss):
+        self.loss_tracker.update_state(loss)
+        self.ctc_tracker.update_state(ctc_loss)
+        self.distillation_tracker.update_state(distillation_loss)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+    def train_step(self, batch):
+        with tf.GradientTape() as tape:
+            losses = self._distillation_losses(batch, training=True)
+        variables = self.student.trainable_variables
+        gradients = tape.gradient(losses[0], variables)
+        self.optimizer.apply_gradients(zip(gradients, variables))
+        return self._track(*losses)
+
+    def test_step(self, batch):
+        return self._track(*self._distillation_losses(batch, training=False))
+
+
+def distill(
+    teacher,
+    n_outputs : int,
+    dataset,
+    latency_budget_ms : float,
+    validation_data = None,
+    epochs : int = 5,
+    learning_rate : float = 1e-3,
+    alpha : float = ALPHA,
+    temperature : float = TEMPERATURE,
+    candidates : dict = None,
+    callbacks = None,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Chooses a student for the latency budget and distills the teacher into it.
+
+    Arguments :
+        teacher           : The teacher inference model, e.g. inference_model_2.
+        n_outputs         : The size of the softmax output, len(char_to_num.get_vocabulary()) + 1.
+        dataset           : The training dataset of {'image', 'label'} batches.
+        latency_budget_ms : The per-image CPU latency budget of the student, in milliseconds.
+        validation_data   : An optional validation dataset of the same batches.
+        epochs            : The number of epochs.
+        learning_rate     : The Adam learning rate.
+        alpha             : The weight of the distillation loss.
+        temperature       : The softening of the distributions.
+        candidates        : The student candidates, see ``select_student``.
+        callbacks         : Keras callbacks of the training.
+        img_height        : The image height.
+        img_width         : The image width.
+
+    Returns:
+        name              : The chosen student candidate.
+        student           : The trained student training model, with its CTC layer.
+        student_inference : The student inference model.
+        history           : The training History.
+    '''
+
+    images = next(iter(dataset))['image'].numpy()
+    name, config, latency_ms = select_student(
+        n_outputs, latency_budget_ms, images, candidates, img_height=img_height, img_width=img_width
+    )
+    print(f'Student {name} : {latency_ms[name]:.2f} ms per image (budget {latency_budget_ms} ms)')
+
+    student, student_inference = build_ocr_model(n_outputs, img_height=img_height, img_width=img_width, **config)
+    distiller = Distiller(student, teacher, alpha=alpha, temperature=temperature)
+    distiller.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate))
+    history = distiller.fit(dataset, validation_data=validation_data, epochs=epochs, callbacks=callbacks)
+    return name, student, student_inference, history
+
+
+def latency_report(models : dict, dataset, decode, latency_budget_ms : float = None, n_runs : int = 20) -> dict:
+    '''
+    Scores models on CER against per-image latency.
+
+    Arguments :
+        models            : Mapping of name to inference model, the reference (the teacher) first.
+        dataset           : An evaluation dataset of (images, texts) batches, see ``build_eval_dataset``.
+        decode            : The batched decoding function, e.g. decode_pred.
+        latency_budget_ms : The budget the models are checked against, if any.
+        n_runs            : The number of timed predictions per model.
+
+    Return:
+        report : Mapping of name to parameters, latency, speedup over the reference, CER, exact match,
+                 the share of the reference's accuracy kept and whether the budget is met.
+    '''
+
+    images = next(iter(dataset))[0].numpy()
+
+    report = {}
+    for name, model in models.items():
+        metrics = evaluate(model, dataset, decode, verbose=False)
+        report[name] = {
+            'parameters': model.count_params(),
+            'latency_ms': per_image_latency(model, images, n_runs),
+            'cer': metrics['cer'],
+            'exact_match': metrics['exact_match'],
+        }
+
+    reference = report[next(iter(report))]
+    for row in report.values():
+        row['speedup'] = reference['latency_ms'] / row['latency_ms']
+        row['accuracy_kept'] = (1 - row['cer']) / max(1 - reference['cer'], 1e-9)
+        row['within_budget'] = None if latency_budget_ms is None else row['latency_ms'] <= latency_budget_ms
+    return report
+
+
+def format_latency_report(report : dict) -> str:
+    '''
+    Formats the report of ``latency_report`` as a text table.
+    '''
+
+    lines = [f"{'Model':<14}{'Params':>10}{'ms/image':>10}{'Speedup':>9}{'CER':>8}{'Exact':>8}{'Kept':>8}  Budget"]
+    for name, row in report.items():
+        budget = '' if row['within_budget'] is None else ('ok' if row['within_budget'] else 'over')
+        lines.append(
+            f"{name:<14}{row['parameters']:>10}{row['latency_ms']:>10.2f}{row['speedup']:>9.2f}"
+            f"{row['cer']:>8.4f}{row['exact_match']:>8.4f}{row['accuracy_kept']:>8.2%}  {budget}"
+        )
+    return '\n'.join(lines)
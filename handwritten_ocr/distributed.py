@@ -0,0 +1,393 @@
+'''
+Multi-process data parallel training.
+
+One Python process trains the small BiLSTM steps on a handful of cores however many the machine has.
+``launch`` starts N worker processes under ``tf.distribute.MultiWorkerMirroredStrategy``: every worker
+holds a replica of the model, reads its own shard of the training CSV and the gradients are
+all-reduced after every step, so one step processes N batches. Workers can also run on other hosts:
+``launch`` starts the tasks listed for this machine and prints the command to run on the others.
+
+The job is a JSON serializable dictionary (see ``training_job``). The chief worker (task 0) writes the
+trained model to ``job['checkpoint']`` as a regular ``.keras`` file with the same layers as the
+notebook's ``ocr_model``, so it loads with ``ocr_model.load_weights`` (or ``keras.models.load_model``
+with ``custom_objects={'CTCLayer': CTCLayer}``), and a job can start from an existing
+``Handwritten-OCR.keras`` through ``job['initial_checkpoint']``. ``scaling_report`` trains with
+increasing worker counts and reports the throughput and scaling efficiency.
+
+Worker command (normally run by ``launch``) :
+    python -m handwritten_ocr.distributed job.json --workers host1:port host2:port --task 0
+'''
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.models import ARCHITECTURES, build_ocr_model
+from handwritten_ocr.preprocessing import decode_image
+from handwritten_ocr.training import ThroughputLogger
+from handwritten_ocr.vocabulary import Vocabulary
+
+# Host names served by the processes started locally
+LOCAL_HOSTS = ('localhost', '127.0.0.1', socket.gethostname())
+
+
+def training_job(
+    csv_path : str,
+    image_dir : str,
+    vocabulary,
+    max_label_length : int,
+    checkpoint : str,
+    architecture : str = 'small',
+    batch_size : int = 16,
+    epochs : int = 1,
+    learning_rate : float = 1e-3,
+    train_size : int = None,
+    initial_checkpoint : str = None,
+    seed : int = 2569,
+) -> dict:
+    '''
+    Describes a distributed training run.
+
+    Arguments :
+        csv_path           : The training CSV with the FILENAME and IDENTITY columns.
+        image_dir          : The directory of the training images.
+        vocabulary         : char_to_num.get_vocabulary(), so every worker encodes labels identically.
+        max_label_length   : The padded label length, MAX_LABEL_LENGTH.
+        checkpoint         : The .keras file the chief writes the trained model to.
+        architecture       : A key of ARCHITECTURES.
+        batch_size         : The batch size of each worker; a step trains on batch_size * workers images.
+        epochs             : The number of epochs.
+        learning_rate      : The Adam learning rate.
+        train_size         : The number of CSV rows used, None for all (TRAIN_SIZE).
+        initial_checkpoint : A .keras file (e.g. Handwritten-OCR.keras) whose weights training starts from.
+        seed               : The shuffle seed.
+
+    Return:
+        job : The job dictionary.
+    '''
+
+    return {
+        'csv_path': csv_path,
+        'image_dir': image_dir,
+        'vocabulary': list(vocabulary),
+        'max_label_length': int(max_label_length),
+        'checkpoint': checkpoint,
+        'architecture': architecture,
+        'batch_size': int(batch_size),
+        'epochs': int(epochs),
+        'learning_rate': float(learning_rate),
+        'train_size': train_size,
+        'initial_checkpoint': initial_checkpoint,
+        'seed': seed,
+    }
+
+
+def free_ports(n_ports : int):
+    '''
+    Returns ``n_ports`` TCP ports that are currently free on this machine.
+    '''
+
+    sockets = []
+    for _ in range(n_ports):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def worker_addresses(n_workers : int, hosts = None, base_port : int = None):
+    '''
+    Builds the worker addresses of a cluster.
+
+    Arguments :
+        n_workers : The number of workers.
+        hosts     : The hosts the workers are spread over round robin; None for this machine only.
+        base_port : The port of the first worker on each host; None picks free local ports.
+
+    Return:
+        workers : The 'host:port' address of every worker, task 0 (the chief) first.
+    '''
+
+    hosts = list(hosts or ['localhost'])
+    if base_port is None:
+        ports = iter(free_ports(n_workers))
+        return [f'{hosts[task % len(hosts)]}:{next(ports)}' for task in range(n_workers)]
+    return [f'{hosts[task % len(hosts)]}:{base_port + task // len(hosts)}' for task in range(n_workers)]
+
+
+def _load_split(job : dict):
+    csv = pd.read_csv(job['csv_path'])[:job['train_size']]
+    paths = np.array([os.path.join(job['image_dir'], filename) for filename in csv['FILENAME']])
+    labels = np.array([str(word) for word in csv['IDENTITY'].to_numpy()])
+    return paths, labels
+
+
+def worker_dataset(job : dict, n_workers : int, task_index : int):
+    '''
+    Builds the training dataset of one worker : the CSV rows are sharded by worker before any image is
+    read, so each image is decoded by exactly one worker.
+
+    Return:
+        dataset  : An endless dataset of {'image', 'label'} batches of job['batch_size'].
+        n_steps  : The number of synchronized steps making up one epoch.
+    '''
+
+    paths, labels = _load_split(job)
+
+    # The vocabulary starts with the OOV token; labels are padded with the CTC blank, n_classes + 1
+    vocabulary = Vocabulary(job['vocabulary'][1:])
+    label_ids, _ = vocabulary.encode(labels, job['max_label_length'])
+
+    def encode(path, label):
+        return {'image': decode_image(tf.io.read_file(path)), 'label': label}
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, label_ids)).shard(n_workers, task_index)
+
+    # Every worker must run the same number of steps, or the all-reduce of the last ones never completes
+    n_steps = len(paths) // (job['batch_size'] * n_workers)
+
+    dataset = dataset.shuffle(10000, seed=job['seed'] + task_index).repeat()
+    dataset = dataset.map(encode, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(job['batch_size'], drop_remainder=True).prefetch(tf.data.AUTOTUNE)
+    return dataset, n_steps
+
+
+def run_worker(job : dict, workers, task_index : int, report_path : str = None, intra_op_threads : int = None):
+    '''
+    Runs one worker of a multi-worker training job. Every worker of the cluster must be started with
+    the same job and worker list.
+
+    Arguments :
+        job              : The job dictionary of ``training_job``.
+        workers          : The 'host:port' addresses of all workers, see ``worker_addresses``.
+        task_index       : The index of this worker in ``workers``; 0 is the chief.
+        report_path      : Where the chief writes its throughput report as JSON.
+        intra_op_threads : The number of threads of each op; None lets TensorFlow decide.
+    '''
+
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': list(workers)},
+        'task': {'type': 'worker', 'index': task_index},
+    })
+
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    n_workers = len(workers)
+    is_chief = task_index == 0
+
+    dataset, n_steps = worker_dataset(job, n_workers, task_index)
+
+    # The rows are already sharded by worker
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    dataset = strategy.distribute_datasets_from_function(lambda _: dataset.with_options(options))
+
+    global_batch_size = job['batch_size'] * n_workers
+    with strategy.scope():
+        model, _ = build_ocr_model(len(job['vocabulary']) + 1, **ARCHITECTURES[job['architecture']])
+        if job.get('initial_checkpoint'):
+            model.load_weights(job['initial_checkpoint'])
+        optimizer = keras.optimizers.Adam(learning_rate=job['learning_rate'])
+        # Compiled so that the saved file carries the optimizer, like the notebook's checkpoint
+        model.compile(optimizer=optimizer)
+
+    # A plain distributed step rather than model.fit, whose multi-worker support varies across Keras
+    # versions. The CTC losses are averaged over the global batch; the optimizer all-reduces the gradients.
+    @tf.function
+    def train_step(batch):
+        def replica_step(batch):
+            with tf.GradientTape() as tape:
+                model(batch, training=True)
+                loss = tf.reduce_sum(tf.add_n(model.losses)) / global_batch_size
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, strategy.run(replica_step, args=(batch,)), axis=None)
+
+    logger = ThroughputLogger(global_batch_size, name=f'{n_workers} workers', verbose=is_chief)
+    iterator = iter(dataset)
+    losses = []
+    for epoch in range(job['epochs']):
+        logger.on_epoch_begin(epoch)
+        total = 0.0
+        for step in range(n_steps):
+            total += float(train_step(next(iterator)))
+            logger.on_train_batch_end(step)
+        losses.append(total / max(n_steps, 1))
+        logger.on_epoch_end(epoch)
+        if is_chief:
+            print(f'Epoch {epoch + 1}/{job["epochs"]} - loss: {losses[-1]:.4f}', flush=True)
+
+    # Saving may run collective ops, so every worker saves; only the chief writes to the real path
+    if is_chief:
+        model.save(job['checkpoint'])
+    else:
+        with tempfile.TemporaryDirectory() as save_dir:
+            model.save(os.path.join(save_dir, os.path.basename(job['checkpoint'])))
+
+    if is_chief and report_path:
+        # The first epoch includes tracing, so it is left out of the throughput when there are others
+        epochs = logger.history[1:] or logger.history
+        report = {
+            'workers': n_workers,
+            'global_batch_size': job['batch_size'] * n_workers,
+            'steps_per_epoch': n_steps,
+            'loss': losses[-1],
+            'samples_per_second': float(np.mean([epoch['samples_per_second'] for epoch in epochs])),
+            'epochs': logger.history,
+        }
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+def launch(
+    job : dict,
+    n_workers : int,
+    hosts = None,
+    base_port : int = None,
+    threads_per_worker : int = None,
+    log_dir : str = None,
+) -> dict:
+    '''
+    Trains a job with ``n_workers`` workers and waits for the local ones to finish.
+
+    Arguments :
+        job                : The job dictionary of ``training_job``.
+        n_workers          : The total number of workers.
+        hosts              : The hosts the workers are spread over; None runs them all on this machine.
+                             Workers of other hosts must be started there with the printed commands.
+        base_port          : The port of the first worker on each host; required with remote hosts.
+        threads_per_worker : The op threads of each worker; None splits this machine's cores evenly.
+        log_dir            : Where the job file, the worker logs and the report are written.
+
+    Return:
+        report : The chief's report : workers, global batch size, final loss and samples per second,
+                 or None when the chief runs on another host.
+    '''
+
+    if hosts and any(host not in LOCAL_HOSTS for host in hosts) and base_port is None:
+        raise ValueError('A base_port is needed to run workers on other hosts')
+
+    log_dir = log_dir or tempfile.mkdtemp(prefix='ocr-distributed-')
+    os.makedirs(log_dir, exist_ok=True)
+    job_path = os.path.join(log_dir, 'job.json')
+    report_path = os.path.join(log_dir, 'report.json')
+    with open(job_path, 'w') as file:
+        json.dump(job, file, indent=2)
+
+    workers = worker_addresses(n_workers, hosts, base_port)
+    local_tasks = [task for task, address in enumerate(workers) if address.rsplit(':', 1)[0] in LOCAL_HOSTS]
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // max(len(local_tasks), 1))
+
+    processes = []
+    for task, address in enumerate(workers):
+        command = [
+            sys.executable, '-m', 'handwritten_ocr.distributed', job_path,
+            '--workers', *workers, '--task', str(task), '--threads', str(threads),
+        ]
+        if task == 0:
+            command += ['--report', report_path]
+        if task not in local_tasks:
+            print(f'Run on {address.rsplit(":", 1)[0]} : {" ".join(command)}')
+            continue
+        log = open(os.path.join(log_dir, f'worker-{task}.log'), 'w')
+        processes.append((task, subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log))
+
+    # A failed worker leaves the others blocked in collectives, so they are stopped as soon as one fails
+    failed = []
+    while not failed and any(process.poll() is None for _, process, _ in processes):
+        failed = [task for task, process, _ in processes if process.poll() not in (None, 0)]
+        time.sleep(0.5)
+    failed = failed or [task for task, process, _ in processes if process.returncode != 0]
+    for _, process, log in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        log.close()
+    if failed:
+        raise RuntimeError(f'Workers {failed} failed, see the logs in {log_dir}')
+
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path) as file:
+        return json.load(file)
+
+
+def scaling_report(job : dict, worker_counts = (1, 2, 4), **launch_kwargs) -> dict:
+    '''
+    Trains the job with each worker count and reports how throughput scales.
+
+    Arguments :
+        job           : The job dictionary of ``training_job``.
+        worker_counts : The numbers of workers compared, the first one being the reference.
+        launch_kwargs : Passed on to ``launch``.
+
+    Return:
+        report : Mapping of worker count to samples per second, speedup over the reference and
+                 scaling efficiency (speedup divided by the relative number of workers).
+    '''
+
+    report = {}
+    for n_workers in worker_counts:
+        start = time.perf_counter()
+        result = launch(job, n_workers, **launch_kwargs)
+        report[n_workers] = {
+            'samples_per_second': result['samples_per_second'],
+            'loss': result['loss'],
+            'wall_seconds': time.perf_counter() - start,
+        }
+
+    base_workers = worker_counts[0]
+    base = report[base_workers]['samples_per_second']
+    for n_workers, row in report.items():
+        row['speedup'] = row['samples_per_second'] / base
+        row['efficiency'] = row['speedup'] / (n_workers / base_workers)
+    return report
+
+
+def format_scaling(report : dict) -> str:
+    '''
+    Formats the report of ``scaling_report`` as a text table.
+    '''
+
+    lines = [f"{'Workers':>7}{'Samples/s':>12}{'Speedup':>9}{'Efficiency':>12}{'Loss':>10}"]
+    for n_workers, row in report.items():
+        lines.append(
+            f"{n_workers:>7}{row['samples_per_second']:>12.1f}{row['speedup']:>9.2f}"
+            f"{row['efficiency']:>12.2%}{row['loss']:>10.3f}"
+        )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run one worker of a multi-worker training job.')
+    parser.add_argument('job', help='job JSON file written by launch')
+    parser.add_argument('--workers', nargs='+', required=True, help='host:port of every worker, chief first')
+    parser.add_argument('--task', type=int, required=True, help='index of this worker')
+    parser.add_argument('--threads', type=int, help='op threads of this worker')
+    parser.add_argument('--report', help='JSON report written by the chief')
+    args = parser.parse_args(argv)
+
+    with open(args.job) as file:
+        job = json.load(file)
+    run_worker(job, args.workers, args.task, report_path=args.report, intra_op_threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+Streaming evaluation of the OCR models.
+
+``evaluate`` runs a model one batch at a time and decodes every batch as soon as it is predicted, so
+only one batch of probabilities is ever held in memory, however large the split. ``OCRMetrics``
+accumulates character error rate, word error rate and exact match as it goes, overall and broken down
+by the length of the true label.
+'''
+
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+
+
+def edit_distance(source, target) -> int:
+    '''
+    Computes the Levenshtein distance between two sequences (strings or lists of words).
+
+    Arguments :
+        source : The predicted sequence.
+        target : The true sequence.
+
+    Return:
+        distance : The minimum number of insertions, deletions and substitutions.
+    '''
+
+    if len(source) < len(target):
+        source, target = target, source
+    previous = list(range(len(target) + 1))
+    for i, item in enumerate(source, start=1):
+        current = [i]
+        for j, other in enumerate(target, start=1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (item != other),
+            ))
+        previous = current
+    return previous[-1]
+
+
+class _Counts:
+
+    def __init__(self) -> None:
+        self.samples = 0
+        self.exact = 0
+        self.char_errors = 0
+        self.chars = 0
+        self.word_errors = 0
+        self.words = 0
+
+    def add(self, truth : str, pred : str):
+        truth_words, pred_words = truth.split(), pred.split()
+        self.samples += 1
+        self.exact += truth == pred
+        self.char_errors += edit_distance(pred, truth)
+        self.chars += len(truth)
+        self.word_errors += edit_distance(pred_words, truth_words)
+        self.words += len(truth_words)
+
+    def result(self) -> dict:
+        return {
+            'samples': self.samples,
+            'cer': self.char_errors / max(self.chars, 1),
+            'wer': self.word_errors / max(self.words, 1),
+            'exact_match': self.exact / max(self.samples, 1),
+        }
+
+
+class OCRMetrics:
+
+    '''
+    Running character error rate, word error rate and exact match, overall and per true label length.
+    '''
+
+    def __init__(self) -> None:
+        self.total = _Counts()
+        self.by_length = defaultdict(_Counts)
+
+    def update(self, truths, preds):
+        '''
+        Adds a batch of predictions.
+
+        Arguments :
+            truths : The true label strings.
+            preds  : The decoded predictions, in the same order.
+        '''
+
+        for truth, pred in zip(truths, preds):
+            self.total.add(truth, pred)
+            self.by_length[len(truth)].add(truth, pred)
+
+    def result(self) -> dict:
+        '''
+        Returns the metrics as a JSON serializable dictionary.
+        '''
+
+        report = self.total.result()
+        report['by_length'] = {
+            length: self.by_length[length].result() for length in sorted(self.by_length)
+        }
+        return report
+
+
+def build_eval_dataset(
+    paths,
+    texts,
+    batch_size : int,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Builds a batched dataset of (images, texts) keeping the raw label strings, so that predictions
+    are scored against the labels exactly as written in the CSV.
+
+    Arguments :
+        paths      : The image file paths.
+        texts      : The true label strings.
+        batch_size : The evaluation batch size.
+        img_height : The height images are resized to.
+        img_width  : The width images are resized to.
+
+    Return:
+        dataset : A tf.data.Dataset yielding (images, texts) batches.
+    '''
+
+    def load(path, text):
+        image = decode_image(tf.io.read_file(path), img_height=img_height, img_width=img_width)
+        return image, text
+
+    return tf.data.Dataset.from_tensor_slices(
+        (np.array(list(paths)), np.array([str(text) for text in texts]))
+    ).map(load, num_parallel_calls=tf.data.AUTOTUNE).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def evaluate(model, dataset, decode, verbose : bool = True) -> dict:
+    '''
+    Runs ``model`` over ``dataset`` batch by batch, decoding and scoring each batch as it arrives.
+
+    Arguments :
+        model   : The inference model, mapping images to per-timestep probabilities.
+        dataset : A dataset of (images, texts) batches, see ``build_eval_dataset``.
+        decode  : The decoding function, e.g. decode_pred.
+        verbose : Whether to print a running count.
+
+    Return:
+        report : The metrics of ``OCRMetrics.result`` plus the wall time and throughput.
+    '''
+
+    metrics = OCRMetrics()
+    start = time.perf_counter()
+
+    for images, texts in dataset:
+        pred = model.predict_on_batch(images)
+        truths = [text.decode('UTF-8') for text in texts.numpy()]
+        metrics.update(truths, decode(np.asarray(pred)))
+        if verbose:
+            print(f'\rEvaluated {metrics.total.samples} images', end='')
+
+    if verbose:
+        print()
+
+    report = metrics.result()
+    report['seconds'] = time.perf_counter() - start
+    report['images_per_second'] = report['samples'] / max(report['seconds'], 1e-9)
+    return report
+
+
+def format_report(report : dict) -> str:
+    '''
+    Formats an evaluation report as a short text table.
+
+    Argument :
+        report : The dictionary returned by ``evaluate``.
+
+    Return:
+        text : The formatted report.
+    '''
+
+    lines = [
+        f"Samples     : {report['samples']}",
+        f"CER         : {report['cer']:.4f}",
+        f"WER         : {report['wer']:.4f}",
+        f"Exact Match : {report['exact_match']:.4f}",
+        '',
+        'Length  Samples     CER     WER   Exact',
+    ]
+    for length, row in report['by_length'].items():
+        lines.append(
+            f"{length:>6}  {row['samples']:>7}  {row['cer']:.4f}  {row['wer']:.4f}  {row['exact_match']:.4f}"
+        )
+    return '\n'.join(lines)
+
+
+def save_report(report : dict, path : str):
+    '''
+    Writes an evaluation report as JSON.
+    '''
+
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
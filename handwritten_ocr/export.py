@@ -0,0 +1,172 @@
+'''
+End-to-end SavedModel export : raw JPEG bytes in, decoded strings and confidences out.
+
+Using an inference model from Python takes several round trips per batch : decode every image, run
+the network, CTC decode, then map the classes back to characters. ``export_saved_model`` puts all of
+it in one graph behind a single serving signature,
+
+    serving_default(images : string[batch])  ->  {'text' : string[batch], 'confidence' : float32[batch]}
+
+where ``images`` holds the raw JPEG file contents. The images are decoded, resized and transposed
+exactly like ``preprocessing.decode_image``, and the greedy CTC decode matches ``GreedyDecoder``.
+The confidence is the probability of the best path, the product over the time steps of the highest
+class probability. The exported directory loads without this package or the model code:
+
+    serving = tf.saved_model.load(path).signatures['serving_default']
+    result = serving(images=tf.constant([open('name.jpg', 'rb').read()]))
+
+An undecodable image fails its whole batch, so callers that cannot trust their inputs should check
+them first or send them one at a time.
+'''
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.decoding import OOV_TOKEN
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+
+
+class OCRModule(tf.Module):
+
+    '''
+    The inference model with its preprocessing and CTC decoding, as a module that can be saved.
+
+    Arguments :
+        model      : The inference model, mapping images to per-timestep probabilities.
+        vocabulary : The Vocabulary of the model; its class indices are the model's.
+        max_length : The maximum number of characters per prediction, by default the vocabulary's
+                     max_label_length, or the number of time steps.
+        img_height : The height the images are resized to.
+        img_width  : The width the images are resized to.
+    '''
+
+    def __init__(
+        self,
+        model,
+        vocabulary,
+        max_length : int = None,
+        img_height : int = IMG_HEIGHT,
+        img_width : int = IMG_WIDTH,
+    ) -> None:
+        super().__init__()
+        self.model = model
+        # Recent Keras versions do not track the variables (e.g. the dropout seed states) for tf.Module
+        self.model_variables = [
+            variable if isinstance(variable, tf.Variable) else variable.value for variable in model.variables
+        ]
+        self.img_height = img_height
+        self.img_width = img_width
+
+        # Class index -> character; the OOV token is rendered as a space and the CTC blank as nothing
+        table = [' ' if token == OOV_TOKEN else token for token in vocabulary.get_vocabulary()]
+        self.blank = len(table)
+        self.table = tf.constant(table + [''])
+        self.max_length = max_length or vocabulary.max_label_length or model.output_shape[1]
+
+    def decode(self, probs):
+        '''
+        Greedy CTC decoding in the graph.
+
+        Argument :
+            probs : The model output of shape (batch, time steps, classes).
+
+        Returns:
+            texts       : A string tensor of shape (batch,).
+            confidences : The best path probabilities, of shape (batch,).
+        '''
+
+        best = tf.argmax(probs, axis=-1, output_type=tf.int32)
+        confidences = tf.exp(tf.reduce_sum(tf.math.log(tf.reduce_max(probs, axis=-1)), axis=-1))
+
+        # Repeated classes are merged, then blanks removed, and at most max_length characters kept
+        previous = tf.pad(best[:, :-1], [[0, 0], [1, 0]], constant_values=-1)
+        keep = (best != self.blank) & (best != previous)
+        keep &= tf.cumsum(tf.cast(keep, tf.int32), axis=1) <= self.max_length
+
+        chars = tf.where(keep, tf.gather(self.table, best), '')
+        texts = tf.strings.strip(tf.strings.reduce_join(chars, axis=1))
+        return texts, confidences
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string, name='images')])
+    def serve(self, images):
+        '''
+        Recognizes a batch of raw JPEG file contents.
+        '''
+
+        batch = tf.map_fn(
+            lambda contents: decode_image(contents, img_height=self.img_height, img_width=self.img_width),
+            images,
+            fn_output_signature=tf.TensorSpec((self.img_width, self.img_height, 1), tf.float32),
+        )
+        probs = self.model(batch, training=False)
+        texts, confidences = self.decode(tf.cast(probs, tf.float32))
+        return {'text': texts, 'confidence': confidences}
+
+
+def export_saved_model(
+    model,
+    vocabulary,
+    path : str,
+    max_length : int = None,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+) -> str:
+    '''
+    Exports an inference model as a SavedModel recognizing raw JPEG bytes.
+
+    Arguments :
+        model      : The inference model, e.g. inference_model_2 or load_inference_model(path).
+        vocabulary : The Vocabulary of the model.
+        path       : The SavedModel directory to write.
+        max_length : The maximum number of characters per prediction (MAX_LABEL_LENGTH).
+        img_height : The height the images are resized to.
+        img_width  : The width the images are resized to.
+
+    Return:
+        path : The written directory.
+    '''
+
+    module = OCRModule(model, vocabulary, max_length, img_height=img_height, img_width=img_width)
+    tf.saved_model.save(module, path, signatures={'serving_default': module.serve})
+    return path
+
+
+class ExportedOCR:
+
+    '''
+    Python front end of an exported SavedModel : one graph call per batch of files.
+
+    Argument :
+        path : The directory written by ``export_saved_model``.
+    '''
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self.serving = tf.saved_model.load(path).signatures['serving_default']
+
+    def predict(self, contents):
+        '''
+        Recognizes a batch of images.
+
+        Argument :
+            contents : The raw JPEG bytes of every image.
+
+        Returns:
+            texts       : The decoded strings.
+            confidences : A float32 array of the best path probabilities.
+        '''
+
+        result = self.serving(images=tf.constant(list(contents), dtype=tf.string))
+        texts = [text.decode('UTF-8') for text in result['text'].numpy()]
+        return texts, np.asarray(result['confidence'])
+
+    def predict_files(self, paths):
+        '''
+        Recognizes a batch of image files, see ``predict``.
+        '''
+
+        contents = []
+        for path in paths:
+            with open(path, 'rb') as file:
+                contents.append(file.read())
+        return self.predict(contents)
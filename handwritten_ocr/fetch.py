@@ -0,0 +1,679 @@
+'''
+Resumable, parallel download of the Kaggle data sources.
+
+The archive is fetched in fixed-size byte ranges by a pool of threads, each range written straight to
+its offset in a ``.part`` file. Finished ranges are recorded next to the part file, so an interrupted
+download picks up where it stopped instead of starting over. While the ranges arrive, a
+``StreamingExtractor`` thread follows the contiguous downloaded prefix of the part file and extracts it
+into a staging directory, so extraction ends shortly after the last byte instead of starting then. Once
+complete, the archive is checked against its SHA-256 digest and moved into the cache, and the staged
+extraction replaces the destination directory; an archive that cannot be extracted as a stream (e.g. a
+zip entry stored with a data descriptor) is extracted from the cache instead. A later cold start that
+finds a verified archive (and an extraction made from it) in the cache skips the network entirely.
+
+Everything here is standard library only, so the stage can be pointed at any HTTP server that
+honours ``Range`` requests, e.g. ``python -m http.server`` serving a local copy of the bundle.
+'''
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPException
+from urllib.error import HTTPError
+from urllib.parse import unquote, urlparse
+from urllib.request import Request, urlopen
+from zipfile import ZipFile
+
+# Read size used when streaming a response body
+CHUNK_SIZE = 40960
+
+# Size of one byte range fetched by a worker
+PART_SIZE = 8 * 1024 * 1024
+
+# Number of parallel range requests
+NUM_WORKERS = 8
+
+# Attempts per byte range before the download is abandoned
+MAX_RETRIES = 5
+
+# Marker left in an extracted directory, holding the digest of the archive it came from
+EXTRACTED_MARKER = '.extracted'
+
+# Suffix of the directory an archive is extracted into before it replaces the destination
+STAGING_SUFFIX = '.extracting'
+
+
+def _write_json(path : str, data : dict):
+    '''
+    Writes ``data`` to ``path`` atomically, so a crash never leaves half a progress file behind.
+    '''
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path : str):
+    '''
+    Reads a JSON file written by ``_write_json``, returning None if it is missing or unreadable.
+    '''
+
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def file_sha256(path : str) -> str:
+    '''
+    Computes the SHA-256 hex digest of a file.
+
+    Argument :
+        path : The file to hash.
+
+    Return:
+        digest : The hex digest of the file contents.
+    '''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def probe(url : str, timeout : float = 60):
+    '''
+    Finds the size of the remote file and whether the server serves byte ranges. A one byte ranged
+    GET is used rather than HEAD, because signed storage URLs are only valid for the GET method.
+
+    Arguments :
+        url     : The URL of the file.
+        timeout : Socket timeout in seconds.
+
+    Returns:
+        total_length    : The size of the file in bytes, or None if the server does not report it.
+        supports_ranges : True if the server answered the ranged request with 206 Partial Content.
+    '''
+
+    with urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=timeout) as response:
+        if response.status == 206:
+            content_range = response.headers.get('Content-Range', '')
+            total = content_range.rpartition('/')[2]
+            if total.isdigit():
+                return int(total), True
+        total = response.headers.get('Content-Length')
+        return (int(total) if total else None), False
+
+
+class _Progress:
+    '''
+    Thread-safe progress bar in the same format as the original notebook download loop.
+    '''
+
+    def __init__(self, total : int, done : int = 0, enabled : bool = True) -> None:
+        self.total = total
+        self.done = done
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+    def update(self, n_bytes : int):
+        with self.lock:
+            self.done += n_bytes
+            if self.enabled and self.total:
+                done = int(50 * self.done / self.total)
+                sys.stdout.write(f"\r[{'=' * done}{' ' * (50-done)}] {self.done} bytes downloaded")
+                sys.stdout.flush()
+
+
+def _fetch_range(url : str, fd : int, start : int, end : int, progress : _Progress, timeout : float):
+    '''
+    Downloads the inclusive byte range [start, end] of ``url`` into ``fd`` at the same offset,
+    retrying with exponential backoff. Bytes written by a failed attempt are simply overwritten.
+    '''
+
+    for attempt in range(MAX_RETRIES):
+        offset = start
+        try:
+            request = Request(url, headers={'Range': f'bytes={start}-{end}'})
+            with urlopen(request, timeout=timeout) as response:
+                if response.status != 206:
+                    raise OSError(f'Server ignored range request for bytes {start}-{end}')
+                data = response.read(CHUNK_SIZE)
+                while len(data) > 0:
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    progress.update(len(data))
+                    data = response.read(CHUNK_SIZE)
+            if offset != end + 1:
+                raise OSError(f'Short read for bytes {start}-{end}')
+            return
+        except HTTPError:
+            # Expired or forbidden URLs will not fix themselves.
+            raise
+        except (OSError, HTTPException):
+            progress.update(start - offset)
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def _fetch_stream(url : str, part_path : str, progress : _Progress, timeout : float, downloaded = None):
+    '''
+    Fallback for servers without range support: a single sequential download, as before.
+    '''
+
+    with urlopen(url, timeout=timeout) as response, open(part_path, 'wb') as file:
+        data = response.read(CHUNK_SIZE)
+        while len(data) > 0:
+            file.write(data)
+            progress.update(len(data))
+            if downloaded is not None:
+                file.flush()
+                downloaded.advance(file.tell())
+            data = response.read(CHUNK_SIZE)
+
+
+class _Downloaded:
+
+    '''
+    Length of the prefix of the part file known to be written, shared by the download threads and the
+    consumer reading behind them.
+    '''
+
+    def __init__(self) -> None:
+        self.size = 0
+        self.finished = False
+        self.condition = threading.Condition()
+
+    def advance(self, size : int):
+        with self.condition:
+            if size > self.size:
+                self.size = size
+                self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def wait(self, position : int) -> int:
+        '''
+        Blocks until the byte at ``position`` is written or the download is over; returns the prefix size.
+        '''
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.size > position or self.finished)
+            return self.size
+
+
+class _PartReader(io.RawIOBase):
+
+    '''
+    Sequential file object over a part file being downloaded: reads block until their bytes are written,
+    and the end of the file is the end of the download.
+    '''
+
+    def __init__(self, path : str, downloaded : _Downloaded) -> None:
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.downloaded = downloaded
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        available = self.downloaded.wait(self.position) - self.position
+        if available <= 0:
+            return 0
+        data = os.pread(self.file.fileno(), min(len(buffer), available), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class _Unstreamable(Exception):
+    '''
+    Raised for an archive that can only be extracted once complete.
+    '''
+
+
+class _ZipStream:
+
+    '''
+    Exact reads over a sequential file object, with the bytes read past a deflate stream pushed back.
+    '''
+
+    def __init__(self, fileobj) -> None:
+        self.fileobj = fileobj
+        self.buffer = b''
+
+    def read(self, size : int) -> bytes:
+        while len(self.buffer) < size:
+            data = self.fileobj.read(max(CHUNK_SIZE, size - len(self.buffer)))
+            if not data:
+                raise EOFError('Truncated zip archive')
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_some(self) -> bytes:
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        data = self.fileobj.read(CHUNK_SIZE)
+        if not data:
+            raise EOFError('Truncated zip archive')
+        return data
+
+    def unread(self, data : bytes):
+        self.buffer = data + self.buffer
+
+
+def _stream_zip(fileobj, destination_path : str):
+    '''
+    Extracts a zip archive in one sequential pass, from the local header before every entry, so the
+    central directory at the end is not needed. Stored and deflated entries are supported; anything
+    else, and names escaping ``destination_path``, raise _Unstreamable.
+    '''
+
+    stream = _ZipStream(fileobj)
+    root = os.path.realpath(destination_path)
+    while True:
+        signature = stream.read(4)
+        if signature != b'PK\x03\x04':
+            # The central directory follows the last entry
+            if signature in (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'):
+                return
+            raise _Unstreamable(f'Unexpected zip record {signature!r}')
+
+        _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = struct.unpack(
+            '<HHHHHIIIHH', stream.read(26)
+        )
+        name = stream.read(name_length).decode('UTF-8' if flags & 0x800 else 'cp437')
+        extra = stream.read(extra_length)
+        if flags & 0x1:
+            raise _Unstreamable(f'Encrypted zip entry {name}')
+
+        # The zip64 extra field holds the sizes that do not fit in the header
+        zip64 = False
+        while len(extra) >= 4:
+            field, field_length = struct.unpack('<HH', extra[:4])
+            if field == 0x0001:
+                zip64 = True
+                values = list(struct.unpack(f'<{field_length // 8}Q', extra[4:4 + field_length // 8 * 8]))
+                if size == 0xFFFFFFFF and values:
+                    size = values.pop(0)
+                if compressed_size == 0xFFFFFFFF and values:
+                    compressed_size = values.pop(0)
+            extra = extra[4 + field_length:]
+
+        descriptor = bool(flags & 0x8)
+        is_directory = name.endswith('/')
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.isabs(name) or not (path == root or path.startswith(root + os.sep)):
+            raise _Unstreamable(f'Unsafe zip entry {name}')
+        if descriptor and method != 8 and not is_directory:
+            raise _Unstreamable(f'Stored zip entry {name} without its size')
+        if method not in (0, 8):
+            raise _Unstreamable(f'Unsupported compression method {method} for {name}')
+
+        checksum = 0
+        if is_directory:
+            os.makedirs(path, exist_ok=True)
+            stream.read(0 if descriptor else compressed_size)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                if method == 0:
+                    remaining = compressed_size
+                    while remaining:
+                        data = stream.read(min(remaining, CHUNK_SIZE))
+                        remaining -= len(data)
+                        file.write(data)
+                        checksum = zlib.crc32(data, checksum)
+                else:
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    remaining = None if descriptor else compressed_size
+                    while not decompressor.eof:
+                        if remaining is None:
+                            data = stream.read_some()
+                        elif remaining:
+                            data = stream.read(min(remaining, CHUNK_SIZE))
+                            remaining -= len(data)
+                        else:
+                            raise ValueError(f'Truncated deflate stream for {name}')
+                        data = decompressor.decompress(data)
+                        file.write(data)
+                        checksum = zlib.crc32(data, checksum)
+                    stream.unread(decompressor.unused_data)
+
+        if descriptor:
+            data = stream.read(4)
+            if data == b'PK\x07\x08':
+                data = stream.read(4)
+            crc = struct.unpack('<I', data)[0]
+            stream.read(16 if zip64 else 8)
+        if not is_directory and checksum != crc:
+            raise ValueError(f'CRC mismatch for zip entry {name}')
+
+
+class StreamingExtractor:
+
+    '''
+    Consumer of ``download`` extracting the archive into a staging directory while it is downloaded.
+    A tar archive is read as a stream by tarfile; a zip archive entry by entry, see ``_stream_zip``.
+
+    Arguments :
+        staging_path : The directory extracted into; it is emptied first.
+        is_zip       : Whether the archive is a zip file; otherwise it is opened as a tar file.
+
+    Attributes :
+        complete : Whether the whole archive was extracted.
+        error    : Why the extraction stopped, if it did; the archive is then extracted once complete.
+    '''
+
+    def __init__(self, staging_path : str, is_zip : bool) -> None:
+        self.staging_path = staging_path
+        self.is_zip = is_zip
+        self.complete = False
+        self.error = None
+        shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path)
+
+    def __call__(self, fileobj):
+        try:
+            with io.BufferedReader(fileobj, CHUNK_SIZE) as reader:
+                if self.is_zip:
+                    _stream_zip(reader, self.staging_path)
+                else:
+                    with tarfile.open(fileobj=reader, mode='r|*') as tfile:
+                        tfile.extractall(self.staging_path)
+            self.complete = True
+        except Exception as error:
+            # Whatever went wrong, extracting the verified archive afterwards is still possible
+            self.error = error
+
+
+def download(
+    url : str,
+    path : str,
+    sha256 : str = None,
+    part_size : int = PART_SIZE,
+    num_workers : int = NUM_WORKERS,
+    timeout : float = 60,
+    verbose : bool = True,
+    consumer = None,
+) -> str:
+    '''
+    Downloads ``url`` to ``path`` using parallel byte ranges, resuming a previous partial download if
+    one exists. Progress is kept in ``path + '.part'`` and ``path + '.part.json'``; the file only
+    appears at ``path`` once it is complete and its digest has been checked.
+
+    Arguments :
+        url         : The URL to download.
+        path        : The destination file.
+        sha256      : The expected hex digest. If given, a mismatch raises ValueError.
+        part_size   : The size of one byte range.
+        num_workers : The number of concurrent range requests.
+        timeout     : Socket timeout in seconds.
+        verbose     : Whether to print a progress bar.
+        consumer    : Optional callable run in a thread on a file object reading the part file as its
+                      contiguous prefix is downloaded, e.g. a StreamingExtractor; it must close it.
+                      ``download`` waits for it before returning.
+
+    Return:
+        digest : The SHA-256 hex digest of the downloaded file.
+    '''
+
+    part_path = path + '.part'
+    state_path = part_path + '.json'
+
+    total_length, supports_ranges = probe(url, timeout=timeout)
+    downloaded = _Downloaded()
+    consumer_thread = None
+
+    def start_consumer():
+        if consumer is not None:
+            thread = threading.Thread(target=consumer, args=(_PartReader(part_path, downloaded),), daemon=True)
+            thread.start()
+            return thread
+
+    try:
+        if supports_ranges:
+            n_parts = (total_length + part_size - 1) // part_size
+
+            # Only trust recorded progress if it describes the same remote file and layout.
+            state = _read_json(state_path)
+            if not (state and state.get('size') == total_length and state.get('part_size') == part_size
+                    and os.path.exists(part_path)):
+                state = {'size': total_length, 'part_size': part_size, 'done': []}
+            done = set(state['done'])
+
+            pending = [i for i in range(n_parts) if i not in done]
+            already = sum(min(part_size, total_length - i * part_size) for i in done)
+            progress = _Progress(total_length, already, enabled=verbose)
+
+            # The consumer may read up to the first range not downloaded yet
+            contiguous = 0
+
+            def advance():
+                nonlocal contiguous
+                while contiguous in done:
+                    contiguous += 1
+                downloaded.advance(min(contiguous * part_size, total_length))
+
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, total_length)
+                consumer_thread = start_consumer()
+                advance()
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    futures = {
+                        executor.submit(
+                            _fetch_range, url, fd, i * part_size,
+                            min((i + 1) * part_size, total_length) - 1, progress, timeout
+                        ): i
+                        for i in pending
+                    }
+                    # Ranges finishing after a failed one are still recorded, so a retry skips them
+                    error = None
+                    for future in as_completed(futures):
+                        if future.exception() is not None:
+                            error = error or future.exception()
+                            continue
+                        done.add(futures[future])
+                        state['done'] = sorted(done)
+                        _write_json(state_path, state)
+                        advance()
+                os.fsync(fd)
+                if error is not None:
+                    raise error
+            finally:
+                os.close(fd)
+        else:
+            open(part_path, 'wb').close()
+            consumer_thread = start_consumer()
+            _fetch_stream(url, part_path, _Progress(total_length or 0, enabled=verbose), timeout, downloaded)
+    finally:
+        downloaded.finish()
+        if consumer_thread is not None:
+            consumer_thread.join()
+
+    digest = file_sha256(part_path)
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        raise ValueError(f'Checksum mismatch for {url}: expected {sha256}, got {digest}')
+
+    os.replace(part_path, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return digest
+
+
+def cached_digest(path : str, sha256 : str = None, rehash : bool = False):
+    '''
+    Returns the digest of a previously downloaded archive if it is still valid, otherwise None.
+    The digest recorded at download time is trusted as long as the file size and modification time
+    are unchanged, so a warm start does not re-read a multi-gigabyte archive.
+
+    Arguments :
+        path   : The cached archive.
+        sha256 : The expected hex digest, if known.
+        rehash : Recompute the digest instead of trusting the recorded one.
+
+    Return:
+        digest : The verified hex digest, or None if the cached copy is missing or invalid.
+    '''
+
+    meta = _read_json(path + '.json')
+    if meta is None or not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+    if rehash or stat.st_size != meta.get('size') or stat.st_mtime_ns != meta.get('mtime_ns'):
+        digest = file_sha256(path)
+        if digest != meta.get('sha256'):
+            return None
+    else:
+        digest = meta['sha256']
+
+    if sha256 is not None and digest != sha256.lower():
+        return None
+    return digest
+
+
+def extract(archive_path : str, destination_path : str, digest : str, is_zip : bool, staged : str = None):
+    '''
+    Extracts an archive, unless ``destination_path`` already holds an extraction of the same digest.
+    The archive is extracted into a staging directory which then replaces ``destination_path``, so
+    nothing of an extraction made from another archive is left behind.
+
+    Arguments :
+        archive_path     : The archive to extract.
+        destination_path : The directory to extract into.
+        digest           : The digest of the archive, recorded in the destination.
+        is_zip           : Whether the archive is a zip file; otherwise it is opened as a tar file.
+        staged           : A complete extraction of the archive already made, e.g. by a StreamingExtractor.
+
+    Return:
+        extracted : False if an up to date extraction was found and nothing was done.
+    '''
+
+    marker_path = os.path.join(destination_path, EXTRACTED_MARKER)
+    try:
+        with open(marker_path) as marker:
+            if marker.read().strip() == digest:
+                if staged is not None:
+                    shutil.rmtree(staged, ignore_errors=True)
+                return False
+    except OSError:
+        pass
+
+    staging_path = staged
+    if staging_path is None:
+        staging_path = destination_path + STAGING_SUFFIX
+        shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path)
+        if is_zip:
+            with ZipFile(archive_path) as zfile:
+                zfile.extractall(staging_path)
+        else:
+            with tarfile.open(archive_path) as tfile:
+                tfile.extractall(staging_path)
+
+    if os.path.lexists(destination_path):
+        shutil.rmtree(destination_path)
+    os.replace(staging_path, destination_path)
+
+    with open(marker_path, 'w') as marker:
+        marker.write(digest)
+    return True
+
+
+def fetch_data_sources(
+    data_source_mapping : str,
+    input_path : str,
+    cache_dir : str,
+    checksums : dict = None,
+    **download_kwargs,
+):
+    '''
+    Fetches every ``directory:url`` pair in ``data_source_mapping`` (comma separated, URL encoded, as
+    in the Kaggle bootstrap cell) and extracts it to ``input_path/directory``. Archives are cached in
+    ``cache_dir`` under the directory name rather than the URL, since signed URLs change between runs.
+
+    Arguments :
+        data_source_mapping : The Kaggle ``DATA_SOURCE_MAPPING`` string.
+        input_path          : The root directory the data sources are extracted into.
+        cache_dir           : The directory holding downloaded archives between runs.
+        checksums           : Optional mapping of directory name to expected SHA-256 hex digest.
+        download_kwargs     : Extra keyword arguments passed on to ``download``.
+    '''
+
+    checksums = checksums or {}
+    os.makedirs(cache_dir, exist_ok=True)
+
+    for data_source_mapping in data_source_mapping.split(','):
+        directory, download_url_encoded = data_source_mapping.split(':')
+        download_url = unquote(download_url_encoded)
+        filename = urlparse(download_url).path
+        is_zip = filename.endswith('.zip')
+        destination_path = os.path.join(input_path, directory)
+        archive_path = os.path.join(cache_dir, directory + ('.zip' if is_zip else '.tar'))
+        expected = checksums.get(directory)
+
+        digest = cached_digest(archive_path, expected)
+        staged = None
+        if digest is not None:
+            print(f'Using cached {directory} ({digest[:12]})')
+        else:
+            # Extracted while it downloads; the staging directory only replaces the destination once
+            # the archive is verified
+            extractor = StreamingExtractor(destination_path + STAGING_SUFFIX, is_zip)
+            try:
+                print(f'Downloading {directory}')
+                digest = download(
+                    download_url, archive_path, sha256=expected, consumer=extractor, **download_kwargs
+                )
+            except HTTPError:
+                shutil.rmtree(extractor.staging_path, ignore_errors=True)
+                print(f'\nFailed to load (likely expired) {download_url} to path {destination_path}')
+                continue
+            except (OSError, HTTPException, ValueError) as e:
+                shutil.rmtree(extractor.staging_path, ignore_errors=True)
+                print(f'\nFailed to load {download_url} to path {destination_path}: {e}')
+                continue
+            stat = os.stat(archive_path)
+            _write_json(archive_path + '.json', {
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest
+            })
+            if extractor.complete:
+                staged = extractor.staging_path
+            else:
+                print(f'\nExtracting {directory} from the archive ({extractor.error})')
+
+        if extract(archive_path, destination_path, digest, is_zip, staged=staged):
+            print(f'\nDownloaded and uncompressed: {directory}')
+        else:
+            print(f'Already uncompressed: {directory}')
+
+    print('Data source import complete.')
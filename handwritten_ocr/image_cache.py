@@ -0,0 +1,265 @@
+'''
+Persistent, content addressed cache of preprocessed images.
+
+Every epoch, and every model trained in the notebook, used to repeat the whole read, decode, resize
+and transpose chain for every image. ``ImageCache`` stores the result of that chain once, as uint8,
+in an SQLite database keyed by a hash of the JPEG bytes and the preprocessing parameters (image size
+and channel count). A second model, a second epoch or a second run after a kernel restart reads the
+preprocessed pixels back instead of decoding again.
+
+The cache keeps a path index (path, size, mtime) so warm lookups do not even re-read the JPEG, and it
+is capped in size with least recently used eviction. Pixels are stored as uint8 and scaled back to
+float32 in [0, 1] on read, which differs from the uncached float pipeline by at most half a grey level.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+
+# Default size cap of the cache, in bytes
+MAX_BYTES = 8 * 1024 ** 3
+
+# Bumped whenever the preprocessing chain changes in a way that invalidates stored pixels
+CACHE_VERSION = 1
+
+# Number of images decoded and written per transaction while warming the cache
+WRITE_BATCH = 512
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used);
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+'''
+
+
+class ImageCache:
+
+    '''
+    A size capped store of preprocessed uint8 images shared by every split and every model.
+
+    Arguments :
+        directory  : The directory holding the cache database.
+        img_height : The height images are resized to.
+        img_width  : The width images are resized to.
+        channels   : The number of channels images are decoded with.
+        max_bytes  : The size cap of the stored pixels; least recently used images are evicted above it.
+    '''
+
+    def __init__(
+        self,
+        directory : str,
+        img_height : int = IMG_HEIGHT,
+        img_width : int = IMG_WIDTH,
+        channels : int = 1,
+        max_bytes : int = MAX_BYTES,
+    ) -> None:
+
+        self.directory = directory
+        self.img_height = img_height
+        self.img_width = img_width
+        self.channels = channels
+        self.max_bytes = max_bytes
+        self.shape = (img_width, img_height, channels)
+        self.params = f'v{CACHE_VERSION}:{img_height}x{img_width}x{channels}'.encode()
+
+        os.makedirs(directory, exist_ok=True)
+        self.db_path = os.path.join(directory, 'images.sqlite')
+        self._local = threading.local()
+
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        '''
+        Returns the connection of the calling thread; tf.data runs lookups from several threads.
+        '''
+
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=60)
+            self._local.db = db
+        return db
+
+    def _digest(self, path : str) -> str:
+        '''
+        Returns the content hash of an image, using the path index when the file is unchanged.
+        '''
+
+        stat = os.stat(path)
+        db = self._connect()
+        row = db.execute('SELECT size, mtime_ns, digest FROM paths WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        with open(path, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, digest)
+            )
+        return digest
+
+    def keys(self, paths, num_workers : int = 8):
+        '''
+        Computes the cache key of every image: its content hash combined with the preprocessing
+        parameters, so caches built for another image size never collide.
+
+        Argument :
+            paths : The image file paths.
+
+        Return:
+            keys : The list of cache keys, in the order of ``paths``.
+        '''
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            digests = list(executor.map(self._digest, paths))
+        return [hashlib.sha1(self.params + digest.encode()).hexdigest() for digest in digests]
+
+    def _decode_uint8(self, image_bytes):
+        image = decode_image(image_bytes, img_height=self.img_height, img_width=self.img_width)
+        return tf.cast(tf.round(tf.clip_by_value(image, 0.0, 1.0) * 255.0), dtype=tf.uint8)
+
+    def warm(self, paths) -> list:
+        '''
+        Makes sure every image in ``paths`` is in the cache, decoding the missing ones in a parallel
+        tf.data pipeline, then marks them as recently used and enforces the size cap.
+
+        Argument :
+            paths : The image file paths.
+
+        Return:
+            keys : The cache keys of the images, in the order of ``paths``.
+        '''
+
+        paths = list(paths)
+        keys = self.keys(paths)
+        session = time.time()
+
+        db = self._connect()
+        present = set()
+        unique = list(set(keys))
+        for start in range(0, len(unique), 900):
+            chunk = unique[start:start + 900]
+            marks = ','.join('?' * len(chunk))
+            present.update(
+                row[0] for row in db.execute(f'SELECT key FROM images WHERE key IN ({marks})', chunk)
+            )
+
+        misses = {}
+        for path, key in zip(paths, keys):
+            if key not in present:
+                misses.setdefault(key, path)
+
+        if misses:
+            miss_keys = list(misses)
+            decoded = tf.data.Dataset.from_tensor_slices(
+                [misses[key] for key in miss_keys]
+            ).map(
+                lambda path: self._decode_uint8(tf.io.read_file(path)),
+                num_parallel_calls=tf.data.AUTOTUNE
+            ).batch(WRITE_BATCH).prefetch(tf.data.AUTOTUNE)
+
+            offset = 0
+            for batch in decoded:
+                batch = batch.numpy()
+                rows = [
+                    (key, image.tobytes(), image.nbytes, session)
+                    for key, image in zip(miss_keys[offset:offset + len(batch)], batch)
+                ]
+                offset += len(batch)
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)', rows)
+
+        with db:
+            db.executemany(
+                'UPDATE images SET last_used = ? WHERE key = ?', [(session, key) for key in unique]
+            )
+        self.evict(protect_since=session)
+
+        return keys
+
+    def evict(self, protect_since : float = None):
+        '''
+        Deletes least recently used images until the cache is under its size cap. Images used at or
+        after ``protect_since`` are kept, so a split is never evicted while it is being read.
+
+        Argument :
+            protect_since : Timestamp of the current session; None allows evicting everything.
+        '''
+
+        db = self._connect()
+        total = db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM images').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        limit = protect_since if protect_since is not None else float('inf')
+        victims, freed = [], 0
+        for key, nbytes in db.execute(
+            'SELECT key, nbytes FROM images WHERE last_used < ? ORDER BY last_used', (limit,)
+        ):
+            if total - freed <= self.max_bytes:
+                break
+            victims.append((key,))
+            freed += nbytes
+
+        with db:
+            db.executemany('DELETE FROM images WHERE key = ?', victims)
+
+        if total - freed > self.max_bytes:
+            print(f'Image cache holds {total - freed} bytes, above its cap of {self.max_bytes} bytes')
+
+    def _load(self, key, path):
+        '''
+        Reads one image back from the cache, decoding it directly if it has been evicted meanwhile.
+        '''
+
+        row = self._connect().execute(
+            'SELECT data FROM images WHERE key = ?', (key.numpy().decode(),)
+        ).fetchone()
+        if row is None:
+            return self._decode_uint8(tf.io.read_file(path))
+        return np.frombuffer(row[0], dtype=np.uint8).reshape(self.shape)
+
+    def dataset(self, paths):
+        '''
+        Builds a dataset of preprocessed float32 images, in the order of ``paths``, backed by the cache.
+        The images are decoded once here if they are not cached yet.
+
+        Argument :
+            paths : The image file paths.
+
+        Return:
+            dataset : A tf.data.Dataset of float32 images of shape (img_width, img_height, channels).
+        '''
+
+        paths = list(paths)
+        keys = self.warm(paths)
+
+        def load(key, path):
+            image = tf.py_function(self._load, [key, path], Tout=tf.uint8)
+            image.set_shape(self.shape)
+            return tf.image.convert_image_dtype(image, dtype=tf.float32)
+
+        return tf.data.Dataset.from_tensor_slices((keys, paths)).map(
+            load, num_parallel_calls=tf.data.AUTOTUNE
+        )
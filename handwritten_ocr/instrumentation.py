@@ -0,0 +1,325 @@
+'''
+Input pipeline instrumentation.
+
+``PipelineStats`` records, from inside a running tf.data pipeline, the latency of every
+preprocessing stage (``read_file`` -> ``decode_jpeg`` -> ``convert`` -> ``resize`` -> ``transpose``,
+then ``unicode_split`` -> ``char_to_num`` -> ``pad`` when labels are encoded on the fly) and how
+many elements have passed a few points of the chain. The stages run inside one map function and
+are bracketed by ``tf.timestamp``, each stage chained after the timestamp before it; the measurements travel with the element and are added up by a
+sequential map further down, so parallel calls never race on the counters.
+
+``instrumented_dataset`` builds the notebook's training chain with these probes, and
+``PipelineMonitor`` is the training callback reading them. Before every step it samples how many
+batches wait in the prefetch buffer. When the buffer is empty at most steps, the model waits for
+data and the epoch is classified as input-bound; otherwise the pipeline keeps up and the epoch is
+compute-bound. Every epoch is written as JSON and as TensorBoard scalars, and a few steps can be
+captured as a TensorBoard profiler trace.
+
+    stats = PipelineStats()
+    train_ds = instrumented_dataset(paths, label_ids, BATCH_SIZE, stats, notebook_stages())
+    model.fit(train_ds, callbacks=[PipelineMonitor(stats, 'pipeline.json', 'logs/pipeline')])
+'''
+
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH
+
+# Fraction of steps starting with an empty prefetch buffer above which an epoch is input-bound
+INPUT_BOUND_THRESHOLD = 0.5
+
+# Key of the stage timings carried by the elements between the timed map and the accumulator
+_TIMINGS_KEY = '_stage_seconds'
+
+
+def notebook_stages(
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+    char_to_num = None,
+    max_length : int = None,
+    padding : int = None,
+):
+    '''
+    Returns the stages of the notebook's preprocessing, as (name, function) pairs mapping an element
+    dictionary to the next one. Elements start as {'path', 'label'} and end as {'image', 'label'}.
+
+    Arguments :
+        img_height  : The height images are resized to.
+        img_width   : The width images are resized to.
+        char_to_num : The StringLookup of the labels. When given, labels are strings encoded by the
+                      unicode_split, char_to_num and pad stages; otherwise they are already encoded
+                      (see ``Vocabulary.encode``).
+        max_length  : The padded label length (MAX_LABEL_LENGTH), with ``char_to_num``.
+        padding     : The label padding index (n_classes + 1), with ``char_to_num``.
+
+    Return:
+        stages : The list of stages.
+    '''
+
+    def replace(element, **values):
+        return {**element, **values}
+
+    stages = [
+        ('read_file', lambda e: replace(e, image=tf.io.read_file(e['path']))),
+        ('decode_jpeg', lambda e: replace(e, image=tf.image.decode_jpeg(e['image'], channels=1))),
+        ('convert', lambda e: replace(e, image=tf.image.convert_image_dtype(e['image'], tf.float32))),
+        ('resize', lambda e: replace(e, image=tf.image.resize(e['image'], (img_height, img_width)))),
+        ('transpose', lambda e: replace(e, image=tf.transpose(e['image'], perm=[1, 0, 2]))),
+    ]
+    if char_to_num is not None:
+        stages += [
+            ('unicode_split', lambda e: replace(e, label=tf.strings.unicode_split(e['label'], 'UTF-8'))),
+            ('char_to_num', lambda e: replace(e, label=char_to_num(e['label']))),
+            ('pad', lambda e: replace(e, label=tf.pad(
+                e['label'], [[0, max_length - tf.shape(e['label'])[0]]], constant_values=padding
+            ))),
+        ]
+    return stages
+
+
+class PipelineStats:
+
+    '''
+    Per-stage latency and element counters recorded from inside tf.data pipelines.
+    '''
+
+    def __init__(self) -> None:
+        self.stage_names = []
+        self._seconds = None
+        self._elements = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._counters = {}
+
+    def timed_map(self, dataset, stages, num_parallel_calls = tf.data.AUTOTUNE):
+        '''
+        Applies ``stages`` in one map, timing each of them, then adds the timings to the statistics.
+        '''
+
+        self.stage_names = [name for name, _ in stages]
+        self._seconds = tf.Variable(tf.zeros(len(stages), tf.float64), trainable=False)
+
+        def run(element):
+            times = [tf.timestamp()]
+            for _, stage in stages:
+                # The stage starts after the previous timestamp, and the next timestamp waits for every
+                # output of the stage; without both, the executor may run the stages and the timestamps
+                # in any order
+                with tf.control_dependencies([times[-1]]):
+                    element = stage(element)
+                with tf.control_dependencies(tf.nest.flatten(element)):
+                    times.append(tf.timestamp())
+            element = {key: value for key, value in element.items() if key != 'path'}
+            element[_TIMINGS_KEY] = tf.stack(times[1:]) - tf.stack(times[:-1])
+            return element
+
+        def accumulate(element):
+            element = dict(element)
+            seconds = element.pop(_TIMINGS_KEY)
+            with tf.control_dependencies([self._seconds.assign_add(seconds), self._elements.assign_add(1)]):
+                return {key: tf.identity(value) for key, value in element.items()}
+
+        dataset = dataset.map(run, num_parallel_calls=num_parallel_calls)
+        return dataset.map(accumulate)
+
+    def tap(self, dataset, name : str):
+        '''
+        Counts the elements (or batches) passing this point of a pipeline.
+        '''
+
+        counter = self._counters.setdefault(name, tf.Variable(0, dtype=tf.int64, trainable=False))
+
+        def count(*element):
+            with tf.control_dependencies([counter.assign_add(1)]):
+                element = tf.nest.map_structure(tf.identity, element)
+            return element if len(element) > 1 else element[0]
+
+        return dataset.map(count)
+
+    def count(self, name : str) -> int:
+        '''
+        Returns the number of elements that passed the tap ``name``.
+        '''
+
+        return int(self._counters[name].numpy())
+
+    def reset(self):
+        '''
+        Clears the stage timings; the tap counters keep running.
+        '''
+
+        if self._seconds is not None:
+            self._seconds.assign(tf.zeros_like(self._seconds))
+        self._elements.assign(0)
+
+    def stage_latency(self) -> dict:
+        '''
+        Returns the mean latency of every stage, in milliseconds per element, since the last reset.
+        '''
+
+        if self._seconds is None:
+            return {}
+        elements = max(int(self._elements.numpy()), 1)
+        seconds = self._seconds.numpy()
+        return {name: float(seconds[index] / elements * 1000) for index, name in enumerate(self.stage_names)}
+
+
+def instrumented_dataset(
+    paths,
+    labels,
+    batch_size : int,
+    stats : PipelineStats,
+    stages,
+    shuffle : bool = True,
+    num_parallel_calls = tf.data.AUTOTUNE,
+    prefetch = tf.data.AUTOTUNE,
+):
+    '''
+    Builds a training dataset like the notebook's, with the probes ``PipelineMonitor`` reads.
+
+    Arguments :
+        paths              : The image file paths.
+        labels             : The labels, as strings or encoded, matching ``stages``.
+        batch_size         : The batch size.
+        stats              : The statistics the probes write to.
+        stages             : The preprocessing stages, see ``notebook_stages``.
+        shuffle            : Whether to shuffle the samples.
+        num_parallel_calls : The parallelism of the preprocessing map.
+        prefetch           : The prefetch buffer size, in batches.
+
+    Return:
+        dataset : A dataset of {'image', 'label'} batches.
+    '''
+
+    dataset = tf.data.Dataset.from_tensor_slices({'path': np.array(list(paths)), 'label': np.asarray(labels)})
+    if shuffle:
+        dataset = dataset.shuffle(1000)
+    dataset = stats.timed_map(dataset, stages, num_parallel_calls=num_parallel_calls)
+    dataset = stats.tap(dataset, 'samples')
+    dataset = stats.tap(dataset.batch(batch_size), 'batches')
+    return dataset.prefetch(prefetch)
+
+
+class PipelineMonitor(keras.callbacks.Callback):
+
+    '''
+    Classifies every epoch as input-bound or compute-bound from the prefetch buffer occupancy.
+
+    Arguments :
+        stats           : The statistics of the training dataset, built by ``instrumented_dataset``.
+        json_path       : The JSON file the epoch reports are written to, rewritten every epoch.
+        tensorboard_dir : The TensorBoard log directory of the scalars and the profiler trace.
+        batch_size      : The batch size, to report samples per second.
+        profile_steps   : A (first, last) range of steps of the first epoch captured as a TensorBoard
+                          profiler trace; needs ``tensorboard_dir``.
+        threshold       : The fraction of steps starting with an empty buffer above which an epoch is
+                          input-bound.
+        verbose         : Whether to print every epoch.
+    '''
+
+    def __init__(
+        self,
+        stats : PipelineStats,
+        json_path : str = None,
+        tensorboard_dir : str = None,
+        batch_size : int = None,
+        profile_steps = None,
+        threshold : float = INPUT_BOUND_THRESHOLD,
+        verbose : bool = True,
+    ) -> None:
+        super().__init__()
+        self.stats = stats
+        self.json_path = json_path
+        self.tensorboard_dir = tensorboard_dir
+        self.batch_size = batch_size
+        self.profile_steps = profile_steps
+        self.threshold = threshold
+        self.verbose = verbose
+        self.history = []
+        self._writer = tf.summary.create_file_writer(tensorboard_dir) if tensorboard_dir else None
+        self._profiling = False
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.stats.reset()
+        self._epoch = epoch
+        self._batches_before = self.stats.count('batches')
+        self._samples_before = self.stats.count('samples')
+        self._occupancy = []
+        self._sample_queue = []
+        self._steps = 0
+        self._start = time.perf_counter()
+        self._end = self._start
+
+    def on_train_batch_begin(self, batch, logs=None):
+        # Batches produced this epoch minus those already consumed : what waits in the prefetch buffer
+        batches = self.stats.count('batches') - self._batches_before
+        samples = self.stats.count('samples') - self._samples_before
+        self._occupancy.append(max(batches - batch, 0))
+        if self.batch_size:
+            self._sample_queue.append(max(samples - batches * self.batch_size, 0))
+
+        if self._profile_now(batch, first=True):
+            tf.profiler.experimental.start(self.tensorboard_dir)
+            self._profiling = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._end = time.perf_counter()
+        if self._profiling and self._profile_now(batch, first=False):
+            tf.profiler.experimental.stop()
+            self._profiling = False
+
+    def _profile_now(self, batch, first : bool) -> bool:
+        if not self.profile_steps or not self.tensorboard_dir or self._epoch != 0:
+            return False
+        return batch == self.profile_steps[0 if first else 1]
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = max(self._end - self._start, 1e-9)
+        occupancy = np.asarray(self._occupancy, dtype=np.float64)
+        empty_fraction = float(np.mean(occupancy == 0)) if len(occupancy) else 0.0
+
+        report = {
+            'epoch': epoch + 1,
+            'steps': self._steps,
+            'seconds': seconds,
+            'steps_per_second': self._steps / seconds,
+            'prefetch_occupancy_mean': float(occupancy.mean()) if len(occupancy) else 0.0,
+            'prefetch_occupancy_max': int(occupancy.max()) if len(occupancy) else 0,
+            'prefetch_empty_fraction': empty_fraction,
+            'bound': 'input' if empty_fraction >= self.threshold else 'compute',
+            'stage_latency_ms': self.stats.stage_latency(),
+        }
+        if self.batch_size:
+            report['samples_per_second'] = self._steps * self.batch_size / seconds
+            report['batch_queue_mean'] = float(np.mean(self._sample_queue)) if self._sample_queue else 0.0
+        self.history.append(report)
+
+        if self.json_path:
+            with open(self.json_path, 'w') as file:
+                json.dump(self.history, file, indent=2)
+
+        if self._writer is not None:
+            with self._writer.as_default(step=epoch):
+                for name in ('steps_per_second', 'prefetch_occupancy_mean', 'prefetch_empty_fraction'):
+                    tf.summary.scalar(f'pipeline/{name}', report[name])
+                tf.summary.scalar('pipeline/input_bound', float(report['bound'] == 'input'))
+                for stage, latency in report['stage_latency_ms'].items():
+                    tf.summary.scalar(f'stage_latency_ms/{stage}', latency)
+            self._writer.flush()
+
+        if self.verbose:
+            slowest = max(report['stage_latency_ms'].items(), key=lambda item: item[1], default=('-', 0.0))
+            print(
+                f"Epoch {epoch + 1}: {report['bound']}-bound, {report['steps_per_second']:.2f} steps/s, "
+                f"prefetch buffer empty at {empty_fraction:.0%} of steps "
+                f"(mean {report['prefetch_occupancy_mean']:.1f} batches), slowest stage {slowest[0]} "
+                f"({slowest[1]:.2f} ms)"
+            )
@@ -0,0 +1,346 @@
+'''
+The CTC layer and a builder for the CNN + BiLSTM OCR architectures of the notebook.
+
+``build_ocr_model`` reproduces both notebook architectures from a small configuration (``ARCHITECTURES``)
+and can also build them for variable width inputs, in which case the CTC loss takes per-sample input
+and label lengths instead of assuming every image spans all time steps. The softmax output and the CTC
+layer are always float32, so the models can be trained under a mixed precision policy, and
+``ctc_batch_cost_xla`` is a drop-in CTC loss for training steps compiled with XLA. Compact variants
+swap the LSTMs for GRUs and the later convolutions for depthwise separable ones.
+
+The BiLSTMs run strictly one time step after the other. The 'conv' and 'attention' sequence encoders
+replace them with blocks that process every time step in parallel, between the same CNN front end and
+CTC head : residual stacks of dilated 1D convolutions, or self-attention blocks over a sinusoidal
+positional encoding. Each block outputs as many features as the bidirectional layer it replaces.
+'''
+
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH
+
+# Every convolution block ends with a 2x2 max pool, and there are two blocks
+DOWNSAMPLE = 4
+
+# Sequence encoders : the recurrent ones run step by step, 'conv' (dilated convolutions) and 'attention'
+# (self-attention) process all time steps at once
+ENCODERS = ('lstm', 'gru', 'conv', 'attention')
+
+# Dilations of the convolutions of a 'conv' encoder block; with kernels of 3 a block sees 31 time steps
+DILATIONS = (1, 2, 4, 8)
+
+# Heads of the self-attention of an 'attention' encoder block
+ATTENTION_HEADS = 4
+
+# The two architectures of the notebook : 'small' is ocr_model, 'large' is ocr_model_2
+ARCHITECTURES = {
+    'small': {
+        'conv_filters': ((32,), (64,)),
+        'dense_units': (64,),
+        'dropout': 0.2,
+        'lstm_units': (128, 64),
+    },
+    'large': {
+        'conv_filters': ((32, 32), (64, 128)),
+        'dense_units': (64, 128),
+        'dropout': 0.4,
+        'lstm_units': (256, 128),
+    },
+}
+
+
+def ctc_batch_cost_xla(y_true, y_pred, input_length, label_length):
+    '''
+    Same loss as keras.backend.ctc_batch_cost, written with plain TensorFlow ops (a log-space forward
+    pass over the label extended with blanks) so that XLA can compile it; the CTCLoss op has no XLA
+    kernel. The blank is the last class.
+
+    Arguments :
+        y_true       : The dense labels, of shape (batch, max label length).
+        y_pred       : The softmax output, of shape (batch, time steps, classes).
+        input_length : The number of valid time steps of each sample, of shape (batch, 1).
+        label_length : The number of valid labels of each sample, of shape (batch, 1).
+
+    Return:
+        loss : The negative log likelihood of each label, of shape (batch, 1).
+    '''
+
+    neg_inf = -1e30
+
+    # Same normalization as ctc_batch_cost, which feeds log(y_pred + epsilon) as logits
+    log_probs = tf.nn.log_softmax(tf.math.log(tf.cast(y_pred, tf.float32) + keras.backend.epsilon()))
+
+    batch = tf.shape(y_true)[0]
+    n_steps = tf.shape(log_probs)[1]
+    blank = tf.shape(log_probs)[2] - 1
+    labels = tf.cast(y_true, tf.int32)
+    n_labels = tf.shape(labels)[1]
+    input_length = tf.reshape(tf.cast(input_length, tf.int32), (-1,))
+    label_length = tf.reshape(tf.cast(label_length, tf.int32), (-1,))
+
+    # Like the CTCLoss kernel, a label ends at its first blank : the notebook pads labels with the blank
+    first_blank = tf.argmax(
+        tf.concat([tf.equal(labels, blank), tf.ones([batch, 1], tf.bool)], axis=1), axis=1, output_type=tf.int32
+    )
+    label_length = tf.minimum(label_length, first_blank)
+
+    # Extended label : blank, l1, blank, l2, ..., blank
+    blanks = tf.fill([batch, n_labels], blank)
+    extended = tf.reshape(tf.stack([blanks, labels], axis=2), [batch, 2 * n_labels])
+    extended = tf.concat([extended, tf.fill([batch, 1], blank)], axis=1)
+    n_states = 2 * n_labels + 1
+
+    # A state may be entered from two states back unless it is a blank or repeats that label
+    two_back = tf.pad(extended[:, :-2], [[0, 0], [2, 0]], constant_values=-1)
+    can_skip = tf.logical_and(tf.not_equal(extended, blank), tf.not_equal(extended, two_back))
+    positions = tf.range(n_states)[tf.newaxis, :]
+    valid_state = positions < (2 * label_length + 1)[:, tf.newaxis]
+
+    # Log probability of emitting each state's symbol at each time step : (time, batch, states)
+    emit = tf.transpose(tf.gather(log_probs, extended, axis=2, batch_dims=1), [1, 0, 2])
+
+    alpha = tf.where(tf.logical_and(positions < 2, valid_state), emit[0], neg_inf)
+
+    def step(alpha, inputs):
+        emit_t, t = inputs
+        from_one = tf.pad(alpha[:, :-1], [[0, 0], [1, 0]], constant_values=neg_inf)
+        from_two = tf.pad(alpha[:, :-2], [[0, 0], [2, 0]], constant_values=neg_inf)
+        from_two = tf.where(can_skip, from_two, neg_inf)
+        new_alpha = tf.reduce_logsumexp(tf.stack([alpha, from_one, from_two]), axis=0) + emit_t
+        new_alpha = tf.where(valid_state, new_alpha, neg_inf)
+        # Samples past their own input length keep their final alpha
+        return tf.where((t < input_length)[:, tf.newaxis], new_alpha, alpha)
+
+    alpha = tf.foldl(step, (emit[1:], tf.range(1, n_steps)), initializer=alpha)
+
+    # The path ends on the last label or the trailing blank
+    last_blank = tf.gather(alpha, 2 * label_length, axis=1, batch_dims=1)
+    last_label = tf.gather(alpha, tf.maximum(2 * label_length - 1, 0), axis=1, batch_dims=1)
+    last_label = tf.where(label_length > 0, last_label, neg_inf)
+    log_likelihood = tf.reduce_logsumexp(tf.stack([last_blank, last_label]), axis=0)
+
+    return -tf.reshape(log_likelihood, (-1, 1))
+
+
+class PositionalEncoding(layers.Layer):
+
+    '''
+    Adds the sinusoidal encoding of the time step to the features, so that self-attention, which is
+    otherwise blind to the order of the columns, knows where each one is.
+    '''
+
+    def call(self, x):
+        steps, width = tf.shape(x)[1], x.shape[-1]
+        position = tf.cast(tf.range(steps), tf.float32)[:, None]
+        rates = 1 / tf.pow(10000.0, tf.cast(2 * (tf.range(width) // 2), tf.float32) / width)
+        angles = position * rates[None]
+        encoding = tf.where(tf.range(width) % 2 == 0, tf.sin(angles), tf.cos(angles))
+        return x + tf.cast(encoding, x.dtype)[None]
+
+
+def sequence_encoder(x, encoder : str, units, dropout : float):
+    '''
+    Builds the sequence encoder between the encoding space and the output layer.
+
+    Arguments :
+        x       : The encoding space, of shape (batch, time steps, features).
+        encoder : One of ENCODERS.
+        units   : The units of each bidirectional recurrent layer; the parallel encoders build one block
+                  of 2 * units features per entry.
+        dropout : The dropout rate inside the layers.
+
+    Return:
+        x : The encoded sequence, with one output per time step.
+    '''
+
+    if encoder in ('lstm', 'gru'):
+        recurrent = layers.LSTM if encoder == 'lstm' else layers.GRU
+        for block_units in units:
+            x = layers.Bidirectional(recurrent(block_units, return_sequences=True, dropout=dropout))(x)
+        return x
+
+    for block, block_units in enumerate(units):
+        width = 2 * block_units
+        if x.shape[-1] != width:
+            x = layers.Dense(width, kernel_initializer='he_normal')(x)
+
+        if encoder == 'conv':
+            # Residual dilated convolutions : the receptive field doubles with every layer
+            for dilation in DILATIONS:
+                y = layers.Conv1D(
+                    width, kernel_size=3, dilation_rate=dilation, padding='same', activation='relu',
+                    kernel_initializer='he_normal'
+                )(x)
+                x = layers.Add()([x, layers.Dropout(dropout)(y)])
+            x = layers.LayerNormalization()(x)
+        else:
+            # Self-attention over every time step, then a position-wise feed forward layer
+            if block == 0:
+                x = PositionalEncoding()(x)
+            y = layers.MultiHeadAttention(
+                num_heads=ATTENTION_HEADS, key_dim=max(width // ATTENTION_HEADS, 1), dropout=dropout
+            )(x, x)
+            x = layers.LayerNormalization()(layers.Add()([x, y]))
+            y = layers.Dense(2 * width, activation='relu', kernel_initializer='he_normal')(x)
+            y = layers.Dropout(dropout)(layers.Dense(width)(y))
+            x = layers.LayerNormalization()(layers.Add()([x, y]))
+    return x
+
+
+class CTCLayer(layers.Layer):
+
+    def __init__(self, xla : bool = False, **kwargs) -> None:
+        super().__init__(**kwargs)
+
+        # The XLA compatible loss is used when the training step is compiled with XLA
+        self.xla = xla
+        self.loss_fn = ctc_batch_cost_xla if xla else keras.backend.ctc_batch_cost
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'xla': self.xla})
+        return config
+
+    def call(self, y_true, y_pred, input_length=None, label_length=None):
+
+        batch_len = tf.cast(tf.shape(y_true)[0], dtype='int64')
+
+        # Without explicit lengths every image spans all time steps and every label its padded length
+        if input_length is None:
+            input_len = tf.cast(tf.shape(y_pred)[1], dtype='int64') * tf.ones(shape=(batch_len, 1), dtype='int64')
+        else:
+            input_len = tf.reshape(tf.cast(input_length, dtype='int64'), (-1, 1))
+
+        if label_length is None:
+            label_len = tf.cast(tf.shape(y_true)[1], dtype='int64') * tf.ones(shape=(batch_len, 1), dtype='int64')
+        else:
+            label_len = tf.reshape(tf.cast(label_length, dtype='int64'), (-1, 1))
+
+        loss = self.loss_fn(y_true, y_pred, input_len, label_len)
+
+        self.add_loss(loss)
+
+        return y_pred
+
+
+def build_ocr_model(
+    n_outputs : int,
+    conv_filters = ARCHITECTURES['small']['conv_filters'],
+    dense_units = ARCHITECTURES['small']['dense_units'],
+    dropout : float = ARCHITECTURES['small']['dropout'],
+    lstm_units = ARCHITECTURES['small']['lstm_units'],
+    lstm_dropout : float = 0.25,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+    xla : bool = False,
+    encoder : str = 'lstm',
+    separable : bool = False,
+):
+    '''
+    Builds the CNN + BiLSTM OCR model with its CTC layer, and the matching inference model.
+
+    Arguments :
+        n_outputs    : The size of the softmax output, len(char_to_num.get_vocabulary()) + 1.
+        conv_filters : The filters of the convolutions of each block; every block ends with a 2x2 max pool.
+        dense_units  : The units of the dense layers of the encoding space.
+        dropout      : The dropout rate after the encoding space.
+        lstm_units   : The units of each bidirectional recurrent layer, or block of the parallel encoders.
+        lstm_dropout : The dropout rate inside the sequence encoder.
+        img_height   : The image height.
+        img_width    : The image width, or None for variable width inputs. A variable width model takes
+                       two extra inputs, 'input_length' (width // 4) and 'label_length'.
+        xla          : Whether the CTC layer uses the XLA compatible loss, for ``compile(jit_compile=True)``.
+        encoder      : The sequence encoder, one of ENCODERS; 'conv' and 'attention' process every time
+                       step in parallel. Self-attention also attends to the padding of variable width batches.
+        separable    : Whether the convolutions after the first are depthwise separable, which needs
+                       fewer multiplications per pixel.
+
+    Returns:
+        model           : The training model, with the CTC loss.
+        inference_model : The model mapping images to per-timestep probabilities.
+    '''
+
+    if encoder not in ENCODERS:
+        raise ValueError(f'Unknown encoder {encoder!r}, expected one of {ENCODERS}')
+
+    # Input Layer
+    input_images = layers.Input(shape=(img_width, img_height, 1), name="image")
+
+    # Labels : These are added for the training purpose.
+    target_labels = layers.Input(shape=(None, ), name="label")
+
+    # CNN Network
+    x = input_images
+    for block in conv_filters:
+        for filters in block:
+            # A depthwise separable convolution has nothing to gain on the single channel input
+            if separable and x is not input_images:
+                convolution = layers.SeparableConv2D(
+                    filters=filters,
+                    kernel_size=3,
+                    strides=1,
+                    padding='same',
+                    activation='relu',
+                    pointwise_initializer='he_normal'
+                )
+            else:
+                convolution = layers.Conv2D(
+                    filters=filters,
+                    kernel_size=3,
+                    strides=1,
+                    padding='same',
+                    activation='relu',
+                    kernel_initializer='he_normal'
+                )
+            x = convolution(x)
+        x = layers.MaxPool2D(pool_size=(2,2), strides=(2,2))(x)
+
+    # Encoding Space : one time step per DOWNSAMPLE columns of the image
+    encoding = layers.Reshape(target_shape=(-1, (img_height//DOWNSAMPLE)*conv_filters[-1][-1]))(x)
+    for units in dense_units:
+        encoding = layers.Dense(units, activation='relu', kernel_initializer='he_normal')(encoding)
+    encoding = layers.Dropout(dropout)(encoding)
+
+    # Sequence encoder : the BiLSTMs of the notebook by default
+    x = sequence_encoder(encoding, encoder, lstm_units, lstm_dropout)
+
+    # Output Layer : kept in float32 under a mixed precision policy, for a numerically safe softmax and loss
+    output = layers.Dense(n_outputs, activation='softmax', dtype='float32')(x)
+
+    # CTC Layer
+    if img_width is None:
+        input_length = layers.Input(shape=(1, ), name="input_length", dtype='int64')
+        label_length = layers.Input(shape=(1, ), name="label_length", dtype='int64')
+        ctc_layer = CTCLayer(xla=xla, dtype='float32')(target_labels, output, input_length, label_length)
+        inputs = [input_images, target_labels, input_length, label_length]
+    else:
+        ctc_layer = CTCLayer(xla=xla, dtype='float32')(target_labels, output)
+        inputs = [input_images, target_labels]
+
+    # Model
+    model = keras.Model(inputs=inputs, outputs=[ctc_layer])
+    inference_model = keras.Model(inputs=input_images, outputs=output)
+
+    return model, inference_model
+
+
+def inference_model_from(model):
+    '''
+    Returns the inference model of a training model, e.g. one loaded from Handwritten-OCR.keras : the
+    model from the image input to the softmax output feeding the CTC layer.
+    '''
+
+    softmax = [layer for layer in model.layers if isinstance(layer, layers.Dense)][-1]
+    return keras.Model(inputs=model.get_layer('image').output, outputs=softmax.output)
+
+
+def load_inference_model(path : str):
+    '''
+    Loads a saved training model (.keras, with its CTC layer) and returns its inference model.
+    '''
+
+    model = keras.models.load_model(
+        path, custom_objects={'CTCLayer': CTCLayer, 'PositionalEncoding': PositionalEncoding}, compile=False
+    )
+    return inference_model_from(model)
@@ -0,0 +1,413 @@
+'''
+Persistent cache of model predictions, keyed by a fingerprint of the weights and a hash of the image.
+
+Evaluating, plotting or batch transcribing the same images again repeats identical forward passes,
+in every notebook cell and after every kernel restart. ``PredictionCache`` keeps the result of each pass
+in an SQLite database, like ``ImageCache`` does for the preprocessed pixels. The key of a prediction is
+the hash of
+
+* the model fingerprint : the shapes, dtypes and values of every weight, so a retrained or fine-tuned
+  model never reads the predictions of its former weights (a .tflite artifact is fingerprinted by its
+  file contents);
+* the image content : the preprocessed float32 pixels the model actually reads.
+
+Each entry holds the decoded text and its confidence, the best path probability, tagged with the
+decoder settings that produced them. It can also hold the per-timestep probabilities, zlib
+compressed and exact. With them, a different decoder (beam search, another maximum length) is served
+from the cache too, since only the decoding is redone. The cache is capped in size with least recently
+used eviction.
+
+Hashing the weights costs a sizeable share of a forward pass, so the cache remembers the fingerprint of
+each model and only takes it again once the weights changed. For a Keras model that is checked on
+every call with an exact integer checksum of the bits of every variable, computed in one compiled
+graph, so it sees training, ``load_weights`` and the training of another model the layers are shared
+with alike (the notebook's inference models are never compiled themselves). A .tflite artifact is
+checked by the modification time and size of its file.
+
+    prediction_cache = PredictionCache('/kaggle/working/prediction_cache')
+    cached_model = CachedModel(inference_model_2, prediction_cache, greedy_decoder)
+    evaluate(cached_model, dataset, decode_pred)     # the second time, without running the model
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+
+import numpy as np
+
+# Default size cap of the cache, in bytes
+MAX_BYTES = 2 * 1024 ** 3
+
+# Bumped whenever the stored format changes
+CACHE_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS predictions (
+    key TEXT PRIMARY KEY,
+    decoder TEXT,
+    text TEXT,
+    confidence REAL,
+    logits BLOB,
+    steps INTEGER,
+    nbytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+'''
+
+
+def model_fingerprint(model) -> str:
+    '''
+    Returns a hash of the weights of a Keras model, or of the file of a TFLiteRunner.
+    '''
+
+    digest = hashlib.sha1(f'v{CACHE_VERSION}'.encode())
+    if hasattr(model, 'get_weights'):
+        for weight in model.get_weights():
+            digest.update(f'{weight.dtype}{weight.shape}'.encode())
+            digest.update(np.ascontiguousarray(weight).tobytes())
+    else:
+        with open(model.path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+# Compiled checksum of a list of variables, built on first use so that TensorFlow is only imported then
+_checksum = None
+
+
+def _variables_checksum(variables):
+    global _checksum
+    import tensorflow as tf
+
+    if _checksum is None:
+        integer_types = {1: tf.int8, 2: tf.int16, 4: tf.int32, 8: tf.int64}
+
+        @tf.function(reduce_retracing=True)
+        def checksum(variables):
+            # The bits of every value read as integers and summed exactly : any change of a value shows
+            sums = []
+            for variable in variables:
+                values = tf.cast(variable, tf.int8) if variable.dtype == tf.bool else variable
+                bits = tf.bitcast(values, integer_types[values.dtype.size])
+                sums.append(tf.reduce_sum(tf.cast(bits, tf.int64)))
+            return tf.stack(sums)
+
+        _checksum = checksum
+
+    # Recent Keras versions wrap the TensorFlow variables, which the compiled graph then reads directly
+    variables = [variable if isinstance(variable, tf.Variable) else variable.value for variable in variables]
+    return _checksum(variables)
+
+
+def _weights_version(model):
+    '''
+    Returns what changes with the weights : a checksum of the variables of a Keras model, the
+    modification time and size of the file of a TFLiteRunner.
+    '''
+
+    if hasattr(model, 'get_weights'):
+        return tuple(_variables_checksum(model.weights).numpy().tolist()) if model.weights else ()
+    stat = os.stat(model.path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def decoder_tag(decoder) -> str:
+    '''
+    Returns a description of the decoder settings that change the decoded strings.
+    '''
+
+    settings = [type(decoder).__name__, hashlib.sha1('\n'.join(decoder.vocabulary).encode()).hexdigest()]
+    for name in ('max_length', 'beam_width', 'prune_threshold', 'greedy_threshold'):
+        if hasattr(decoder, name):
+            settings.append(f'{name}={getattr(decoder, name)}')
+    trie = getattr(decoder, 'trie', None)
+    if trie is not None:
+        settings.append(hashlib.sha1('\n'.join(sorted(trie.words)).encode()).hexdigest())
+    return ':'.join(settings)
+
+
+class PredictionCache:
+
+    '''
+    A size capped store of predictions shared by every model, split and decoder.
+
+    Arguments :
+        directory    : The directory holding the cache database.
+        max_bytes    : The size cap of the stored entries; least recently used ones are evicted above it.
+        store_logits : Whether the per-timestep probabilities are stored with the texts.
+    '''
+
+    def __init__(self, directory : str, max_bytes : int = MAX_BYTES, store_logits : bool = True) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store_logits = store_logits
+        self.hits = 0
+        self.misses = 0
+        # Running size of the entries, checked against the cap on every write and re-read when evicting
+        self._bytes = None
+        # Weights version and fingerprint of every model seen, see fingerprint
+        self._fingerprints = weakref.WeakKeyDictionary()
+
+        os.makedirs(directory, exist_ok=True)
+        self.db_path = os.path.join(directory, 'predictions.sqlite')
+        self._local = threading.local()
+
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        '''
+        Returns the connection of the calling thread.
+        '''
+
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=60)
+            self._local.db = db
+        return db
+
+    def fingerprint(self, model) -> str:
+        '''
+        Returns the ``model_fingerprint`` of a model, taken again only when its weights changed.
+        '''
+
+        version = _weights_version(model)
+        known = self._fingerprints.get(model)
+        if known is None or known[0] != version:
+            known = (version, model_fingerprint(model))
+            self._fingerprints[model] = known
+        return known[1]
+
+    def keys(self, fingerprint : str, images):
+        '''
+        Returns the cache key of every image of a batch for a model.
+
+        Arguments :
+            fingerprint : The ``model_fingerprint`` of the model.
+            images      : A batch of preprocessed images in the model layout.
+        '''
+
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        prefix = f'{fingerprint}:{images.shape[1:]}'.encode()
+        return [hashlib.sha1(prefix + image.tobytes()).hexdigest() for image in images]
+
+    def _rows(self, keys) -> dict:
+        db = self._connect()
+        rows = {}
+        unique = list(set(keys))
+        for start in range(0, len(unique), 900):
+            chunk = unique[start:start + 900]
+            marks = ','.join('?' * len(chunk))
+            for row in db.execute(
+                f'SELECT key, decoder, text, confidence, logits, steps FROM predictions WHERE key IN ({marks})', chunk
+            ):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def _touch(self, keys):
+        with self._connect() as db:
+            db.executemany('UPDATE predictions SET last_used = ? WHERE key = ?', [(time.time(), key) for key in keys])
+
+    @staticmethod
+    def _pack(probs):
+        # The bytes of every float32 are grouped by significance first, which zlib compresses much better
+        probs = np.ascontiguousarray(probs, dtype=np.float32)
+        return zlib.compress(probs.view(np.uint8).reshape(-1, 4).T.tobytes())
+
+    @staticmethod
+    def _unpack(logits, steps : int):
+        shuffled = np.frombuffer(zlib.decompress(logits), dtype=np.uint8).reshape(4, -1)
+        return np.ascontiguousarray(shuffled.T).view(np.float32).reshape(steps, -1)
+
+    def _put(self, keys, probs, tag : str = None, texts = None, confidences = None):
+        rows, added = [], 0
+        for index, key in enumerate(keys):
+            logits = self._pack(probs[index]) if self.store_logits else None
+            text = None if texts is None else texts[index]
+            confidence = None if confidences is None else float(confidences[index])
+            nbytes = len(key) + len(text or '') + len(logits or b'')
+            added += nbytes
+            rows.append((key, tag if texts is not None else None, text, confidence, logits, probs.shape[1], nbytes, time.time()))
+        with self._connect() as db:
+            db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        if self._bytes is None or self._bytes + added > self.max_bytes:
+            self.evict()
+        else:
+            self._bytes += added
+
+    def predict(self, model, images, decoder):
+        '''
+        Decodes a batch of images with their confidences, running the model on the missing ones only.
+        An entry decoded by another decoder is decoded again from its stored probabilities.
+
+        Arguments :
+            model   : The inference model, or a TFLiteRunner.
+            images  : A batch of preprocessed images in the model layout.
+            decoder : The decoder, e.g. greedy_decoder.
+
+        Returns:
+            texts       : The decoded strings.
+            confidences : A float32 array of the best path probabilities.
+        '''
+
+        images = np.asarray(images, dtype=np.float32)
+        keys = self.keys(self.fingerprint(model), images)
+        rows = self._rows(keys)
+        tag = decoder_tag(decoder)
+
+        texts, confidences = [None] * len(keys), np.zeros(len(keys), dtype=np.float32)
+        redecode, missing = [], []
+        for index, key in enumerate(keys):
+            row = rows.get(key)
+            if row is not None and row[0] == tag:
+                texts[index], confidences[index] = row[1], row[2]
+            elif row is not None and row[3] is not None:
+                redecode.append(index)
+            else:
+                missing.append(index)
+
+        if redecode:
+            probs = np.stack([self._unpack(rows[keys[index]][3], rows[keys[index]][4]) for index in redecode])
+            batch_texts, batch_confidences = decoder.decode_with_confidence(probs)
+            self._update(tag, [keys[index] for index in redecode], batch_texts, batch_confidences, rows)
+            for index, text, confidence in zip(redecode, batch_texts, batch_confidences):
+                texts[index], confidences[index] = text, confidence
+
+        if missing:
+            probs = np.asarray(model.predict_on_batch(images[missing]))
+            batch_texts, batch_confidences = decoder.decode_with_confidence(probs)
+            self._put([keys[index] for index in missing], probs, tag, batch_texts, batch_confidences)
+            for index, text, confidence in zip(missing, batch_texts, batch_confidences):
+                texts[index], confidences[index] = text, confidence
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        missing = set(missing)
+        self._touch([key for index, key in enumerate(keys) if index not in missing])
+        return texts, confidences
+
+    def _update(self, tag : str, keys, texts, confidences, rows : dict):
+        # The size of an entry counts its text, so it changes with the text (rows holds the previous ones)
+        updates, added = [], 0
+        for key, text, confidence in zip(keys, texts, confidences):
+            nbytes = len(key) + len(text) + len(rows[key][3])
+            added += len(text) - len(rows[key][1] or '')
+            updates.append((tag, text, float(confidence), nbytes, key))
+        with self._connect() as db:
+            db.executemany(
+                'UPDATE predictions SET decoder = ?, text = ?, confidence = ?, nbytes = ? WHERE key = ?', updates
+            )
+        if self._bytes is not None:
+            self._bytes += added
+
+    def probabilities(self, model, images, decoder = None):
+        '''
+        Returns the per-timestep probabilities of a batch, running the model on the images whose
+        probabilities are not stored.
+
+        Arguments :
+            model   : The inference model, or a TFLiteRunner.
+            images  : A batch of preprocessed images in the model layout.
+            decoder : A decoder whose texts and confidences are stored with new entries, if any.
+
+        Return:
+            probs : A float32 array of shape (batch, time steps, classes).
+        '''
+
+        if not self.store_logits:
+            raise ValueError('The cache does not store probabilities; create it with store_logits=True')
+
+        images = np.asarray(images, dtype=np.float32)
+        keys = self.keys(self.fingerprint(model), images)
+        rows = self._rows(keys)
+        missing = [index for index, key in enumerate(keys) if rows.get(key, (None,) * 5)[3] is None]
+
+        probs = [None] * len(keys)
+        for index, key in enumerate(keys):
+            if rows.get(key, (None,) * 5)[3] is not None:
+                probs[index] = self._unpack(rows[key][3], rows[key][4])
+
+        if missing:
+            pred = np.asarray(model.predict_on_batch(images[missing]), dtype=np.float32)
+            texts = confidences = None
+            if decoder is not None:
+                texts, confidences = decoder.decode_with_confidence(pred)
+            self._put([keys[index] for index in missing], pred, decoder_tag(decoder) if decoder else None, texts, confidences)
+            for index, sample in zip(missing, pred):
+                probs[index] = sample
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        missing = set(missing)
+        self._touch([key for index, key in enumerate(keys) if index not in missing])
+        return np.stack(probs)
+
+    def evict(self):
+        '''
+        Deletes least recently used entries until the cache is under its size cap.
+        '''
+
+        db = self._connect()
+        total = db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM predictions').fetchone()[0]
+        self._bytes = total
+        if total <= self.max_bytes:
+            return
+
+        victims, freed = [], 0
+        for key, nbytes in db.execute('SELECT key, nbytes FROM predictions ORDER BY last_used'):
+            if total - freed <= self.max_bytes:
+                break
+            victims.append((key,))
+            freed += nbytes
+        with db:
+            db.executemany('DELETE FROM predictions WHERE key = ?', victims)
+        self._bytes = total - freed
+
+    def stats(self) -> dict:
+        '''
+        Returns the hits and misses of this session and the number and size of the stored entries.
+        '''
+
+        entries, nbytes = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM predictions'
+        ).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': nbytes}
+
+
+class CachedModel:
+
+    '''
+    An inference model answering from a ``PredictionCache``, for code that calls ``predict_on_batch``
+    or ``predict`` and decodes the probabilities itself : ``evaluate``, ``show_images``, the reports.
+    Every other attribute is the model's. The fingerprint is taken again once the weights changed, by
+    training or otherwise (see ``PredictionCache.fingerprint``), so it never reads its former predictions.
+
+    Arguments :
+        model   : The inference model, or a TFLiteRunner.
+        cache   : The prediction cache; it must store the probabilities.
+        decoder : A decoder whose texts and confidences are stored along, e.g. greedy_decoder, so the
+                  batch job and the cascade find them too.
+    '''
+
+    def __init__(self, model, cache : PredictionCache, decoder = None) -> None:
+        self.model = model
+        self.cache = cache
+        self.decoder = decoder
+
+    def predict_on_batch(self, images):
+        return self.cache.probabilities(self.model, images, self.decoder)
+
+    def predict(self, images, verbose = None, **kwargs):
+        return self.predict_on_batch(images)
+
+    def __call__(self, images, training = False):
+        return self.predict_on_batch(images)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
@@ -0,0 +1,42 @@
+'''
+Image preprocessing shared by the notebook and the data readers.
+'''
+
+import tensorflow as tf
+
+# Image Size
+IMG_WIDTH = 200
+IMG_HEIGHT = 50
+
+
+def decode_image(contents, img_height : int = IMG_HEIGHT, img_width : int = IMG_WIDTH):
+    '''
+    Decodes the raw bytes of a JPEG into the model input layout. The image is decoded as a single
+    channel, converted to float32 in [0, 1], resized to (img_height, img_width) and transposed so
+    that the width becomes the time axis.
+
+    Arguments :
+        contents   : A scalar string tensor holding the encoded JPEG.
+        img_height : The height the image is resized to.
+        img_width  : The width the image is resized to.
+
+    Return:
+        image : The image tensor of shape (img_width, img_height, 1).
+    '''
+
+    # Decode the image
+    decoded_image = tf.image.decode_jpeg(contents = contents, channels = 1)
+
+    # Convert image data type.
+    cnvt_image = tf.image.convert_image_dtype(image = decoded_image, dtype = tf.float32)
+
+    # Resize the image
+    resized_image = tf.image.resize(images = cnvt_image, size = (img_height, img_width))
+
+    # Transpose
+    image = tf.transpose(resized_image, perm = [1, 0, 2])
+
+    # Convert image to a tensor.
+    image = tf.cast(image, dtype = tf.float32)
+
+    return image
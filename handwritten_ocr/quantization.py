@@ -0,0 +1,353 @@
+'''
+Post-training quantized export of the OCR inference models.
+
+``export_tflite`` converts an inference model (``inference_model`` / ``inference_model_2``) to a
+TensorFlow Lite flatbuffer, either with dynamic-range quantization (int8 weights, float activations)
+or with full integer quantization calibrated on images drawn from ``valid_ds``. ``TFLiteRunner`` runs
+the artifact on CPU behind the same ``predict_on_batch`` interface as a Keras model, so it plugs
+straight into ``evaluation.evaluate``. ``compare_models`` reports size, latency and CER of the float
+model against the quantized artifacts.
+
+The recurrent layers only convert to fused TensorFlow Lite LSTM kernels with a static batch size, and
+the converted graph cannot be resized afterwards, so an artifact serves one batch size. ``export_tflite``
+can write extra artifacts for other batch sizes next to the main one (``name.b1.tflite`` ...), and
+``TFLiteRunner`` runs each batch on the smallest artifact it fits, padding only what does not match
+exactly. ``compare_models`` only times a TensorFlow Lite model at the batch sizes it has an artifact for,
+so its latencies are never those of a padded batch. The artifact also holds batch sized state buffers,
+so a smaller export batch gives a smaller file.
+'''
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.evaluation import evaluate
+
+# Supported quantization modes
+MODES = ('float32', 'dynamic', 'int8')
+
+# Batch size the artifacts are exported with
+EXPORT_BATCH_SIZE = 16
+
+
+def calibration_images(dataset, n_samples : int = 512):
+    '''
+    Collects the calibration images for full integer quantization.
+
+    Arguments :
+        dataset   : A batched dataset of {'image', 'label'} dictionaries, e.g. valid_ds.
+        n_samples : The number of images used for calibration.
+
+    Return:
+        images : A float32 array of at most ``n_samples`` images.
+    '''
+
+    images, seen = [], 0
+    for batch in dataset:
+        images.append(batch['image'].numpy())
+        seen += len(images[-1])
+        if seen >= n_samples:
+            break
+    return np.concatenate(images)[:n_samples]
+
+
+def batch_artifact_path(path : str, batch_size : int) -> str:
+    '''
+    Returns the path of the artifact exported for another batch size next to ``path``.
+    '''
+
+    stem, extension = os.path.splitext(path)
+    return f'{stem}.b{batch_size}{extension}'
+
+
+def _batch_artifacts(path : str):
+    stem, extension = os.path.splitext(path)
+    return [
+        other for other in glob.glob(glob.escape(stem) + '.b*' + extension)
+        if other[len(stem) + 2:len(other) - len(extension)].isdigit()
+    ]
+
+
+def _save_fixed_batch(model, saved_dir : str, batch_size : int):
+    '''
+    Saves the model as a SavedModel whose serving signature has a static batch dimension.
+    '''
+
+    spec = tf.TensorSpec([batch_size, *model.input_shape[1:]], tf.float32)
+    try:
+        # Keras 3
+        model.export(saved_dir, format='tf_saved_model', input_signature=[spec], verbose=False)
+    except (AttributeError, TypeError):
+        serve = tf.function(lambda images: model(images, training=False))
+        tf.saved_model.save(model, saved_dir, signatures=serve.get_concrete_function(spec))
+
+
+def _convert(saved_dir : str, path : str, mode : str, calibration : str = None, batch_size : int = EXPORT_BATCH_SIZE):
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_dir)
+    if mode != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        images = np.load(calibration)
+
+        def representative():
+            for start in range(0, len(images) - batch_size + 1, batch_size):
+                yield [images[start:start + batch_size]]
+
+        converter.representative_dataset = representative
+        # Ops without an int8 kernel fall back to float; inputs and outputs stay float32 so the
+        # artifact is a drop-in replacement.
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+        ]
+
+    with open(path, 'wb') as file:
+        file.write(converter.convert())
+
+
+def export_tflite(
+    model,
+    path : str,
+    mode : str = 'dynamic',
+    calibration = None,
+    batch_size : int = EXPORT_BATCH_SIZE,
+    extra_batch_sizes = (),
+) -> str:
+    '''
+    Converts an inference model to a TensorFlow Lite artifact.
+
+    Arguments :
+        model       : The Keras inference model.
+        path        : The .tflite file to write.
+        mode        : 'float32' (no quantization), 'dynamic' (int8 weights) or 'int8' (int8 weights and
+                      activations; needs ``calibration``).
+        calibration : The calibration images returned by ``calibration_images``, at least as many as
+                      the largest batch size since calibration runs in full batches.
+        batch_size  : The static batch size of the artifact.
+        extra_batch_sizes : Other batch sizes an artifact is written for, at ``batch_artifact_path``.
+
+    Return:
+        path : The written file.
+    '''
+
+    if mode not in MODES:
+        raise ValueError(f'Unknown quantization mode {mode!r}, expected one of {MODES}')
+    if mode == 'int8' and calibration is None:
+        raise ValueError('Full integer quantization needs calibration images')
+    largest = max([batch_size, *extra_batch_sizes])
+    if mode == 'int8' and len(calibration) < largest:
+        raise ValueError(
+            f'Full integer quantization at batch size {largest} needs at least {largest} calibration '
+            f'images, got {len(calibration)}'
+        )
+
+    # Artifacts of an earlier export would be loaded by TFLiteRunner alongside the new one
+    for stale in _batch_artifacts(path):
+        os.remove(stale)
+    for extra in sorted(set(extra_batch_sizes) - {batch_size}):
+        _export(model, batch_artifact_path(path, extra), mode, calibration, extra)
+    return _export(model, path, mode, calibration, batch_size)
+
+
+def _export(model, path : str, mode : str, calibration, batch_size : int) -> str:
+    with tempfile.TemporaryDirectory() as saved_dir:
+        _save_fixed_batch(model, saved_dir, batch_size)
+
+        if mode != 'int8':
+            _convert(saved_dir, path, mode)
+            return path
+
+        # Calibrating the recurrent layers can crash the converter outright on some TensorFlow
+        # versions, so the int8 conversion runs in a child process that cannot take the kernel down.
+        calibration_path = os.path.join(saved_dir, 'calibration.npy')
+        np.save(calibration_path, np.asarray(calibration, dtype=np.float32))
+        result = subprocess.run(
+            [sys.executable, '-m', 'handwritten_ocr.quantization', saved_dir, path,
+             '--mode', mode, '--calibration', calibration_path, '--batch-size', str(batch_size)],
+            capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f'int8 conversion failed (exit code {result.returncode}):\n{result.stderr[-2000:]}'
+            )
+    return path
+
+
+class TFLiteRunner:
+
+    '''
+    Runs a TensorFlow Lite artifact on CPU with the ``predict_on_batch`` interface of a Keras model.
+    The artifacts exported next to it for other batch sizes (see ``batch_artifact_path``) are loaded too.
+
+    Arguments :
+        path        : The .tflite file.
+        num_threads : The number of interpreter threads; None lets TensorFlow Lite decide.
+    '''
+
+    def __init__(self, path : str, num_threads : int = None) -> None:
+        self.path = path
+        self.interpreter, self.input, self.output = self._load(path, num_threads)
+        self.batch_size = int(self.input['shape'][0])
+
+        # Interpreter, input and output details by static batch size
+        self.interpreters = {self.batch_size: (self.interpreter, self.input, self.output)}
+        for other in _batch_artifacts(path):
+            details = self._load(other, num_threads)
+            self.interpreters.setdefault(int(details[1]['shape'][0]), details)
+        self.batch_sizes = sorted(self.interpreters)
+
+    @staticmethod
+    def _load(path : str, num_threads : int):
+        interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        interpreter.allocate_tensors()
+        return interpreter, interpreter.get_input_details()[0], interpreter.get_output_details()[0]
+
+    def _invoke(self, images, batch_size : int = None):
+        interpreter, input, output = self.interpreters[batch_size or self.batch_size]
+        scale, zero_point = input['quantization']
+        if input['dtype'] != np.float32:
+            images = np.round(images / scale + zero_point).astype(input['dtype'])
+
+        interpreter.set_tensor(input['index'], images)
+        interpreter.invoke()
+        pred = interpreter.get_tensor(output['index'])
+
+        scale, zero_point = output['quantization']
+        if output['dtype'] != np.float32:
+            pred = (pred.astype(np.float32) - zero_point) * scale
+        return pred
+
+    def predict_on_batch(self, images):
+        '''
+        Runs a batch of preprocessed images of any size, in chunks of the largest artifact batch size.
+        Every chunk runs on the smallest artifact it fits, zero padded if the sizes differ.
+
+        Argument :
+            images : A float32 array of shape (batch, IMG_WIDTH, IMG_HEIGHT, 1).
+
+        Return:
+            pred : The per-timestep probabilities, as float32.
+        '''
+
+        images = np.asarray(images, dtype=np.float32)
+        largest = self.batch_sizes[-1]
+        outputs = []
+        for start in range(0, len(images), largest):
+            chunk = images[start:start + largest]
+            n_valid = len(chunk)
+            batch_size = min(size for size in self.batch_sizes if size >= n_valid)
+            if n_valid < batch_size:
+                padding = np.zeros((batch_size - n_valid, *chunk.shape[1:]), dtype=np.float32)
+                chunk = np.concatenate([chunk, padding])
+            outputs.append(self._invoke(chunk, batch_size)[:n_valid])
+        return np.concatenate(outputs)
+
+    def __call__(self, images):
+        return self.predict_on_batch(images)
+
+
+def _model_size(model) -> int:
+    if isinstance(model, TFLiteRunner):
+        return os.path.getsize(model.path)
+    return int(sum(np.asarray(weight).nbytes for weight in model.get_weights()))
+
+
+def measure_latency(model, images, n_runs : int = 20) -> float:
+    '''
+    Returns the median wall time of ``model.predict_on_batch(images)`` in milliseconds, after a warm-up.
+    '''
+
+    model.predict_on_batch(images)
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        model.predict_on_batch(images)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+def compare_models(models : dict, dataset, decode, batch_sizes = (EXPORT_BATCH_SIZE,), n_runs : int = 20) -> dict:
+    '''
+    Compares models on size, latency and accuracy.
+
+    Arguments :
+        models      : Mapping of name to model (a Keras model or a TFLiteRunner).
+        dataset     : An evaluation dataset of (images, texts) batches, see ``build_eval_dataset``.
+        decode      : The batched decoding function, e.g. decode_pred.
+        batch_sizes : The batch sizes latency is measured at. A TFLiteRunner is only timed at the batch
+                      sizes it has an artifact for (see ``export_tflite``), never on a padded batch.
+        n_runs      : The number of timed runs per batch size.
+
+    Return:
+        report : Mapping of name to size in bytes, median latency per batch size (None when not
+                 measured) and evaluation metrics.
+    '''
+
+    def timed(model, batch_size):
+        return not isinstance(model, TFLiteRunner) or batch_size in model.batch_sizes
+
+    sample = next(iter(dataset.unbatch().batch(max(batch_sizes))))[0].numpy()
+
+    report = {}
+    for name, model in models.items():
+        metrics = evaluate(model, dataset, decode, verbose=False)
+        report[name] = {
+            'size_bytes': _model_size(model),
+            'latency_ms': {
+                batch_size: measure_latency(model, sample[:batch_size], n_runs) if timed(model, batch_size)
+                else None for batch_size in batch_sizes
+            },
+            'cer': metrics['cer'],
+            'wer': metrics['wer'],
+            'exact_match': metrics['exact_match'],
+        }
+    return report
+
+
+def format_comparison(report : dict) -> str:
+    '''
+    Formats the report of ``compare_models`` as a text table, with sizes relative to the first model.
+    '''
+
+    names = list(report)
+    base = report[names[0]]['size_bytes']
+    batch_sizes = list(report[names[0]]['latency_ms'])
+
+    header = f"{'Model':<16}{'Size (MB)':>10}{'Ratio':>7}" + ''.join(
+        f"{f'ms@{batch_size}':>10}" for batch_size in batch_sizes
+    ) + f"{'CER':>8}{'Exact':>8}"
+    lines = [header]
+    for name in names:
+        row = report[name]
+        lines.append(
+            f"{name:<16}{row['size_bytes'] / 1e6:>10.2f}{base / row['size_bytes']:>7.2f}"
+            + ''.join(
+                f"{'n/a':>10}" if latency is None else f"{latency:>10.2f}"
+                for latency in (row['latency_ms'][batch_size] for batch_size in batch_sizes)
+            )
+            + f"{row['cer']:>8.4f}{row['exact_match']:>8.4f}"
+        )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a fixed batch SavedModel to TensorFlow Lite.')
+    parser.add_argument('saved_dir', help='SavedModel directory')
+    parser.add_argument('path', help='.tflite file to write')
+    parser.add_argument('--mode', choices=MODES, default='dynamic')
+    parser.add_argument('--calibration', help='.npy file of calibration images (int8 mode)')
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    _convert(args.saved_dir, args.path, args.mode, args.calibration, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
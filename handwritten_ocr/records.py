@@ -0,0 +1,289 @@
+'''
+Sharded TFRecord storage for the handwriting images.
+
+Opening 331K tiny JPEGs one by one makes an epoch bound by file opens rather than by disk bandwidth.
+``pack_shards`` stores the raw JPEG bytes together with their ``IDENTITY`` label in a few hundred large
+TFRecord shards, and ``read_shards`` streams them back with parallel interleaved sequential reads.
+Given a ``Vocabulary``, the labels are also encoded once while packing and stored as padded class
+indices with their lengths, so training reads integer labels and never splits a string.
+
+Rows are shuffled once while packing, so every shard is a random sample of the split. At read time
+the shard order is reshuffled every epoch, several shards are read at once and a record level shuffle
+buffer mixes them, which together give a good shuffle without holding the data set in memory.
+
+Packing from the command line :
+    python -m handwritten_ocr.records \\
+        --csv /kaggle/input/handwriting-recognitionocr/CSV/written_name_train.csv \\
+        --image-dir /kaggle/input/handwriting-recognitionocr/train_v2/train \\
+        --output-dir /kaggle/working/shards --prefix train
+'''
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from handwritten_ocr.vocabulary import Vocabulary
+
+# Number of shards written per split
+NUM_SHARDS = 256
+
+# Number of shards read concurrently
+CYCLE_LENGTH = 16
+
+# Read buffer per open shard, in bytes
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Number of records held by the record level shuffle buffer
+SHUFFLE_BUFFER = 20000
+
+FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.string),
+    'filename': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def shard_pattern(output_dir : str, prefix : str) -> str:
+    '''
+    Returns the glob pattern matching every shard of a split.
+    '''
+
+    return os.path.join(output_dir, f'{prefix}-*.tfrecord')
+
+
+def manifest_path(output_dir : str, prefix : str) -> str:
+    '''
+    Returns the path of the manifest describing a packed split.
+    '''
+
+    return os.path.join(output_dir, f'{prefix}-manifest.json')
+
+
+def _bytes_feature(value : bytes):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def _write_shard(path : str, image_dir : str, filenames, labels, label_ids = None, label_lengths = None):
+    '''
+    Writes one shard; the file appears under its final name only once it is complete.
+    '''
+
+    tmp_path = path + '.tmp'
+    with tf.io.TFRecordWriter(tmp_path) as writer:
+        for index, (filename, label) in enumerate(zip(filenames, labels)):
+            with open(os.path.join(image_dir, filename), 'rb') as file:
+                image = file.read()
+            feature = {
+                'image': _bytes_feature(image),
+                'label': _bytes_feature(label.encode('UTF-8')),
+                'filename': _bytes_feature(filename.encode('UTF-8')),
+            }
+            if label_ids is not None:
+                feature['label_ids'] = _int64_feature(label_ids[index])
+                feature['label_length'] = _int64_feature([label_lengths[index]])
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            writer.write(example.SerializeToString())
+    os.replace(tmp_path, path)
+    return len(filenames)
+
+
+def pack_shards(
+    csv_path : str,
+    image_dir : str,
+    output_dir : str,
+    prefix : str,
+    num_shards : int = NUM_SHARDS,
+    num_workers : int = 8,
+    seed : int = 2569,
+    vocabulary = None,
+    max_label_length : int = None,
+    padding : int = None,
+) -> dict:
+    '''
+    Packs every image listed in a ``written_name_*.csv`` file into TFRecord shards. Shards that already
+    exist are left alone, so an interrupted packing run can simply be restarted, unless the manifest
+    shows they hold labels encoded differently; those are written again.
+
+    Arguments :
+        csv_path         : The CSV file with the FILENAME and IDENTITY columns.
+        image_dir        : The directory holding the images named in the CSV.
+        output_dir       : The directory the shards are written to.
+        prefix           : The shard name prefix, e.g. 'train'.
+        num_shards       : The number of shards to write.
+        num_workers      : The number of shards written concurrently.
+        seed             : The seed of the one-off row shuffle.
+        vocabulary       : A Vocabulary the labels are encoded with, stored as 'label_ids' and
+                           'label_length'; None stores the label strings only.
+        max_label_length : The padded length of the encoded labels (MAX_LABEL_LENGTH).
+        padding          : The padding index, see ``Vocabulary.encode``.
+
+    Return:
+        manifest : The manifest written next to the shards (record count, shard names and the label
+                   encoding, None when the labels are not encoded).
+    '''
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    csv = pd.read_csv(csv_path)
+    filenames = np.array(csv['FILENAME'].to_list(), dtype=object)
+    labels = np.array([str(word) for word in csv['IDENTITY'].to_numpy()], dtype=object)
+
+    # Shuffle once so that every shard is a random sample of the split
+    order = np.random.default_rng(seed).permutation(len(filenames))
+    filenames, labels = filenames[order], labels[order]
+
+    label_ids = label_lengths = encoding = None
+    if vocabulary is not None:
+        if max_label_length is None:
+            raise ValueError('Encoding the labels needs a max_label_length')
+        label_ids, label_lengths = vocabulary.encode(labels, max_label_length, padding=padding)
+        encoding = {
+            'fingerprint': vocabulary.fingerprint,
+            'max_label_length': int(max_label_length),
+            'padding': int(len(vocabulary) if padding is None else padding),
+        }
+
+    num_shards = max(1, min(num_shards, len(filenames)))
+    bounds = np.linspace(0, len(filenames), num_shards + 1).astype(int)
+    shards = [f'{prefix}-{index:05d}-of-{num_shards:05d}.tfrecord' for index in range(num_shards)]
+
+    # Shards packed with another label encoding would be left alone otherwise
+    previous = manifest_path(output_dir, prefix)
+    if os.path.exists(previous):
+        with open(previous) as file:
+            if json.load(file).get('label_encoding') != encoding:
+                for path in tf.io.gfile.glob(shard_pattern(output_dir, prefix)):
+                    os.remove(path)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = []
+        for index, shard in enumerate(shards):
+            path = os.path.join(output_dir, shard)
+            if os.path.exists(path):
+                continue
+            start, end = bounds[index], bounds[index + 1]
+            futures.append(executor.submit(
+                _write_shard, path, image_dir, filenames[start:end], labels[start:end],
+                None if label_ids is None else label_ids[start:end],
+                None if label_lengths is None else label_lengths[start:end],
+            ))
+        for future in futures:
+            future.result()
+
+    manifest = {'num_records': int(len(filenames)), 'shards': shards, 'label_encoding': encoding}
+    with open(manifest_path(output_dir, prefix), 'w') as file:
+        json.dump(manifest, file)
+
+    return manifest
+
+
+def parse_record(record):
+    '''
+    Parses a serialized example back into its raw JPEG bytes and label string.
+
+    Argument :
+        record : A serialized tf.train.Example.
+
+    Return:
+        image, label : The encoded JPEG and the label, both scalar string tensors.
+    '''
+
+    features = tf.io.parse_single_example(record, FEATURES)
+    return features['image'], features['label']
+
+
+def parse_encoded_record(record, max_label_length : int):
+    '''
+    Parses a serialized example packed with a vocabulary into its raw JPEG bytes and label indices.
+
+    Arguments :
+        record           : A serialized tf.train.Example.
+        max_label_length : The padded label length the shards were packed with.
+
+    Return:
+        image, label_ids : The encoded JPEG and the padded int64 label of shape (max_label_length,).
+    '''
+
+    features = tf.io.parse_single_example(record, {
+        'image': FEATURES['image'],
+        'label_ids': tf.io.FixedLenFeature([max_label_length], tf.int64),
+    })
+    return features['image'], features['label_ids']
+
+
+def read_shards(
+    pattern : str,
+    shuffle : bool = True,
+    cycle_length : int = CYCLE_LENGTH,
+    shuffle_buffer : int = SHUFFLE_BUFFER,
+    seed : int = None,
+    max_label_length : int = None,
+):
+    '''
+    Builds a dataset of (image_bytes, label) pairs from TFRecord shards. Shards are read sequentially,
+    ``cycle_length`` of them in parallel; when shuffling, the shard order changes every epoch and the
+    interleaved records pass through a shuffle buffer.
+
+    Arguments :
+        pattern          : The glob pattern of the shards, see ``shard_pattern``.
+        shuffle          : Whether to shuffle shards and records. Disable for validation and testing.
+        cycle_length     : The number of shards read concurrently.
+        shuffle_buffer   : The size of the record level shuffle buffer.
+        seed             : Optional seed for the shuffles.
+        max_label_length : For shards packed with a vocabulary, the padded label length; the labels
+                           are then read as their class indices rather than as strings.
+
+    Return:
+        dataset : A tf.data.Dataset yielding (image_bytes, label) pairs.
+    '''
+
+    files = tf.data.Dataset.list_files(pattern, shuffle=shuffle, seed=seed)
+
+    dataset = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=READ_BUFFER_SIZE),
+        cycle_length=cycle_length,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not shuffle,
+    )
+
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    if max_label_length is not None:
+        return dataset.map(
+            lambda record: parse_encoded_record(record, max_label_length), num_parallel_calls=tf.data.AUTOTUNE
+        )
+    return dataset.map(parse_record, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack handwriting images into TFRecord shards.')
+    parser.add_argument('--csv', required=True, help='written_name_*.csv file of the split')
+    parser.add_argument('--image-dir', required=True, help='directory holding the images')
+    parser.add_argument('--output-dir', required=True, help='directory to write the shards to')
+    parser.add_argument('--prefix', required=True, help="shard name prefix, e.g. 'train'")
+    parser.add_argument('--num-shards', type=int, default=NUM_SHARDS)
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--vocabulary', help='.vocab.json file the labels are encoded with')
+    args = parser.parse_args(argv)
+
+    vocabulary = Vocabulary.load(args.vocabulary) if args.vocabulary else None
+    manifest = pack_shards(
+        args.csv, args.image_dir, args.output_dir, args.prefix,
+        num_shards=args.num_shards, num_workers=args.num_workers, vocabulary=vocabulary,
+        max_label_length=vocabulary.max_label_length if vocabulary is not None else None
+    )
+    print(f"Packed {manifest['num_records']} records into {len(manifest['shards'])} shards")
+
+
+if __name__ == '__main__':
+    main()
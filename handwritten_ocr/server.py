@@ -0,0 +1,385 @@
+'''
+Asynchronous micro-batching inference server.
+
+Predicting one image per call spends most of the time in per-call overhead. ``MicroBatcher`` gathers
+concurrent requests into dynamic batches: the first request of a batch waits at most ``max_wait``
+seconds for others to join, up to ``max_batch_size``. Each batch then gets one forward pass and one
+batched decode. ``OCRServer`` puts a small HTTP/1.1 front end on it using only asyncio streams:
+
+    POST /predict   body: raw JPEG bytes   ->  {"text": "..."}; 400 with {"error": "..."} when the body
+                                               is not a valid image, 500 when the server fails
+    GET  /stats                            ->  p50/p99 latency, throughput, mean batch size
+    GET  /health                           ->  {"status": "ok"}
+
+Typical use, from a script that has built ``inference_model`` and ``decode_pred`` :
+
+    serve(inference_model, decode_pred, port=8500)
+
+``load_test`` is an asyncio client that replays JPEGs with a given concurrency and reports the client
+side latency percentiles and throughput.
+'''
+
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+
+# Largest number of requests served by one forward pass
+MAX_BATCH_SIZE = 64
+
+# Longest time the first request of a batch waits for others, in seconds
+MAX_WAIT = 0.005
+
+# Number of recent latencies kept for the percentiles
+STATS_WINDOW = 10000
+
+
+class InvalidImageError(ValueError):
+
+    '''
+    Raised for a request whose body cannot be decoded as an image, the client's fault (HTTP 400).
+    '''
+
+
+def latency_summary(latencies, n_requests : int, seconds : float) -> dict:
+    '''
+    Summarizes request latencies (in seconds) as milliseconds percentiles plus throughput.
+    '''
+
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    return {
+        'requests': n_requests,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'throughput': n_requests / seconds if seconds > 0 else 0.0,
+    }
+
+
+class MicroBatcher:
+
+    '''
+    Groups concurrent asyncio requests into batches for a blocking batch function.
+
+    Arguments :
+        process_batch  : Function mapping a list of items to a list of results of the same length. A
+                         result that is an Exception instance is raised to that item's caller only.
+        max_batch_size : The largest batch handed to ``process_batch``.
+        max_wait       : The longest time, in seconds, a batch is held open for more requests.
+    '''
+
+    def __init__(self, process_batch, max_batch_size : int = MAX_BATCH_SIZE, max_wait : float = MAX_WAIT) -> None:
+
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.batch_sizes = deque(maxlen=STATS_WINDOW)
+        self.completed = 0
+        self.started_at = None
+
+        self._queue = None
+        self._task = None
+        # A single thread: forward passes run one at a time, off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        '''
+        Starts the batching loop; must be called from within the running event loop.
+        '''
+
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, item):
+        '''
+        Queues one item and waits for its result.
+        '''
+
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self._queue.put((item, future))
+        try:
+            return await future
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self.completed += 1
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _ in batch]
+            self.batch_sizes.append(len(items))
+            try:
+                results = await loop.run_in_executor(self._executor, self.process_batch, items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f'The batch function returned {len(results)} results for {len(items)} items'
+                    )
+            except Exception as error:
+                # The whole batch failed, so every request of it gets the error
+                results = [error] * len(items)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        '''
+        Returns the server side latency percentiles, throughput and mean batch size.
+        '''
+
+        elapsed = time.perf_counter() - self.started_at if self.started_at else 0.0
+        stats = latency_summary(list(self.latencies), self.completed, elapsed)
+        stats['mean_batch_size'] = float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0
+        return stats
+
+
+class OCRBatchPredictor:
+
+    '''
+    Batch function for ``MicroBatcher``: JPEG bytes in, decoded strings out. Images that fail to
+    decode produce an InvalidImageError for their own request without failing the rest of the batch.
+
+    Arguments :
+        model      : The inference model.
+        decode     : The batched decoding function, e.g. decode_pred; a GreedyDecoder or BeamSearchDecoder
+                     when a cache is given.
+        img_height : The height images are resized to.
+        img_width  : The width images are resized to.
+        cache      : An optional PredictionCache consulted before running the model.
+    '''
+
+    def __init__(
+        self, model, decode, img_height : int = IMG_HEIGHT, img_width : int = IMG_WIDTH, cache = None
+    ) -> None:
+        self.model = model
+        self.decode = decode
+        self.cache = cache
+        self._decode_image = tf.function(
+            lambda contents: decode_image(contents, img_height=img_height, img_width=img_width),
+            input_signature=[tf.TensorSpec([], tf.string)]
+        )
+
+    def __call__(self, jpegs):
+        results = [None] * len(jpegs)
+        images, valid = [], []
+        for index, contents in enumerate(jpegs):
+            try:
+                images.append(self._decode_image(tf.constant(contents)))
+                valid.append(index)
+            except (tf.errors.InvalidArgumentError, ValueError):
+                results[index] = InvalidImageError('Invalid JPEG')
+
+        if images and self.cache is not None:
+            texts, _ = self.cache.predict(self.model, tf.stack(images), self.decode)
+            for index, text in zip(valid, texts):
+                results[index] = text
+        elif images:
+            pred = self.model.predict_on_batch(tf.stack(images))
+            for index, text in zip(valid, self.decode(np.asarray(pred))):
+                results[index] = text
+        return results
+
+
+class OCRServer:
+
+    '''
+    Minimal HTTP/1.1 server (keep-alive supported) in front of a ``MicroBatcher``.
+
+    Arguments :
+        batcher : The micro batcher serving the predictions.
+        host    : The interface to listen on.
+        port    : The port to listen on.
+    '''
+
+    def __init__(self, batcher : MicroBatcher, host : str = '127.0.0.1', port : int = 8500) -> None:
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def _route(self, method : str, path : str, body : bytes):
+        if method == 'POST' and path == '/predict':
+            try:
+                return 200, {'text': await self.batcher.submit(body)}
+            except InvalidImageError as error:
+                return 400, {'error': str(error)}
+            except Exception as error:
+                # A failed forward pass or decode still gets an answer, and the connection stays usable
+                return 500, {'error': f'{type(error).__name__}: {error}'}
+        if method == 'GET' and path == '/stats':
+            return 200, self.batcher.stats()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': 'Not Found'}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._route(method, path, body)
+
+                data = json.dumps(payload).encode()
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+                writer.write(
+                    f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+
+                if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(
+    model,
+    decode,
+    host : str = '127.0.0.1',
+    port : int = 8500,
+    max_batch_size : int = MAX_BATCH_SIZE,
+    max_wait : float = MAX_WAIT,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Serves ``model`` over HTTP until interrupted.
+
+    Arguments :
+        model          : The inference model.
+        decode         : The batched decoding function, e.g. decode_pred.
+        host           : The interface to listen on.
+        port           : The port to listen on.
+        max_batch_size : The largest batch of one forward pass.
+        max_wait       : The longest time a batch waits for more requests, in seconds.
+        img_height     : The height images are resized to.
+        img_width      : The width images are resized to.
+    '''
+
+    predictor = OCRBatchPredictor(model, decode, img_height=img_height, img_width=img_width)
+    server = OCRServer(MicroBatcher(predictor, max_batch_size, max_wait), host, port)
+    print(f'Serving on http://{host}:{port}')
+    asyncio.run(server.serve_forever())
+
+
+async def _post(reader, writer, host : str, body : bytes):
+    writer.write(
+        f'POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+    )
+    await writer.drain()
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return json.loads(await reader.readexactly(length))
+
+
+async def load_test(host : str, port : int, payloads, n_requests : int = 1000, concurrency : int = 32) -> dict:
+    '''
+    Sends ``n_requests`` JPEGs over ``concurrency`` keep-alive connections and measures them.
+
+    Arguments :
+        host        : The server host.
+        port        : The server port.
+        payloads    : The JPEG bytes to send, cycled through.
+        n_requests  : The total number of requests.
+        concurrency : The number of concurrent clients.
+
+    Return:
+        report : The client side p50/p99 latency in milliseconds and the throughput in requests/s.
+    '''
+
+    payloads = list(payloads)
+    latencies = []
+    counter = iter(range(n_requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for index in counter:
+                start = time.perf_counter()
+                await _post(reader, writer, host, payloads[index % len(payloads)])
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latency_summary(latencies, len(latencies), time.perf_counter() - start)
@@ -0,0 +1,494 @@
+'''
+Concurrent architecture and hyperparameter sweeps over one preprocessed copy of the data.
+
+Comparing the notebook's two models means decoding every training image once per model and per epoch.
+``prepare_data`` decodes the training and validation images a single time into uint8 ``.npy`` arrays
+in the model layout; every trial memory-maps them, so the operating system shares one copy of the pages
+between all processes and a trial's input pipeline is a gather. ``run_sweep`` then trains the trials
+concurrently in a pool of processes (each with its share of the cores), with the same budget of
+training steps each, and measures the validation CER every ``eval_every`` steps. A trial whose CER is
+worse than the median of the trials that already reached the same step is stopped early (the median
+stopping rule), which frees its process for the next trial. The result is a leaderboard by CER, with
+the training and inference throughputs. ``encoder_trials`` sizes one trial per sequence encoder of
+``models.ENCODERS`` to the parameter count of the BiLSTM model, to compare them at equal size.
+
+    data = prepare_data('sweep', train_paths, train_texts, valid_paths, valid_texts, vocabulary, MAX_LABEL_LENGTH)
+    leaderboard = run_sweep([trial('small'), trial('large'), trial('small', learning_rate=3e-3)], data)
+    print(format_leaderboard(leaderboard))
+'''
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.decoding import GreedyDecoder
+from handwritten_ocr.evaluation import OCRMetrics
+from handwritten_ocr.models import ARCHITECTURES, ENCODERS, build_ocr_model
+from handwritten_ocr.preprocessing import IMG_HEIGHT, IMG_WIDTH, decode_image
+from handwritten_ocr.vocabulary import Vocabulary
+
+# Version of the prepared data layout, checked before it is reused
+DATA_VERSION = 1
+
+# Number of images decoded at a time by prepare_data
+PREPARE_BATCH = 256
+
+
+def trial(architecture : str = 'small', learning_rate : float = 1e-3, name : str = None, **overrides) -> dict:
+    '''
+    Describes one trial : an architecture of ARCHITECTURES with some of its settings overridden.
+
+    Arguments :
+        architecture  : The key of ARCHITECTURES the trial starts from.
+        learning_rate : The Adam learning rate.
+        name          : The leaderboard name, by default built from the architecture and the overrides.
+        overrides     : Arguments of build_ocr_model replacing the architecture's, e.g.
+                        lstm_units=(256, 128), dense_units=(128,), dropout=0.3, encoder='gru'.
+
+    Return:
+        trial : The JSON serializable trial dictionary.
+    '''
+
+    model = dict(ARCHITECTURES[architecture])
+    unknown = set(overrides) - set(model) - {'lstm_dropout', 'encoder', 'separable'}
+    if unknown:
+        raise ValueError(f'Unknown model settings {sorted(unknown)}')
+    model.update(overrides)
+
+    if name is None:
+        settings = [f'{key}={value}' for key, value in sorted(overrides.items())] + [f'lr={learning_rate:g}']
+        name = ' '.join([architecture] + settings)
+
+    return {'name': name, 'learning_rate': float(learning_rate), 'model': model}
+
+
+def matched_units(
+    n_outputs : int,
+    target_parameters : int,
+    encoder : str,
+    n_blocks : int,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+    **config,
+) -> int:
+    '''
+    Finds the units of a sequence encoder giving the model the closest parameter count to a target.
+
+    Arguments :
+        n_outputs         : The size of the softmax output.
+        target_parameters : The parameter count to match, e.g. the BiLSTM model's.
+        encoder           : One of ENCODERS.
+        n_blocks          : The number of encoder layers or blocks, all with the same units.
+        img_height        : The image height.
+        img_width         : The image width.
+        config            : The other build_ocr_model settings (conv_filters, dense_units, dropout).
+
+    Return:
+        units : The units of every block.
+    '''
+
+    def parameters(units):
+        model, _ = build_ocr_model(
+            n_outputs, img_height=img_height, img_width=img_width, encoder=encoder,
+            lstm_units=(units,) * n_blocks, **config
+        )
+        return model.count_params()
+
+    # The parameter count grows with the units, so a bisection finds the closest
+    low, high = 1, 1024
+    while high - low > 1:
+        middle = (low + high) // 2
+        if parameters(middle) < target_parameters:
+            low = middle
+        else:
+            high = middle
+    return min((low, high), key=lambda units: abs(parameters(units) - target_parameters))
+
+
+def encoder_trials(
+    n_outputs : int,
+    architecture : str = 'small',
+    encoders = ENCODERS,
+    learning_rate : float = 1e-3,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+):
+    '''
+    Builds one trial per sequence encoder, at the parameter count of the architecture's BiLSTM model,
+    so that their throughput and CER compare at equal size.
+
+    Arguments :
+        n_outputs     : The size of the softmax output.
+        architecture  : The key of ARCHITECTURES providing the CNN front end and the reference size.
+        encoders      : The encoders compared.
+        learning_rate : The Adam learning rate of every trial.
+        img_height    : The image height.
+        img_width     : The image width.
+
+    Return:
+        trials : The trial dictionaries, named after their encoder.
+    '''
+
+    config = dict(ARCHITECTURES[architecture])
+    n_blocks = len(config.pop('lstm_units'))
+    reference, _ = build_ocr_model(n_outputs, img_height=img_height, img_width=img_width, **ARCHITECTURES[architecture])
+    target = reference.count_params()
+
+    trials = []
+    for encoder in encoders:
+        if encoder == 'lstm':
+            trials.append(trial(architecture, learning_rate, name=f'{architecture} lstm'))
+            continue
+        units = matched_units(n_outputs, target, encoder, n_blocks, img_height, img_width, **config)
+        trials.append(trial(
+            architecture, learning_rate, name=f'{architecture} {encoder}', encoder=encoder, lstm_units=(units,) * n_blocks
+        ))
+    return trials
+
+
+def _decode_split(paths, images, img_height : int, img_width : int, verbose : bool):
+    dataset = tf.data.Dataset.from_tensor_slices(np.array(list(paths))).map(
+        lambda path: decode_image(tf.io.read_file(path), img_height=img_height, img_width=img_width),
+        num_parallel_calls=tf.data.AUTOTUNE
+    ).batch(PREPARE_BATCH).prefetch(tf.data.AUTOTUNE)
+
+    start = 0
+    for batch in dataset:
+        batch = np.round(batch.numpy() * 255)
+        images[start:start + len(batch)] = batch.astype(np.uint8)
+        start += len(batch)
+        if verbose:
+            print(f'\rDecoded {start}/{len(images)} images', end='')
+    if verbose:
+        print()
+    images.flush()
+
+
+def _data_digest(train_paths, train_texts, valid_paths, valid_texts) -> str:
+    '''
+    Returns a digest of the ordered paths and labels of both splits, so that another split or shuffle of
+    the same size is not mistaken for the prepared one.
+    '''
+
+    digest = hashlib.sha1()
+    for values in (train_paths, train_texts, valid_paths, valid_texts):
+        digest.update(json.dumps(values, ensure_ascii=False).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def prepare_data(
+    directory : str,
+    train_paths,
+    train_texts,
+    valid_paths,
+    valid_texts,
+    vocabulary : Vocabulary,
+    max_label_length : int,
+    img_height : int = IMG_HEIGHT,
+    img_width : int = IMG_WIDTH,
+    verbose : bool = True,
+) -> dict:
+    '''
+    Decodes both splits once into the shared arrays of a sweep. The images are stored as uint8 in the
+    model layout, a quarter of the float32 size; the rounding is below the JPEG quantization. A directory
+    already prepared with the same paths and labels, in the same order, and the same sizes and
+    vocabulary is reused as is.
+
+    Arguments :
+        directory        : Where the arrays are written.
+        train_paths      : The training image paths.
+        train_texts      : The training labels.
+        valid_paths      : The validation image paths.
+        valid_texts      : The validation labels, scored as written.
+        vocabulary       : The Vocabulary the labels are encoded with.
+        max_label_length : The padded label length, MAX_LABEL_LENGTH.
+        img_height       : The image height.
+        img_width        : The image width.
+        verbose          : Whether to print the decoding progress.
+
+    Return:
+        data : The JSON serializable description of the prepared data, passed to ``run_sweep``.
+    '''
+
+    os.makedirs(directory, exist_ok=True)
+    train_paths, valid_paths = [str(path) for path in train_paths], [str(path) for path in valid_paths]
+    train_texts, valid_texts = [str(text) for text in train_texts], [str(text) for text in valid_texts]
+    data = {
+        'version': DATA_VERSION,
+        'directory': os.path.abspath(directory),
+        'train_size': len(train_paths),
+        'valid_size': len(valid_paths),
+        'img_height': img_height,
+        'img_width': img_width,
+        'max_label_length': int(max_label_length),
+        'vocabulary': vocabulary.fingerprint,
+        'digest': _data_digest(train_paths, train_texts, valid_paths, valid_texts),
+    }
+
+    meta_path = os.path.join(directory, 'data.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            if json.load(file) == data:
+                return data
+        os.remove(meta_path)
+
+    vocabulary.save(os.path.join(directory, 'vocabulary.json'))
+    labels, _ = vocabulary.encode(train_texts, max_label_length)
+    np.save(os.path.join(directory, 'train_labels.npy'), labels)
+    with open(os.path.join(directory, 'valid_texts.json'), 'w', encoding='UTF-8') as file:
+        json.dump(valid_texts, file, ensure_ascii=False)
+
+    for split, paths in (('train', train_paths), ('valid', valid_paths)):
+        images = np.lib.format.open_memmap(
+            os.path.join(directory, f'{split}_images.npy'), mode='w+', dtype=np.uint8,
+            shape=(len(paths), img_width, img_height, 1)
+        )
+        _decode_split(paths, images, img_height, img_width, verbose)
+        del images
+
+    # Written last, so that an interrupted preparation is not reused
+    with open(meta_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    return data
+
+
+def _load_data(data : dict):
+    directory = data['directory']
+    with open(os.path.join(directory, 'valid_texts.json'), encoding='UTF-8') as file:
+        valid_texts = json.load(file)
+    return {
+        'train_images': np.load(os.path.join(directory, 'train_images.npy'), mmap_mode='r'),
+        'train_labels': np.load(os.path.join(directory, 'train_labels.npy')),
+        'valid_images': np.load(os.path.join(directory, 'valid_images.npy'), mmap_mode='r'),
+        'valid_texts': valid_texts,
+        'vocabulary': Vocabulary.load(os.path.join(directory, 'vocabulary.json')),
+    }
+
+
+def _train_dataset(arrays : dict, batch_size : int, seed : int):
+    images, labels = arrays['train_images'], arrays['train_labels']
+
+    # Sorted indices read the memory-mapped pages in order
+    def gather(indices):
+        indices = np.sort(indices)
+        return images[indices], labels[indices]
+
+    def load(indices):
+        batch_images, batch_labels = tf.numpy_function(gather, [indices], (tf.uint8, tf.int64))
+        batch_images = tf.ensure_shape(batch_images, (None, *images.shape[1:]))
+        batch_labels = tf.ensure_shape(batch_labels, (None, labels.shape[1]))
+        return {'image': tf.cast(batch_images, tf.float32) / 255, 'label': batch_labels}
+
+    return tf.data.Dataset.range(len(images)).shuffle(len(images), seed=seed).repeat().batch(
+        batch_size, drop_remainder=True
+    ).map(load, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+def _validation_cer(inference_model, arrays : dict, decode, batch_size : int) -> dict:
+    images, texts = arrays['valid_images'], arrays['valid_texts']
+    metrics = OCRMetrics()
+    predict_seconds = 0.0
+    for start in range(0, len(images), batch_size):
+        batch = np.asarray(images[start:start + batch_size], dtype=np.float32) / 255
+        predict_start = time.perf_counter()
+        pred = inference_model.predict_on_batch(batch)
+        predict_seconds += time.perf_counter() - predict_start
+        metrics.update(texts[start:start + batch_size], decode(np.asarray(pred)))
+    report = metrics.result()
+    report.pop('by_length')
+    report['inference_images_per_second'] = len(images) / max(predict_seconds, 1e-9)
+    return report
+
+
+def _should_stop(rungs, lock, step : int, cer : float, min_peers : int) -> bool:
+    with lock:
+        peers = list(rungs.get(step, []))
+        rungs[step] = peers + [cer]
+    return len(peers) >= min_peers and cer > float(np.median(peers))
+
+
+def run_trial(
+    trial : dict,
+    data : dict,
+    steps : int,
+    eval_every : int,
+    batch_size : int = 16,
+    max_seconds : float = None,
+    rungs = None,
+    lock = None,
+    min_peers : int = 2,
+    grace_steps : int = None,
+    threads : int = None,
+    output_dir : str = None,
+    seed : int = 2569,
+) -> dict:
+    '''
+    Trains and scores one trial; normally run in a worker process by ``run_sweep``.
+
+    Arguments :
+        trial       : The trial dictionary of ``trial``.
+        data        : The prepared data of ``prepare_data``.
+        steps       : The budget of training steps.
+        eval_every  : The number of steps between two validation CER measurements.
+        batch_size  : The training batch size.
+        max_seconds : A wall clock budget; the trial ends at the first measurement past it.
+        rungs       : The shared step -> CERs mapping of the median stopping rule; None never stops early.
+        lock        : The lock guarding ``rungs``.
+        min_peers   : The number of trials that must have reached a step before the rule applies.
+        grace_steps : The steps before which a trial is never stopped, by default ``eval_every``.
+        threads     : The op threads of the process; None lets TensorFlow decide.
+        output_dir  : Where the trained model is saved as '<name>.keras'; None does not save it.
+        seed        : The shuffle seed, the same for every trial.
+
+    Return:
+        report : The trial, its status ('completed', 'stopped' or 'timeout'), the final validation CER,
+                 WER and exact match, the CER history, the parameter count and the training and
+                 inference throughputs.
+    '''
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+    grace_steps = eval_every if grace_steps is None else grace_steps
+
+    arrays = _load_data(data)
+    vocabulary = arrays['vocabulary']
+    decode = GreedyDecoder(vocabulary.get_vocabulary(), data['max_label_length'])
+
+    model, inference_model = build_ocr_model(
+        len(vocabulary) + 1, img_height=data['img_height'], img_width=data['img_width'], **trial['model']
+    )
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=trial['learning_rate']))
+    iterator = iter(_train_dataset(arrays, batch_size, seed))
+
+    status, step, history = 'completed', 0, []
+    train_seconds = 0.0
+    start = time.perf_counter()
+    while step < steps:
+        n_steps = min(eval_every, steps - step)
+        step_start = time.perf_counter()
+        for _ in range(n_steps):
+            logs = model.train_on_batch(next(iterator), return_dict=True)
+        train_seconds += time.perf_counter() - step_start
+        step += n_steps
+
+        result = _validation_cer(inference_model, arrays, decode, batch_size=256)
+        history.append({'step': step, 'loss': float(logs['loss']), 'cer': result['cer']})
+        if step >= steps:
+            break
+        if rungs is not None and step >= grace_steps and _should_stop(rungs, lock, step, result['cer'], min_peers):
+            status = 'stopped'
+            break
+        if max_seconds is not None and time.perf_counter() - start > max_seconds:
+            status = 'timeout'
+            break
+
+    checkpoint = None
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        checkpoint = os.path.join(output_dir, trial['name'].replace(' ', '_').replace('/', '-') + '.keras')
+        model.save(checkpoint)
+
+    return {
+        'name': trial['name'],
+        'trial': trial,
+        'status': status,
+        'steps': step,
+        'parameters': model.count_params(),
+        **result,
+        'history': history,
+        'seconds': time.perf_counter() - start,
+        'samples_per_second': step * batch_size / max(train_seconds, 1e-9),
+        'checkpoint': checkpoint,
+    }
+
+
+def run_sweep(
+    trials,
+    data : dict,
+    steps : int = 2000,
+    eval_every : int = 250,
+    batch_size : int = 16,
+    max_seconds : float = None,
+    n_workers : int = None,
+    min_peers : int = 2,
+    grace_steps : int = None,
+    output_dir : str = None,
+    verbose : bool = True,
+):
+    '''
+    Trains the trials concurrently and ranks them by validation CER.
+
+    Arguments :
+        trials      : The trial dictionaries of ``trial``.
+        data        : The prepared data of ``prepare_data``, shared by every trial.
+        steps       : The budget of training steps of each trial.
+        eval_every  : The number of steps between two validation CER measurements.
+        batch_size  : The training batch size.
+        max_seconds : The wall clock budget of each trial.
+        n_workers   : The number of trials trained at once, by default one per 2 cores.
+        min_peers   : The number of trials that must have reached a step before stopping at it.
+        grace_steps : The steps before which no trial is stopped, by default ``eval_every``.
+        output_dir  : Where the trained models are saved; None does not save them.
+        verbose     : Whether to print each trial as it finishes.
+
+    Return:
+        leaderboard : The trial reports of ``run_trial``, by increasing CER.
+    '''
+
+    trials = list(trials)
+    names = [trial['name'] for trial in trials]
+    if len(set(names)) != len(names):
+        raise ValueError('The trial names must be unique')
+
+    cores = os.cpu_count() or 1
+    n_workers = min(n_workers or max(1, cores // 2), len(trials))
+    threads = max(1, cores // n_workers)
+
+    # TensorFlow is not fork safe, and every worker maps the same arrays anyway
+    context = multiprocessing.get_context('spawn')
+    reports = []
+    with context.Manager() as manager:
+        rungs, lock = manager.dict(), manager.Lock()
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(
+                    run_trial, trial, data, steps, eval_every, batch_size=batch_size,
+                    max_seconds=max_seconds, rungs=rungs, lock=lock, min_peers=min_peers,
+                    grace_steps=grace_steps, threads=threads, output_dir=output_dir,
+                )
+                for trial in trials
+            ]
+            for future in as_completed(futures):
+                report = future.result()
+                reports.append(report)
+                if verbose:
+                    print(f"{report['name']} : CER {report['cer']:.4f} after {report['steps']} steps ({report['status']})")
+
+    return sorted(reports, key=lambda report: report['cer'])
+
+
+def format_leaderboard(leaderboard) -> str:
+    '''
+    Formats the leaderboard of ``run_sweep`` as a text table.
+    '''
+
+    width = max([len(report['name']) for report in leaderboard] + [5])
+    lines = [
+        f"{'Trial':<{width}}{'CER':>8}{'WER':>8}{'Exact':>8}{'Steps':>7}{'Params':>10}{'Samples/s':>11}"
+        f"{'Infer/s':>10}  Status"
+    ]
+    for report in leaderboard:
+        lines.append(
+            f"{report['name']:<{width}}{report['cer']:>8.4f}{report['wer']:>8.4f}{report['exact_match']:>8.4f}"
+            f"{report['steps']:>7}{report['parameters']:>10}{report['samples_per_second']:>11.1f}"
+            f"{report['inference_images_per_second']:>10.1f}  {report['status']}"
+        )
+    return '\n'.join(lines)
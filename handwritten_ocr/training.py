@@ -0,0 +1,402 @@
+'''
+Training modes: XLA compilation and mixed precision.
+
+``set_training_mode`` switches the Keras precision policy and returns the settings the models are
+built and compiled with:
+
+    float32   : the notebook default.
+    mixed     : bfloat16 compute (float16 on GPUs without bfloat16), float32 weights.
+    xla       : the training step is compiled with XLA.
+    mixed_xla : both.
+
+Mixed precision is only turned on where the hardware has fast bfloat16 (or float16) arithmetic; on
+other CPUs it would be slower than float32, so the mode falls back to float32 with a warning. The
+softmax output and the CTC layer always stay in float32 (see ``build_ocr_model``). The CTCLoss op has
+no XLA kernel, so XLA modes build the CTC layer with the pure TensorFlow loss ``ctc_batch_cost_xla``.
+
+``ThroughputLogger`` prints the training samples per second of every epoch, and
+``compare_training_modes`` trains the same architecture in each mode for a side by side table.
+
+Large-batch mode : steps of 16 images are dominated by per-step overhead. ``large_batch_optimizer``
+builds an Adam optimizer for an effective batch of hundreds or thousands of images : the learning rate
+is scaled from the one tuned at ``BASE_BATCH_SIZE``, warmed up linearly, then decayed (``WarmupDecay``),
+and the gradients of ``batch_size // micro_batch_size`` consecutive micro batches are accumulated
+before every update, so that only a micro batch has to fit in memory. ``time_to_target`` trains
+several settings and reports the wall time each one needs to reach a validation loss.
+'''
+
+import math
+import time
+import warnings
+
+import tensorflow as tf
+from tensorflow import keras
+
+# Supported training modes
+TRAINING_MODES = ('float32', 'mixed', 'xla', 'mixed_xla')
+
+# CPU flags of native bfloat16 arithmetic
+BF16_CPU_FLAGS = ('avx512_bf16', 'amx_bf16')
+
+# Batch size the notebook's LEARNING_RATE was tuned for
+BASE_BATCH_SIZE = 16
+
+# Learning rate scaling rules : 'linear' (SGD) or 'sqrt', the safer one for Adam
+LR_SCALING = ('linear', 'sqrt')
+
+# Learning rate decays after the warmup
+LR_DECAYS = ('cosine', 'step')
+
+
+def _cpu_flags() -> set:
+    try:
+        with open('/proc/cpuinfo') as file:
+            for line in file:
+                if line.startswith('flags'):
+                    return set(line.split(':', 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def mixed_precision_policy():
+    '''
+    Returns the mixed precision policy suited to the hardware, or None when it has no fast half
+    precision arithmetic.
+    '''
+
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        capability = tf.config.experimental.get_device_details(gpus[0]).get('compute_capability', (0, 0))
+        if capability >= (8, 0):
+            return 'mixed_bfloat16'
+        if capability >= (7, 0):
+            return 'mixed_float16'
+        return None
+
+    if _cpu_flags() & set(BF16_CPU_FLAGS):
+        return 'mixed_bfloat16'
+    return None
+
+
+def set_training_mode(mode : str = 'float32') -> dict:
+    '''
+    Sets the global precision policy of a training mode. Must be called before the models are built.
+
+    Argument :
+        mode : One of TRAINING_MODES.
+
+    Return:
+        config : {'mode', 'policy', 'jit_compile', 'xla'}; 'jit_compile' goes to ``model.compile`` and
+                 'xla' to ``build_ocr_model`` (or to the CTC layer).
+    '''
+
+    if mode not in TRAINING_MODES:
+        raise ValueError(f'Unknown training mode {mode!r}, expected one of {TRAINING_MODES}')
+
+    policy = 'float32'
+    if mode.startswith('mixed'):
+        policy = mixed_precision_policy()
+        if policy is None:
+            warnings.warn('No bfloat16 or float16 support on this machine, training in float32')
+            policy = 'float32'
+    keras.mixed_precision.set_global_policy(policy)
+
+    xla = mode.endswith('xla')
+    return {'mode': mode, 'policy': policy, 'jit_compile': xla, 'xla': xla}
+
+
+class ThroughputLogger(keras.callbacks.Callback):
+
+    '''
+    Logs the training throughput of every epoch, validation excluded.
+
+    Arguments :
+        batch_size : The training batch size.
+        name       : A label printed with every line, e.g. the training mode.
+        verbose    : Whether to print every epoch.
+    '''
+
+    def __init__(self, batch_size : int, name : str = '', verbose : bool = True) -> None:
+        super().__init__()
+        self.batch_size = batch_size
+        self.name = name
+        self.verbose = verbose
+        self.history = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._steps = 0
+        self._start = time.perf_counter()
+        self._end = self._start
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = self._end - self._start
+        samples_per_second = self._steps * self.batch_size / max(seconds, 1e-9)
+        self.history.append({'epoch': epoch + 1, 'seconds': seconds, 'samples_per_second': samples_per_second})
+        if self.verbose:
+            prefix = f'[{self.name}] ' if self.name else ''
+            print(f'{prefix}Epoch {epoch + 1}: {samples_per_second:.1f} samples/s ({seconds:.1f}s)')
+
+
+def compare_training_modes(build_model, dataset, batch_size : int, modes = TRAINING_MODES, epochs : int = 2) -> dict:
+    '''
+    Trains a fresh model in each mode and reports its throughput. The first epoch includes tracing
+    and XLA compilation, so the report uses the last one.
+
+    Arguments :
+        build_model : Function taking the ``xla`` flag and returning a model compiled with
+                      ``jit_compile`` set as given, e.g.
+                      lambda xla: ... build_ocr_model(..., xla=xla) ... compile(jit_compile=xla).
+        dataset     : The training dataset.
+        batch_size  : Its batch size.
+        modes       : The modes to compare.
+        epochs      : The number of epochs per mode.
+
+    Return:
+        report : Mapping of mode to its policy, final loss and samples per second.
+    '''
+
+    previous = keras.mixed_precision.global_policy()
+    report = {}
+    try:
+        for mode in modes:
+            config = set_training_mode(mode)
+            model = build_model(config['xla'])
+            logger = ThroughputLogger(batch_size, name=mode)
+            history = model.fit(dataset, epochs=epochs, callbacks=[logger], verbose=0)
+            report[mode] = {
+                'policy': config['policy'],
+                'loss': history.history['loss'][-1],
+                'samples_per_second': logger.history[-1]['samples_per_second'],
+            }
+    finally:
+        keras.mixed_precision.set_global_policy(previous)
+
+    base = report[modes[0]]['samples_per_second']
+    for row in report.values():
+        row['speedup'] = row['samples_per_second'] / base
+    return report
+
+
+def scaled_learning_rate(
+    base_learning_rate : float,
+    batch_size : int,
+    base_batch_size : int = BASE_BATCH_SIZE,
+    rule : str = 'sqrt',
+) -> float:
+    '''
+    Scales a learning rate tuned at ``base_batch_size`` to ``batch_size``, by the ratio of the batch
+    sizes ('linear') or by its square root ('sqrt').
+    '''
+
+    if rule not in LR_SCALING:
+        raise ValueError(f'Unknown scaling rule {rule!r}, expected one of {LR_SCALING}')
+    ratio = batch_size / base_batch_size
+    return base_learning_rate * (ratio if rule == 'linear' else math.sqrt(ratio))
+
+
+class WarmupDecay(keras.optimizers.schedules.LearningRateSchedule):
+
+    '''
+    Linear warmup to the peak learning rate, then cosine decay to ``final_fraction`` of it, or step
+    decay dividing it by 10 at half and again at three quarters of the remaining updates.
+
+    Arguments :
+        peak_learning_rate : The learning rate at the end of the warmup.
+        warmup_steps       : The number of warmup updates.
+        total_steps        : The number of updates of the whole training.
+        decay              : One of LR_DECAYS.
+        accumulation_steps : The micro batches per update; the optimizer counts micro batches.
+        final_fraction     : The fraction of the peak the cosine decay ends at.
+    '''
+
+    def __init__(
+        self,
+        peak_learning_rate : float,
+        warmup_steps : int,
+        total_steps : int,
+        decay : str = 'cosine',
+        accumulation_steps : int = 1,
+        final_fraction : float = 0.0,
+    ) -> None:
+        if decay not in LR_DECAYS:
+            raise ValueError(f'Unknown decay {decay!r}, expected one of {LR_DECAYS}')
+        self.peak_learning_rate = peak_learning_rate
+        self.warmup_steps = warmup_steps
+        self.total_steps = total_steps
+        self.decay = decay
+        self.accumulation_steps = accumulation_steps
+        self.final_fraction = final_fraction
+
+    def __call__(self, step):
+        update = tf.cast(step // self.accumulation_steps, tf.float32)
+        peak = tf.constant(self.peak_learning_rate, tf.float32)
+        warmup = peak * (update + 1) / max(self.warmup_steps, 1)
+
+        progress = (update - self.warmup_steps) / max(self.total_steps - self.warmup_steps, 1)
+        progress = tf.clip_by_value(progress, 0.0, 1.0)
+        if self.decay == 'cosine':
+            cosine = 0.5 * (1 + tf.cos(math.pi * progress))
+            decayed = peak * (self.final_fraction + (1 - self.final_fraction) * cosine)
+        else:
+            drops = tf.cast(progress >= 0.5, tf.float32) + tf.cast(progress >= 0.75, tf.float32)
+            decayed = peak * tf.pow(0.1, drops)
+
+        return tf.where(update < self.warmup_steps, warmup, decayed)
+
+    def get_config(self):
+        return {
+            'peak_learning_rate': self.peak_learning_rate,
+            'warmup_steps': self.warmup_steps,
+            'total_steps': self.total_steps,
+            'decay': self.decay,
+            'accumulation_steps': self.accumulation_steps,
+            'final_fraction': self.final_fraction,
+        }
+
+
+def large_batch_optimizer(
+    batch_size : int,
+    micro_batch_size : int,
+    steps_per_epoch : int,
+    epochs : int,
+    base_learning_rate : float = 1e-3,
+    base_batch_size : int = BASE_BATCH_SIZE,
+    warmup_epochs : float = 1.0,
+    decay : str = 'cosine',
+    scaling : str = 'sqrt',
+):
+    '''
+    Builds the Adam optimizer of a large-batch run.
+
+    Arguments :
+        batch_size         : The effective batch size of an update, e.g. 512 to 2048.
+        micro_batch_size   : The batch size of the dataset, the largest that fits in memory; it must
+                             divide ``batch_size``.
+        steps_per_epoch    : The number of micro batches per epoch.
+        epochs             : The number of epochs the schedule spans.
+        base_learning_rate : The learning rate tuned at ``base_batch_size`` (LEARNING_RATE).
+        base_batch_size    : The batch size it was tuned at (BATCH_SIZE).
+        warmup_epochs      : The length of the linear warmup, in epochs.
+        decay              : One of LR_DECAYS.
+        scaling            : One of LR_SCALING.
+
+    Return:
+        optimizer : The Adam optimizer, with its learning rate schedule and gradient accumulation.
+    '''
+
+    if batch_size % micro_batch_size:
+        raise ValueError(f'The batch size {batch_size} is not a multiple of the micro batch size {micro_batch_size}')
+    accumulation_steps = batch_size // micro_batch_size
+    updates_per_epoch = max(steps_per_epoch // accumulation_steps, 1)
+
+    schedule = WarmupDecay(
+        scaled_learning_rate(base_learning_rate, batch_size, base_batch_size, scaling),
+        warmup_steps=max(int(warmup_epochs * updates_per_epoch), 1),
+        total_steps=updates_per_epoch * epochs,
+        decay=decay,
+        accumulation_steps=accumulation_steps,
+    )
+    return keras.optimizers.Adam(
+        learning_rate=schedule,
+        gradient_accumulation_steps=accumulation_steps if accumulation_steps > 1 else None,
+    )
+
+
+class TargetLossStopper(keras.callbacks.Callback):
+
+    '''
+    Stops training once the validation loss reaches a target, recording the training time it took
+    (validation excluded) and the samples seen.
+
+    Arguments :
+        target_loss : The validation loss to reach.
+        batch_size  : The batch size of the dataset, to count the samples.
+    '''
+
+    def __init__(self, target_loss : float, batch_size : int) -> None:
+        super().__init__()
+        self.target_loss = target_loss
+        self.batch_size = batch_size
+        self.seconds = 0.0
+        self.steps = 0
+        self.reached_epoch = None
+        self.best_loss = math.inf
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+        self._end = self._start
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self._end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds += self._end - self._start
+        loss = (logs or {}).get('val_loss', math.inf)
+        self.best_loss = min(self.best_loss, loss)
+        if loss <= self.target_loss and self.reached_epoch is None:
+            self.reached_epoch = epoch + 1
+            self.model.stop_training = True
+
+
+def time_to_target(build_model, runs : dict, validation_data, target_loss : float, max_epochs : int = 20) -> dict:
+    '''
+    Trains a fresh model per setting until the validation loss reaches ``target_loss``.
+
+    Arguments :
+        build_model     : Function returning a fresh, uncompiled training model.
+        runs            : Mapping of name to {'dataset', 'optimizer', 'batch_size'}, where 'batch_size' is
+                          the effective batch size of an update, and 'micro_batch_size' the dataset's
+                          when it differs. The first run is the reference.
+        validation_data : The validation dataset.
+        target_loss     : The validation CTC loss to reach.
+        max_epochs      : The most epochs a setting is trained for.
+
+    Return:
+        report : Mapping of name to whether the target was reached, the epochs and training seconds it
+                 took, the samples per second, the best validation loss and the speedup over the reference.
+    '''
+
+    report = {}
+    for name, run in runs.items():
+        model = build_model()
+        model.compile(optimizer=run['optimizer'])
+        micro_batch_size = run.get('micro_batch_size', run['batch_size'])
+        stopper = TargetLossStopper(target_loss, micro_batch_size)
+        history = model.fit(
+            run['dataset'], validation_data=validation_data, epochs=max_epochs, callbacks=[stopper], verbose=0
+        )
+        report[name] = {
+            'batch_size': run['batch_size'],
+            'reached': stopper.reached_epoch is not None,
+            'epochs': stopper.reached_epoch or len(history.history['loss']),
+            'seconds': stopper.seconds,
+            'samples_per_second': stopper.steps * micro_batch_size / max(stopper.seconds, 1e-9),
+            'best_val_loss': stopper.best_loss,
+        }
+
+    reference = report[next(iter(report))]
+    for row in report.values():
+        both = row['reached'] and reference['reached']
+        row['speedup'] = reference['seconds'] / row['seconds'] if both else None
+    return report
+
+
+def format_time_to_target(report : dict) -> str:
+    '''
+    Formats the report of ``time_to_target`` as a text table.
+    '''
+
+    lines = [f"{'Setting':<14}{'Batch':>7}{'Reached':>9}{'Epochs':>8}{'Seconds':>10}{'Samples/s':>11}{'Best loss':>11}{'Speedup':>9}"]
+    for name, row in report.items():
+        speedup = '' if row['speedup'] is None else f"{row['speedup']:.2f}"
+        lines.append(
+            f"{name:<14}{row['batch_size']:>7}{str(row['reached']):>9}{row['epochs']:>8}{row['seconds']:>10.1f}"
+            f"{row['samples_per_second']:>11.1f}{row['best_val_loss']:>11.3f}{speedup:>9}"
+        )
+    return '\n'.join(lines)
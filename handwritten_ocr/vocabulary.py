@@ -0,0 +1,204 @@
+'''
+Persisted character vocabulary and vectorized label encoding.
+
+The class indices the models are trained on are defined by the order of the vocabulary. Building it
+from a Python ``set`` gives a different order on every run (string hashing is randomized), so a saved
+checkpoint could silently be decoded with the wrong characters. ``Vocabulary`` keeps the characters
+sorted, carries a fingerprint of them, and is saved as a small JSON file next to the model
+(``vocabulary_path``). ``load_or_create`` reloads it when it exists.
+
+``Vocabulary.encode`` turns a whole column of labels into a padded integer array plus the label
+lengths in a few NumPy operations. The pipelines then slice these arrays instead of splitting and
+looking up every label string on every epoch. The indices are those of
+``StringLookup(vocabulary=characters, mask_token=None)``: 0 for unknown characters, then the characters.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from handwritten_ocr.decoding import OOV_TOKEN
+
+# Version of the file format
+FORMAT_VERSION = 1
+
+
+def vocabulary_path(model_path : str) -> str:
+    '''
+    Returns the path of the vocabulary saved next to a model, e.g. Handwritten-OCR.vocab.json for
+    Handwritten-OCR.keras.
+    '''
+
+    return os.path.splitext(model_path)[0] + '.vocab.json'
+
+
+class Vocabulary:
+
+    '''
+    An ordered character vocabulary.
+
+    Arguments :
+        characters       : The characters, in class index order (index 0 is the OOV token).
+        max_label_length : The longest training label (MAX_LABEL_LENGTH), which bounds the decoded
+                           predictions; None when unknown.
+    '''
+
+    def __init__(self, characters, max_label_length : int = None) -> None:
+        self.characters = list(characters)
+        self.max_label_length = max_label_length
+        if len(set(self.characters)) != len(self.characters):
+            raise ValueError('The vocabulary has duplicate characters')
+
+    @classmethod
+    def from_labels(cls, labels):
+        '''
+        Builds the vocabulary of every character found in ``labels``, in sorted order.
+        '''
+
+        labels = [str(label) for label in labels]
+        return cls(sorted(set(''.join(labels))), max(map(len, labels), default=0))
+
+    @property
+    def fingerprint(self) -> str:
+        '''
+        A short digest of the ordered characters, identifying the class mapping.
+        '''
+
+        return hashlib.sha1(json.dumps(self.characters).encode('UTF-8')).hexdigest()[:12]
+
+    @property
+    def n_classes(self) -> int:
+        '''
+        The number of characters, OOV token excluded (the notebook's n_classes).
+        '''
+
+        return len(self.characters)
+
+    def get_vocabulary(self):
+        '''
+        Returns the vocabulary as ``char_to_num.get_vocabulary()`` does, the OOV token first.
+        '''
+
+        return [OOV_TOKEN] + self.characters
+
+    def __len__(self) -> int:
+        return len(self.characters) + 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Vocabulary) and self.characters == other.characters
+
+    def missing(self, labels) -> set:
+        '''
+        Returns the characters of ``labels`` that are not in the vocabulary.
+        '''
+
+        return set(''.join(str(label) for label in labels)) - set(self.characters)
+
+    def save(self, path : str):
+        '''
+        Writes the vocabulary as JSON.
+        '''
+
+        with open(path, 'w', encoding='UTF-8') as file:
+            json.dump({
+                'format_version': FORMAT_VERSION,
+                'fingerprint': self.fingerprint,
+                'oov_token': OOV_TOKEN,
+                'max_label_length': self.max_label_length,
+                'characters': self.characters,
+            }, file, indent=2, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path : str):
+        '''
+        Reads a vocabulary written by ``save``, checking its format version and fingerprint.
+        '''
+
+        with open(path, encoding='UTF-8') as file:
+            data = json.load(file)
+        if data.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported vocabulary format {data.get("format_version")!r} in {path}')
+        vocabulary = cls(data['characters'], data.get('max_label_length'))
+        if vocabulary.fingerprint != data['fingerprint']:
+            raise ValueError(f'The vocabulary in {path} does not match its fingerprint')
+        return vocabulary
+
+    def encode(self, labels, max_length : int, padding : int = None):
+        '''
+        Encodes labels into class indices, all at once.
+
+        Arguments :
+            labels     : The label strings (anything else is converted with str, like the notebook does).
+            max_length : The padded length; longer labels are truncated.
+            padding    : The padding index, by default the CTC blank len(vocabulary) (n_classes + 1).
+
+        Returns:
+            ids     : An int64 array of shape (len(labels), max_length).
+            lengths : An int64 array of the label lengths, after truncation.
+        '''
+
+        padding = len(self) if padding is None else padding
+        labels = [str(label) for label in labels]
+
+        lengths = np.fromiter((len(label) for label in labels), dtype=np.int64, count=len(labels))
+        codes = np.frombuffer(''.join(labels).encode('UTF-32-LE'), dtype=np.uint32)
+
+        # Code point to class index table, unknown characters mapping to 0
+        known = np.array([ord(char) for char in self.characters], dtype=np.int64)
+        size = int(max(known.max(initial=0), codes.max(initial=0))) + 1
+        table = np.zeros(size, dtype=np.int64)
+        table[known] = np.arange(1, len(known) + 1)
+
+        # Scatter every character to its (row, column), dropping what exceeds max_length
+        rows = np.repeat(np.arange(len(labels)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        columns = np.arange(len(codes)) - np.repeat(starts, lengths)
+        keep = columns < max_length
+
+        ids = np.full((len(labels), max_length), padding, dtype=np.int64)
+        ids[rows[keep], columns[keep]] = table[codes[keep]]
+        return ids, np.minimum(lengths, max_length)
+
+    def decode(self, ids, lengths = None):
+        '''
+        Maps rows of class indices back to strings, ignoring indices outside the characters.
+        '''
+
+        vocabulary = self.get_vocabulary()
+        texts = []
+        for index, row in enumerate(np.asarray(ids)):
+            if lengths is not None:
+                row = row[:lengths[index]]
+            texts.append(''.join(vocabulary[i] for i in row if 0 < i < len(vocabulary)))
+        return texts
+
+
+def load_or_create(path : str, labels) -> Vocabulary:
+    '''
+    Loads the vocabulary saved at ``path``, or builds it from ``labels`` and saves it there. A saved
+    vocabulary is never rebuilt, since that would change the classes of the models trained with it;
+    if ``labels`` have characters it lacks, a ValueError asks for a new model name instead.
+
+    Arguments :
+        path   : The vocabulary file, see ``vocabulary_path``.
+        labels : The training labels.
+
+    Return:
+        vocabulary : The vocabulary.
+    '''
+
+    if not os.path.exists(path):
+        vocabulary = Vocabulary.from_labels(labels)
+        vocabulary.save(path)
+        return vocabulary
+
+    vocabulary = Vocabulary.load(path)
+    missing = vocabulary.missing(labels)
+    if missing:
+        raise ValueError(
+            f'The labels have characters missing from the vocabulary saved in {path} : '
+            f'{"".join(sorted(missing))!r}. Train under a new model name to build a new vocabulary.'
+        )
+    return vocabulary
@@ -0,0 +1,70 @@
+'''
+Checks ``compare`` flags regressions on the time per item and refuses reports of another configuration.
+'''
+
+import pytest
+
+from handwritten_ocr.benchmarks import compare, format_comparison
+
+# Configuration and environment shared by the reports
+CONFIG = {'n_samples': 512, 'n_runs': 10, 'batch_sizes': [1, 512], 'architectures': ['small'], 'seed': 2569}
+ENVIRONMENT = {'python': '3.11', 'tensorflow': '2.21', 'cpu_count': 1}
+
+
+def make_report(timings : dict, config : dict = CONFIG, environment : dict = ENVIRONMENT):
+    # timings maps a benchmark name to (median_ms, items)
+    benchmarks = {
+        name: {
+            'median_ms': median_ms,
+            'min_ms': median_ms,
+            'ms_per_item': median_ms / items,
+            'items_per_second': items * 1000 / median_ms,
+            'runs': 10,
+        }
+        for name, (median_ms, items) in timings.items()
+    }
+    return {'environment': environment, 'config': dict(config), 'benchmarks': benchmarks}
+
+
+def test_regressions_are_flagged_on_the_time_per_item():
+    baseline = make_report({'load_image': (512.0, 512), 'inference/1': (10.0, 1), 'decode_pred': (20.0, 512)})
+    report = make_report({'load_image': (512.0, 512), 'inference/1': (12.0, 1), 'decode_pred': (21.0, 512)})
+
+    comparison = compare(report, baseline, tolerance=0.15)
+
+    assert comparison['regressions'] == ['inference/1']
+    assert comparison['benchmarks']['load_image']['ms_per_item'] == pytest.approx(1.0)
+    assert comparison['benchmarks']['inference/1']['ratio'] == pytest.approx(1.2)
+    assert comparison['same_environment']
+
+
+def test_old_baselines_and_new_benchmarks():
+    baseline = make_report({'load_image': (512.0, 512)})
+    # A baseline written before 'ms_per_item' existed
+    del baseline['benchmarks']['load_image']['ms_per_item']
+    report = make_report({'load_image': (1024.0, 512), 'inference/8': (5.0, 8)})
+
+    comparison = compare(report, baseline)
+
+    assert comparison['benchmarks']['load_image']['baseline_ms_per_item'] == pytest.approx(1.0)
+    assert comparison['regressions'] == ['load_image']
+    assert comparison['benchmarks']['inference/8']['ratio'] is None
+    assert 'REGRESSION' in format_comparison(comparison)
+
+
+def test_other_environment_warns():
+    baseline = make_report({'load_image': (512.0, 512)}, environment={**ENVIRONMENT, 'cpu_count': 8})
+    report = make_report({'load_image': (512.0, 512)})
+
+    comparison = compare(report, baseline)
+
+    assert not comparison['same_environment']
+    assert 'different environment' in format_comparison(comparison)
+
+
+def test_other_configuration_is_refused():
+    baseline = make_report({'load_image': (512.0, 512)}, config={**CONFIG, 'n_samples': 64})
+    report = make_report({'load_image': (512.0, 512)})
+
+    with pytest.raises(ValueError, match='n_samples'):
+        compare(report, baseline)
@@ -0,0 +1,45 @@
+'''
+Checks the bucketed pipeline resizes from the image alone and drops samples CTC cannot align.
+'''
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.bucketing import MIN_WIDTH, bucketed_dataset, decode_image_keep_aspect
+from handwritten_ocr.models import DOWNSAMPLE
+
+# Image height of the synthetic samples, as in the notebook
+IMG_HEIGHT = 50
+
+
+def write_jpeg(path, width : int):
+    pixels = np.full((IMG_HEIGHT, width, 1), 255, dtype=np.uint8)
+    tf.io.write_file(path, tf.io.encode_jpeg(pixels))
+    return path
+
+
+def test_width_depends_on_the_image_only(tmp_path):
+    narrow = tf.io.read_file(write_jpeg(str(tmp_path / 'narrow.jpg'), 20))
+    wide = tf.io.read_file(write_jpeg(str(tmp_path / 'wide.jpg'), 150))
+
+    image, input_length = decode_image_keep_aspect(narrow, img_height=IMG_HEIGHT)
+    assert image.shape[0] == MIN_WIDTH and int(input_length) == MIN_WIDTH // DOWNSAMPLE
+
+    image, input_length = decode_image_keep_aspect(wide, img_height=IMG_HEIGHT)
+    assert image.shape[0] == 152 and int(input_length) == 152 // DOWNSAMPLE
+
+
+def test_samples_too_narrow_for_their_label_are_dropped(tmp_path):
+    paths = [write_jpeg(str(tmp_path / f'{index}.jpg'), 20) for index in range(4)]
+    # 16 time steps fit labels of up to 7 characters
+    label_lengths = np.array([3, 7, 8, 12])
+    labels = np.zeros((4, 12), dtype=np.int64)
+
+    dataset = bucketed_dataset(
+        paths, labels, None, batch_size=4, img_height=IMG_HEIGHT, label_lengths=label_lengths
+    )
+    kept = np.concatenate([batch['label_length'].numpy()[:, 0] for batch in dataset])
+
+    assert sorted(kept.tolist()) == [3, 7]
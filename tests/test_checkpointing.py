@@ -0,0 +1,101 @@
+'''
+Tests of the resumable training loop : the History and the callback state carried across calls.
+'''
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.checkpointing import fit_resumable
+
+
+class SquaredError(keras.layers.Layer):
+
+    # Adds its loss like the CTC layer, so batches carry their targets as an input
+    def call(self, y_true, y_pred):
+        self.add_loss(tf.reduce_mean(tf.square(y_true - y_pred)))
+        return y_pred
+
+
+def make_model():
+    keras.utils.set_random_seed(0)
+    x, y = keras.Input(shape=(4,), name='x'), keras.Input(shape=(1,), name='y')
+    model = keras.Model([x, y], SquaredError()(y, keras.layers.Dense(1)(x)))
+    model.compile(optimizer=keras.optimizers.SGD(learning_rate=0.01))
+    return model
+
+
+def make_dataset():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(32, 4)).astype(np.float32)
+    y = x.sum(axis=1, keepdims=True)
+    return tf.data.Dataset.from_tensor_slices({'x': x, 'y': y}).batch(8)
+
+
+def test_history_covers_every_call(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    dataset = make_dataset()
+
+    first = fit_resumable(make_model(), dataset, epochs=1, checkpoint_dir=directory, verbose=0)
+    assert first.epoch == [0]
+
+    history = fit_resumable(make_model(), dataset, epochs=3, checkpoint_dir=directory, verbose=0)
+    assert history.epoch == [0, 1, 2]
+    assert history.history['loss'][0] == first.history['loss'][0]
+    assert len(history.history['loss']) == 3
+
+    # Every epoch is trained : a new call restores the History and trains nothing
+    model = make_model()
+    again = fit_resumable(model, dataset, epochs=3, checkpoint_dir=directory, verbose=0)
+    assert again.history == history.history
+    assert int(model.optimizer.iterations.numpy()) == 12
+
+
+def test_early_stop_is_not_trained_past(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    dataset = make_dataset()
+
+    def early_stopping():
+        # Only the first epoch counts as an improvement, so the run stops after the second
+        return keras.callbacks.EarlyStopping(monitor='loss', patience=1, min_delta=1e9, restore_best_weights=True)
+
+    model = make_model()
+    history = fit_resumable(
+        model, dataset, epochs=5, checkpoint_dir=directory, callbacks=[early_stopping()], verbose=0
+    )
+    assert history.epoch == [0, 1]
+    weights = model.get_weights()
+
+    model = make_model()
+    callback = early_stopping()
+    again = fit_resumable(model, dataset, epochs=5, checkpoint_dir=directory, callbacks=[callback], verbose=0)
+    assert again.epoch == [0, 1]
+    assert int(model.optimizer.iterations.numpy()) == 8
+    assert callback.stopped_epoch == 1
+    # The best weights of the first epoch are restored again at the end
+    for restored, expected in zip(model.get_weights(), weights):
+        np.testing.assert_array_equal(restored, expected)
+
+
+def test_resume_at_the_end_of_an_epoch(tmp_path):
+    directory = str(tmp_path / 'checkpoints')
+    dataset = make_dataset()
+
+    class Interrupt(keras.callbacks.Callback):
+        # Stops the process after the last step of the first epoch was saved, before its end is processed
+        def on_epoch_end(self, epoch, logs=None):
+            raise KeyboardInterrupt
+
+    try:
+        fit_resumable(
+            make_model(), dataset, epochs=2, checkpoint_dir=directory, callbacks=[Interrupt()],
+            save_steps=4, async_save=False, verbose=0
+        )
+    except KeyboardInterrupt:
+        pass
+
+    model = make_model()
+    history = fit_resumable(model, dataset, epochs=2, checkpoint_dir=directory, verbose=0)
+    assert history.epoch == [0, 1]
+    assert len(history.history['loss']) == 2
+    assert int(model.optimizer.iterations.numpy()) == 8
@@ -0,0 +1,88 @@
+'''
+Tests of the greedy decoder against Keras' CTC decoding, and of the beam search decoder's input
+lengths and confidences.
+'''
+
+import itertools
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.decoding import BeamSearchDecoder, GreedyDecoder
+
+VOCABULARY = ['[UNK]', 'A', 'B']
+
+
+def test_beam_probability_sums_the_alignments():
+    probs = np.random.default_rng(0).dirichlet(np.ones(4), size=4)
+    decoder = BeamSearchDecoder(VOCABULARY, 5, beam_width=100, prune_threshold=0, num_workers=1)
+    text, probability = decoder.search_with_probability(probs)
+
+    # Every path of the 4 classes (the last is the blank), summed by the labelling it collapses to
+    totals = {}
+    for path in itertools.product(range(4), repeat=len(probs)):
+        labelling = tuple(c for t, c in enumerate(path) if c != 3 and (t == 0 or c != path[t - 1]))
+        totals[labelling] = totals.get(labelling, 0.0) + np.prod(probs[np.arange(len(probs)), path])
+    best = max(totals, key=totals.get)
+
+    assert text == ''.join(VOCABULARY[c] if c else ' ' for c in best).strip()
+    assert np.isclose(probability, totals[best])
+
+
+def test_input_length_ignores_padding():
+    pred = np.random.default_rng(1).dirichlet(np.full(4, 0.3), size=(6, 10)).astype(np.float32)
+    lengths = np.array([10, 7, 5, 10, 3, 8])
+    decoder = BeamSearchDecoder(VOCABULARY, 5, beam_width=5, greedy_threshold=0.5, num_workers=1)
+
+    texts, confidences = decoder.decode_with_confidence(pred, lengths)
+    assert decoder(pred, lengths) == texts
+    for index, length in enumerate(lengths):
+        text, confidence = decoder.decode_with_confidence(pred[index:index + 1, :length])
+        assert texts[index] == text[0]
+        assert np.isclose(confidences[index], confidence[0])
+
+
+def reference_decode_pred(pred, vocabulary, max_length : int):
+    # The notebook's original decode_pred: CTC decode in Keras, num_to_char, reduce_join, OOV to space
+    num_to_char = keras.layers.StringLookup(vocabulary=vocabulary, mask_token=None, invert=True)
+    input_length = np.full(pred.shape[0], pred.shape[1])
+    if hasattr(keras.backend, 'ctc_decode'):
+        decoded = keras.backend.ctc_decode(pred, input_length=input_length, greedy=True)[0][0]
+    else:
+        # Keras 3; Keras 2 took the last class as the blank
+        decoded = keras.ops.ctc_decode(
+            pred, input_length, strategy='greedy', mask_index=len(vocabulary)
+        )[0][0]
+    chars = num_to_char(keras.ops.convert_to_numpy(decoded)[:, :max_length])
+    texts = [tf.strings.reduce_join(inputs=char).numpy().decode('UTF-8') for char in chars]
+    return [text.replace('[UNK]', ' ').strip() for text in texts]
+
+
+def one_hot_paths(paths, n_classes : int):
+    pred = np.full((len(paths), len(paths[0]), n_classes), 0.01, dtype=np.float32)
+    for index, path in enumerate(paths):
+        pred[index, np.arange(len(path)), path] = 1.0
+    return pred / pred.sum(axis=-1, keepdims=True)
+
+
+def test_greedy_decoder_matches_keras_ctc_decode():
+    vocabulary = ['[UNK]', 'A', 'B', 'É', '-', ' ']
+    blank = len(vocabulary)
+    max_length = 5
+    paths = [
+        [1, 1, 2, 2, 2, 1, blank, blank, blank, blank],   # repeats collapse
+        [1, blank, 1, blank, 2, blank, 2, 2, blank, 3],   # blanks separate repeats
+        [blank] * 10,                                     # nothing emitted
+        [0, 1, 0, 0, 2, blank, 0, 3, blank, 0],           # OOV shown as a space, truncated, then stripped
+        [5, 1, 5, 2, blank, 4, 3, 1, 2, 1],               # a space character, truncated to max_length
+        [1, 2, 3, 4, 1, 2, 3, 4, 1, 2],
+    ]
+    pred = one_hot_paths(paths, blank + 1)
+    # And random predictions, peaked so that the best path emits characters
+    random_pred = np.random.default_rng(2).dirichlet(np.full(blank + 1, 0.2), size=(64, 10))
+    pred = np.concatenate([pred, random_pred.astype(np.float32)])
+
+    expected = reference_decode_pred(pred, vocabulary, max_length)
+    assert expected[:6] == ['ABA', 'AABBÉ', '', 'A B', 'A B-', 'ABÉ-A']
+    assert GreedyDecoder(vocabulary, max_length)(pred) == expected
@@ -0,0 +1,53 @@
+'''
+Runs a two worker training job on this machine and loads the model the chief writes.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from handwritten_ocr import distributed
+from handwritten_ocr.models import ARCHITECTURES, build_ocr_model
+
+# Label characters of the synthetic job, after the OOV token
+ALPHABET = 'ABCDEFGHIJ'
+
+
+def make_images(directory, n_images : int):
+    rng = np.random.default_rng(0)
+    rows = []
+    for index in range(n_images):
+        pixels = rng.integers(0, 256, size=(50, 200, 1), dtype=np.uint8)
+        filename = f'SYNTH_{index:03d}.jpg'
+        tf.io.write_file(os.path.join(directory, filename), tf.io.encode_jpeg(pixels))
+        rows.append({'FILENAME': filename, 'IDENTITY': ''.join(rng.choice(list(ALPHABET), size=5))})
+    csv_path = os.path.join(directory, 'written_name_synthetic.csv')
+    pd.DataFrame(rows).to_csv(csv_path, index=False)
+    return csv_path
+
+
+def test_launch_two_local_workers(tmp_path, monkeypatch):
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    csv_path = make_images(str(image_dir), 16)
+
+    # The workers inherit the temporary directory, so whatever they leave behind shows up here
+    worker_tmp = tmp_path / 'tmp'
+    worker_tmp.mkdir()
+    monkeypatch.setenv('TMPDIR', str(worker_tmp))
+
+    checkpoint = str(tmp_path / 'model.keras')
+    job = distributed.training_job(
+        csv_path, str(image_dir), ['[UNK]', *ALPHABET], max_label_length=8,
+        checkpoint=checkpoint, batch_size=4,
+    )
+    report = distributed.launch(job, 2, threads_per_worker=1, log_dir=str(tmp_path / 'logs'))
+
+    assert report['workers'] == 2 and report['global_batch_size'] == 8
+    assert np.isfinite(report['loss'])
+    assert os.listdir(worker_tmp) == []
+
+    model, _ = build_ocr_model(len(ALPHABET) + 2, **ARCHITECTURES['small'])
+    model.load_weights(checkpoint)
@@ -0,0 +1,52 @@
+'''
+Checks the edit distance and the OCR metrics on small hand computed cases.
+'''
+
+import pytest
+
+from handwritten_ocr.evaluation import OCRMetrics, edit_distance
+
+
+def test_edit_distance():
+    assert edit_distance('kitten', 'sitting') == 3
+    assert edit_distance('sitting', 'kitten') == 3
+    assert edit_distance('', 'LEE') == 3
+    assert edit_distance('LEE', '') == 3
+    assert edit_distance('', '') == 0
+    assert edit_distance('JOHN', 'JOHN') == 0
+    # Word sequences : one insertion
+    assert edit_distance(['MARY', 'ANN'], ['MARY', 'JO', 'ANN']) == 1
+
+
+def test_metrics_overall_and_by_length():
+    metrics = OCRMetrics()
+    # Streamed in two batches
+    metrics.update(['JOHN', 'MARY ANN'], ['JON', 'MARY ANN'])
+    metrics.update(['', 'LEE'], ['X', ''])
+
+    report = metrics.result()
+
+    # Character errors 1 + 0 + 1 + 3 over 4 + 8 + 0 + 3 characters, word errors 1 + 0 + 1 + 1 over
+    # 1 + 2 + 0 + 1 words, one exact match out of four
+    assert report['samples'] == 4
+    assert report['cer'] == pytest.approx(5 / 15)
+    assert report['wer'] == pytest.approx(3 / 4)
+    assert report['exact_match'] == pytest.approx(1 / 4)
+
+    assert list(report['by_length']) == [0, 3, 4, 8]
+    # An empty reference has no characters to divide by, so its rates are the raw edit distances
+    assert report['by_length'][0] == {'samples': 1, 'cer': 1.0, 'wer': 1.0, 'exact_match': 0.0}
+    # An empty prediction deletes every character
+    assert report['by_length'][3] == {'samples': 1, 'cer': 1.0, 'wer': 1.0, 'exact_match': 0.0}
+    assert report['by_length'][4] == {'samples': 1, 'cer': 0.25, 'wer': 1.0, 'exact_match': 0.0}
+    assert report['by_length'][8] == {'samples': 1, 'cer': 0.0, 'wer': 0.0, 'exact_match': 1.0}
+
+
+def test_empty_reference_and_prediction_match():
+    metrics = OCRMetrics()
+    metrics.update([''], [''])
+
+    report = metrics.result()
+
+    assert report['cer'] == 0.0 and report['wer'] == 0.0 and report['exact_match'] == 1.0
+    assert report['by_length'] == {0: {'samples': 1, 'cer': 0.0, 'wer': 0.0, 'exact_match': 1.0}}
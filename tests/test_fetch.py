@@ -0,0 +1,161 @@
+'''
+Tests of the resumable fetch stage against a local HTTP server honouring Range requests.
+'''
+
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+import pytest
+
+from handwritten_ocr import fetch
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+
+    # Served files by path, the ranges requested, and the requests cut halfway
+    files = {}
+    requests = []
+    cut = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_error(404)
+            return
+
+        header = self.headers.get('Range')
+        if header is None:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        else:
+            start, _, end = header.removeprefix('bytes=').partition('-')
+            start, end = int(start), min(int(end), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.requests.append((start, end))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        body = data[start:end + 1]
+        if (start, end) in self.cut:
+            self.cut.discard((start, end))
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    RangeHandler.files, RangeHandler.requests, RangeHandler.cut = {}, [], set()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_zip(files : dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zfile:
+        for name, data in files.items():
+            zfile.writestr(name, data)
+    return buffer.getvalue()
+
+
+def make_tar(files : dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tfile:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tfile.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_resume_after_cut_connection(server, tmp_path, monkeypatch):
+    data = os.urandom(10_000)
+    RangeHandler.files['/archive.bin'] = data
+    RangeHandler.cut.add((4096, 6143))
+    monkeypatch.setattr(fetch, 'MAX_RETRIES', 1)
+    path = str(tmp_path / 'archive.bin')
+
+    with pytest.raises(OSError):
+        fetch.download(server + '/archive.bin', path, part_size=2048, num_workers=1, verbose=False)
+    assert not os.path.exists(path)
+
+    # Only the range that was cut is requested again
+    RangeHandler.requests.clear()
+    digest = fetch.download(server + '/archive.bin', path, part_size=2048, num_workers=1, verbose=False)
+    assert [request for request in RangeHandler.requests if request != (0, 0)] == [(4096, 6143)]
+    assert digest == hashlib.sha256(data).hexdigest()
+    with open(path, 'rb') as file:
+        assert file.read() == data
+
+
+def test_checksum_mismatch(server, tmp_path):
+    RangeHandler.files['/archive.bin'] = os.urandom(5000)
+    path = str(tmp_path / 'archive.bin')
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        fetch.download(server + '/archive.bin', path, sha256='0' * 64, part_size=2048, verbose=False)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.parametrize('is_zip', [True, False])
+def test_streamed_extraction_replaces_stale_files(server, tmp_path, capsys, is_zip):
+    make = make_zip if is_zip else make_tar
+    suffix = '.zip' if is_zip else '.tar'
+    old = make({'data/old.txt': b'old', 'data/kept.txt': b'v1'})
+    new = make({'data/kept.txt': b'v2' * 5000, 'data/new.txt': os.urandom(20_000)})
+    input_path, cache_dir = str(tmp_path / 'input'), str(tmp_path / 'cache')
+
+    for archive in (old, new):
+        RangeHandler.files['/bundle/archive' + suffix] = archive
+        mapping = 'names:' + quote(server + '/bundle/archive' + suffix + '?signature=1', safe='')
+        fetch.fetch_data_sources(mapping, input_path, cache_dir, part_size=4096, num_workers=2, verbose=False)
+        # A new archive under the same name is fetched again
+        os.remove(os.path.join(cache_dir, 'names' + suffix))
+
+    destination = os.path.join(input_path, 'names', 'data')
+    assert sorted(os.listdir(destination)) == ['kept.txt', 'new.txt']
+    with open(os.path.join(destination, 'kept.txt'), 'rb') as file:
+        assert file.read() == b'v2' * 5000
+    assert not os.path.exists(os.path.join(input_path, 'names' + fetch.STAGING_SUFFIX))
+    # Both archives were extracted while downloading, not from the cache afterwards
+    assert 'from the archive' not in capsys.readouterr().out
+
+
+def test_stream_zip_with_data_descriptors(tmp_path):
+    # Zip files written to a stream carry their sizes after the data, in a data descriptor
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.chunks = []
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            self.chunks.append(bytes(data))
+            return len(data)
+
+    output = Unseekable()
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as zfile:
+        zfile.writestr('a/b.txt', b'hello' * 1000)
+        zfile.writestr('c.txt', b'')
+    fetch._stream_zip(io.BytesIO(b''.join(output.chunks)), str(tmp_path))
+
+    with open(tmp_path / 'a' / 'b.txt', 'rb') as file:
+        assert file.read() == b'hello' * 1000
+    assert os.path.getsize(tmp_path / 'c.txt') == 0
@@ -0,0 +1,26 @@
+'''
+Tests of the per-stage latencies recorded inside a tf.data pipeline.
+'''
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.instrumentation import PipelineStats, notebook_stages
+
+
+def test_slow_stage_dominates_latency(tmp_path):
+    # Decoding a large JPEG takes tens of milliseconds, reading it and the cheap stages far less
+    pixels = np.random.default_rng(0).integers(0, 256, size=(2000, 2000, 1), dtype=np.uint8)
+    path = str(tmp_path / 'large.jpg')
+    tf.io.write_file(path, tf.io.encode_jpeg(pixels))
+
+    stages = [stage for stage in notebook_stages() if stage[0] in ('read_file', 'decode_jpeg', 'transpose')]
+    stats = PipelineStats()
+    dataset = tf.data.Dataset.from_tensor_slices({'path': [path] * 4, 'label': np.zeros((4, 1), np.int64)})
+    for _ in stats.timed_map(dataset, stages, num_parallel_calls=1):
+        pass
+
+    latency = stats.stage_latency()
+    assert max(latency, key=latency.get) == 'decode_jpeg'
+    assert latency['decode_jpeg'] > 5 * max(latency['read_file'], latency['transpose'])
+    assert latency['decode_jpeg'] > 5
@@ -0,0 +1,90 @@
+'''
+Tests of the prediction cache's fingerprint memo and size accounting.
+'''
+
+import numpy as np
+from tensorflow import keras
+
+from handwritten_ocr import prediction_cache
+from handwritten_ocr.decoding import GreedyDecoder
+from handwritten_ocr.prediction_cache import PredictionCache
+
+VOCABULARY = ['[UNK]', 'A', 'B']
+
+
+def make_models():
+    '''
+    Returns a compiled training model and an uncompiled inference model sharing its layers, like the
+    notebook's ocr_model and inference_model.
+    '''
+
+    keras.utils.set_random_seed(0)
+    images = keras.Input(shape=(6, 2, 1))
+    probs = keras.layers.Dense(len(VOCABULARY) + 1, activation='softmax')(keras.layers.Reshape((6, 2))(images))
+    model = keras.Model(images, probs)
+    model.compile(optimizer=keras.optimizers.SGD(learning_rate=1.0), loss='mse')
+    return model, keras.Model(images, probs)
+
+
+def count_fingerprints(monkeypatch):
+    calls = []
+    fingerprint = prediction_cache.model_fingerprint
+    monkeypatch.setattr(
+        prediction_cache, 'model_fingerprint', lambda model: calls.append(model) or fingerprint(model)
+    )
+    return calls
+
+
+def train(model, images):
+    model.train_on_batch(images, np.eye(len(VOCABULARY) + 1)[np.zeros((len(images), 6), dtype=int)])
+
+
+def test_fingerprint_is_taken_again_after_training(tmp_path, monkeypatch):
+    calls = count_fingerprints(monkeypatch)
+    (model, _), cache = make_models(), PredictionCache(str(tmp_path))
+    images = np.random.default_rng(0).random((4, 6, 2, 1), dtype=np.float32)
+    before = cache.probabilities(model, images)
+    cache.probabilities(model, images)
+    assert len(calls) == 1 and cache.hits == 4
+
+    train(model, images)
+    after = cache.probabilities(model, images)
+    assert len(calls) == 2 and cache.misses == 8
+    np.testing.assert_allclose(after, model.predict_on_batch(images), rtol=1e-6)
+    assert not np.allclose(before, after)
+
+
+def test_uncompiled_inference_model_sees_training(tmp_path, monkeypatch):
+    calls = count_fingerprints(monkeypatch)
+    (model, inference_model), cache = make_models(), PredictionCache(str(tmp_path))
+    cached_model = prediction_cache.CachedModel(inference_model, cache)
+    images = np.random.default_rng(2).random((4, 6, 2, 1), dtype=np.float32)
+    cached_model.predict_on_batch(images)
+    cached_model.predict_on_batch(images)
+    assert len(calls) == 1 and cache.hits == 4
+
+    # The training model takes the steps; the inference model only shares its weights
+    for _ in range(5):
+        train(model, images)
+    probs = cached_model.predict_on_batch(images)
+    assert len(calls) == 2 and cache.hits == 4
+    np.testing.assert_allclose(probs, inference_model.predict_on_batch(images), rtol=1e-6)
+
+    # Weights loaded from elsewhere are seen too
+    inference_model.set_weights([weight * 0.5 for weight in inference_model.get_weights()])
+    probs = cached_model.predict_on_batch(images)
+    assert len(calls) == 3
+    np.testing.assert_allclose(probs, inference_model.predict_on_batch(images), rtol=1e-6)
+
+
+def test_redecoded_entries_are_resized(tmp_path):
+    (model, _), cache = make_models(), PredictionCache(str(tmp_path))
+    images = np.random.default_rng(1).random((4, 6, 2, 1), dtype=np.float32)
+    cache.probabilities(model, images)
+
+    # The entries were stored without a text; decoding them from their probabilities adds one
+    cache.predict(model, images, GreedyDecoder(VOCABULARY, max_length=6))
+    db = cache._connect()
+    for key, text, logits, nbytes in db.execute('SELECT key, text, logits, nbytes FROM predictions'):
+        assert nbytes == len(key) + len(text) + len(logits)
+    assert cache._bytes == cache.stats()['bytes']
@@ -0,0 +1,19 @@
+'''
+Checks ``export_tflite`` refuses int8 calibration sets smaller than a batch before converting anything.
+'''
+
+import numpy as np
+import pytest
+
+from handwritten_ocr.quantization import export_tflite
+
+
+def test_int8_export_needs_a_full_calibration_batch(tmp_path):
+    calibration = np.zeros((8, 200, 50, 1), dtype=np.float32)
+    path = str(tmp_path / 'model.tflite')
+
+    # The model is never reached: the calibration set is checked first
+    with pytest.raises(ValueError, match='at least 16 calibration images, got 8'):
+        export_tflite(None, path, 'int8', calibration, batch_size=16)
+    with pytest.raises(ValueError, match='at least 32 calibration images, got 8'):
+        export_tflite(None, path, 'int8', calibration, batch_size=4, extra_batch_sizes=(32,))
@@ -0,0 +1,96 @@
+'''
+Checks the status codes of the server: a bad image only fails its own request with 400, and failures
+of the server answer 500, even when they are ValueErrors.
+'''
+
+import asyncio
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from handwritten_ocr.server import MicroBatcher, OCRBatchPredictor, OCRServer
+
+# Time the first request of a batch waits for the others, long enough to batch the test's requests
+MAX_WAIT = 0.2
+
+
+class FakeModel:
+
+    def __init__(self, error : Exception = None) -> None:
+        self.error = error
+
+    def predict_on_batch(self, images):
+        if self.error is not None:
+            raise self.error
+        return np.zeros((images.shape[0], 4, 3), dtype=np.float32)
+
+
+def decode(pred):
+    return ['TEXT'] * len(pred)
+
+
+def make_jpeg() -> bytes:
+    pixels = np.full((50, 200, 1), 255, dtype=np.uint8)
+    return tf.io.encode_jpeg(pixels).numpy()
+
+
+async def request(port : int, method : str, path : str, body : bytes = b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    payload = json.loads(await reader.readexactly(length))
+    writer.close()
+    return status, payload
+
+
+def serve_requests(model, requests):
+    async def main():
+        predictor = OCRBatchPredictor(model, decode)
+        server = OCRServer(MicroBatcher(predictor, max_wait=MAX_WAIT), port=0)
+        await server.start()
+        try:
+            responses = await asyncio.gather(*(request(server.port, *arguments) for arguments in requests))
+            return responses, server.batcher.stats()
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_invalid_image_only_fails_its_own_request():
+    jpeg = make_jpeg()
+    requests = [('POST', '/predict', jpeg), ('POST', '/predict', b'not a jpeg'), ('POST', '/predict', jpeg)]
+
+    responses, stats = serve_requests(FakeModel(), requests)
+
+    assert responses == [(200, {'text': 'TEXT'}), (400, {'error': 'Invalid JPEG'}), (200, {'text': 'TEXT'})]
+    assert stats['mean_batch_size'] == 3
+
+
+def test_server_failures_answer_500():
+    jpeg = make_jpeg()
+    requests = [('POST', '/predict', jpeg), ('POST', '/predict', jpeg)]
+
+    # A ValueError of the model is still the server's fault
+    responses, _ = serve_requests(FakeModel(ValueError('bad shape')), requests)
+
+    assert [status for status, _ in responses] == [500, 500]
+    assert responses[0][1] == {'error': 'ValueError: bad shape'}
+
+
+def test_other_routes():
+    responses, _ = serve_requests(FakeModel(), [('GET', '/health'), ('GET', '/missing')])
+
+    assert responses == [(200, {'status': 'ok'}), (404, {'error': 'Not Found'})]
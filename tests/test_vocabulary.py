@@ -0,0 +1,84 @@
+'''
+Checks ``Vocabulary.encode`` against the notebook's StringLookup and pad encoding, and the saved
+vocabulary's round trip and mismatch errors.
+'''
+
+import json
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+
+from handwritten_ocr.vocabulary import Vocabulary, load_or_create
+
+# Training labels, non-ASCII characters included
+LABELS = ['BALTHAZAR', "D'ARC", 'JEAN-LUC', 'ÉLODIE', 'STRAßE', 'ZOË MAY', '']
+
+# Padded label length
+MAX_LENGTH = 10
+
+
+def reference_encode(label : str, characters, max_length : int):
+    # The notebook's encode_label: unicode_split, char_to_num, pad with n_classes + 1
+    char_to_num = keras.layers.StringLookup(vocabulary=list(characters), mask_token=None)
+    vecs = char_to_num(tf.strings.unicode_split(label, input_encoding='UTF-8'))
+    vecs = tf.pad(vecs, paddings=[[0, max_length - tf.shape(vecs)[0]]], constant_values=len(characters) + 1)
+    return vecs.numpy()
+
+
+def test_encode_matches_the_notebook():
+    vocabulary = Vocabulary.from_labels(LABELS)
+    # Unknown characters, ASCII or not, map to the OOV index 0
+    labels = LABELS + ['ÅSA', 'X9Y', 'ÉÉÉ ?']
+
+    ids, lengths = vocabulary.encode(labels, MAX_LENGTH)
+
+    expected = np.stack([reference_encode(label, vocabulary.characters, MAX_LENGTH) for label in labels])
+    np.testing.assert_array_equal(ids, expected)
+    np.testing.assert_array_equal(lengths, [len(label) for label in labels])
+    assert ids[-3, 0] == 0 and ids[-2, 1] == 0
+    assert vocabulary.decode(ids, lengths)[:len(LABELS)] == LABELS
+
+
+def test_encode_truncates_long_labels():
+    vocabulary = Vocabulary.from_labels(LABELS)
+
+    ids, lengths = vocabulary.encode(['BALTHAZAR JEAN', 'ÉLODIE'], 6, padding=-1)
+
+    assert lengths.tolist() == [6, 6]
+    assert vocabulary.decode(ids) == ['BALTHA', 'ÉLODIE']
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / 'model.vocab.json')
+    vocabulary = Vocabulary.from_labels(LABELS)
+    vocabulary.save(path)
+
+    loaded = Vocabulary.load(path)
+    assert loaded == vocabulary
+    assert loaded.fingerprint == vocabulary.fingerprint
+    assert loaded.max_label_length == vocabulary.max_label_length == 9
+    # Saved as UTF-8 text rather than escapes
+    with open(path, encoding='UTF-8') as file:
+        assert 'ß' in file.read()
+
+    # Reordered characters no longer match the fingerprint
+    with open(path, encoding='UTF-8') as file:
+        data = json.load(file)
+    data['characters'] = data['characters'][::-1]
+    with open(path, 'w', encoding='UTF-8') as file:
+        json.dump(data, file)
+    with pytest.raises(ValueError, match='fingerprint'):
+        Vocabulary.load(path)
+
+
+def test_load_or_create_refuses_new_characters(tmp_path):
+    path = str(tmp_path / 'model.vocab.json')
+    created = load_or_create(path, LABELS)
+
+    # Labels within the saved vocabulary reload it unchanged
+    assert load_or_create(path, ['JEAN', 'ZOË']) == created
+
+    with pytest.raises(ValueError, match="'ÅØ'"):
+        load_or_create(path, LABELS + ['ØSTÅ'])